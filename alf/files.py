@@ -187,6 +187,13 @@ def filter_by(alf_path, **kwargs):
         filter_by(alf_path, attribute='intervals', timescale='bpod')
     """
     alf_files = [f for f in os.listdir(alf_path) if is_valid(f)]
+    return _filter_files(alf_files, **kwargs)
+
+
+def _filter_files(alf_files, **kwargs):
+    """
+    Filters a list of ALF file names, see filter_by
+    """
     attributes = [alf_parts(f, as_dict=True) for f in alf_files]
 
     if kwargs:
@@ -7,7 +7,9 @@ https://ibllib.readthedocs.io/en/develop/04_reference.html#alf
 
 import json
 import copy
+import fnmatch
 import logging
+import os
 import re
 from uuid import UUID
 from datetime import datetime
@@ -19,12 +21,40 @@ import pandas as pd
 
 from brainbox.core import Bunch
 from brainbox.io import parquet
-from ibllib.io import jsonable
+from ibllib.io import jsonable, npy_header
 from ibllib.exceptions import ALFObjectNotFound
 from . import files
 
 _logger = logging.getLogger('ibllib')
 
+CHUNK_SIZE = 2 ** 26  # bytes copied at once when concatenating memory-mapped arrays
+
+
+def _concatenate_to_file(arrays, file):
+    """
+    Concatenates arrays along the first axis into a new npy file, copying chunks of CHUNK_SIZE
+    bytes so that memory-mapped inputs are never fully read into memory
+    :param arrays: list of np.ndarray or np.memmap
+    :param file: output npy file
+    :return: np.memmap of the concatenated array opened read-only
+    """
+    dtype = np.result_type(*arrays)
+    shape = (sum(a.shape[0] for a in arrays),) + arrays[0].shape[1:]
+    # writes to a temporary file as the inputs may be memory-mapped from the output file
+    file_part = Path(file).parent.joinpath(Path(file).name + '.part')
+    out = np.lib.format.open_memmap(file_part, mode='w+', dtype=dtype, shape=shape)
+    nrows = max(1, CHUNK_SIZE // max(1, dtype.itemsize * int(np.prod(shape[1:]))))
+    first = 0
+    for a in arrays:
+        for i in range(0, a.shape[0], nrows):
+            chunk = a[i:i + nrows]
+            out[first + i:first + i + chunk.shape[0]] = chunk
+        first += a.shape[0]
+    out.flush()
+    del out
+    file_part.replace(file)
+    return np.load(file, mmap_mode='r')
+
 
 class AlfBunch(Bunch):
 
@@ -32,17 +62,22 @@ class AlfBunch(Bunch):
     def check_dimensions(self):
         return check_dimensions(self)
 
-    def append(self, b, inplace=False):
+    def append(self, b, inplace=False, mmap_path=None):
         """
         Appends one bunch to another, key by key
         :param bunch:
+        :param mmap_path: if provided, folder in which the concatenated arrays are written
+         by chunks as `<key>.npy` files and returned as read-only memmaps, so that memory-mapped
+         arrays are not read into memory
         :return: Bunch
         """
-        # default is to return a copy
+        # default is to return a copy. Memory-mapped arrays are not copied, a deep copy would read
+        # them into memory and the concatenation creates new arrays anyway
         if inplace:
             a = self
         else:
-            a = AlfBunch(copy.deepcopy(self))
+            a = AlfBunch({k: v if isinstance(v, np.memmap) else copy.deepcopy(v)
+                          for k, v in self.items()})
         # handles empty bunches for convenience if looping
         if b == {}:
             return a
@@ -54,7 +89,10 @@ class AlfBunch(Bunch):
                                       "For more complex merges, convert to pandas dataframe.")
         # do the merge; only concatenate lists and np arrays right now
         for k in a:
-            if isinstance(a[k], np.ndarray):
+            if isinstance(a[k], np.ndarray) and mmap_path is not None:
+                Path(mmap_path).mkdir(parents=True, exist_ok=True)
+                a[k] = _concatenate_to_file([a[k], b[k]], Path(mmap_path).joinpath(f'{k}.npy'))
+            elif isinstance(a[k], np.ndarray):
                 a[k] = np.concatenate((a[k], b[k]), axis=0)
             elif isinstance(a[k], list):
                 a[k].extend(b[k])
@@ -97,14 +135,19 @@ def dataframe(adict):
     return df
 
 
-def _find_metadata(file_alf):
+def _find_metadata(file_alf, candidates=None):
     """
     Loof for an existing meta-data file for an alf_file
     :param file_alf: PurePath of existing alf file
+    :param candidates: optional list of files to look into instead of listing the folder
     :return: PurePath of meta-data if exists
     """
     ns, obj = file_alf.name.split('.')[:2]
-    meta_data_file = list(file_alf.parent.glob(f'{ns}.{obj}*.metadata*.json'))
+    if candidates is not None:
+        meta_data_file = [f for f in candidates
+                          if fnmatch.fnmatch(f.name, f'{ns}.{obj}*.metadata*.json')]
+    else:
+        meta_data_file = list(file_alf.parent.glob(f'{ns}.{obj}*.metadata*.json'))
     if meta_data_file:
         return meta_data_file[0]
 
@@ -120,9 +163,30 @@ def check_dimensions(dico):
     :param dico: dictionary containing data
     :return: status 0 for consistent dimensions, 1 for inconsistent dimensions
     """
+    shapes = {lab: dico[lab].shape for lab in dico if isinstance(dico[lab], np.ndarray)}
+    return _check_shapes(shapes)
+
+
+def check_dimensions_headers(alfpath, object, **kwargs):
+    """
+    Test for consistency of dimensions of an ALF object on disk, as per check_dimensions,
+    from the npy files headers only without reading any data
+
+    :param alfpath: folder containing the object files
+    :param object: ALF object name
+    :return: status 0 for consistent dimensions, 1 for inconsistent dimensions
+    """
+    headers = read_headers(alfpath, object, **kwargs)
+    return _check_shapes({lab: h.shape for lab, h in headers.items() if h.shape is not None})
+
+
+def _check_shapes(shapes):
+    """
+    :param shapes: dictionary of attribute: shape tuple
+    :return: status 0 for consistent dimensions, 1 for inconsistent dimensions
+    """
     excluded_attributes = ['timestamps']
-    shapes = [dico[lab].shape for lab in dico if isinstance(dico[lab], np.ndarray) and
-              lab.split('.')[0] not in excluded_attributes]
+    shapes = [sh for lab, sh in shapes.items() if lab.split('.')[0] not in excluded_attributes]
     # the dictionary may contain only excluded attributes, in this case return success
     if not shapes:
         return int(0)
@@ -156,17 +220,21 @@ def read_ts(filename):
     return np.load(filename.parent / time_file), np.load(filename)
 
 
-def load_file_content(fil):
+def load_file_content(fil, mmap_mode=None):
     """
     Returns content of files. Designed for very generic file formats:
     so far supported contents are `json`, `npy`, `csv`, `tsv`, `ssv`, `jsonable`
 
     :param fil: file to read
+    :param mmap_mode: if not None, `npy` files are memory-mapped using this mode (see np.load),
+     except arrays of Python objects that are loaded in memory
     :return:array/json/pandas dataframe depending on format
     """
     if not fil:
         return
     fil = Path(fil)
+    if _is_bundled(fil):
+        return load_bundle(fil.parent, names=[fil.name], mmap_mode=mmap_mode)[fil.name]
     if fil.stat().st_size == 0:
         return
     if fil.suffix == '.csv':
@@ -181,6 +249,11 @@ def load_file_content(fil):
     if fil.suffix == '.jsonable':
         return jsonable.read(fil)
     if fil.suffix == '.npy':
+        if mmap_mode:
+            try:
+                return np.load(file=fil, mmap_mode=mmap_mode)
+            except ValueError:  # object arrays and empty files can't be memory-mapped
+                pass
         return np.load(file=fil, allow_pickle=True)
     if fil.suffix == '.pqt':
         return parquet.load(fil)
@@ -191,9 +264,130 @@ def load_file_content(fil):
     return Path(fil)
 
 
+BUNDLE_EXT = '.alfb'
+BUNDLE_MAGIC = b'\x93ALFBNDL'
+BUNDLE_ALIGN = 64  # bytes, alignment of the index and of each array in the bundle file
+BUNDLE_EXP = re.compile(r'^_?(?P<namespace>(?<=_)[a-zA-Z0-9]+)?_?(?P<object>\w+)\.alfb$')
+
+
+def _align(nbytes):
+    return int(np.ceil(nbytes / BUNDLE_ALIGN) * BUNDLE_ALIGN)
+
+
+def bundle_name(object, namespace=None):
+    """
+    :param object: ALF object name
+    :param namespace: optional ALF namespace
+    :return: name of the bundle file of the object, ie. `(_namespace_)object.alfb`
+    """
+    return ('_%s_' % namespace if namespace else '') + object + BUNDLE_EXT
+
+
+def save_bundle(file_bundle, arrays):
+    """
+    Writes arrays in a single bundle file: a json index of the arrays names, dtypes, shapes and
+    offsets followed by the raw data of each array, aligned so that they can be memory-mapped
+    without copy. The file is written to a temporary file and moved in place.
+
+    :param file_bundle: output file, see bundle_name
+    :param arrays: dictionary of ALF file names (ie. `spikes.times.npy`): numerical np.ndarray
+    :return: pathlib.Path of the bundle file
+    """
+    file_bundle = Path(file_bundle)
+    index, offset = [], 0
+    for name, arr in arrays.items():
+        fortran_order = bool(arr.flags.f_contiguous and not arr.flags.c_contiguous)
+        index.append({'name': name, 'descr': np.lib.format.dtype_to_descr(arr.dtype),
+                      'shape': list(arr.shape), 'fortran_order': fortran_order,
+                      'offset': offset, 'nbytes': int(arr.nbytes)})
+        offset = _align(offset + arr.nbytes)
+    index = json.dumps(index).encode()
+    file_part = file_bundle.parent.joinpath(file_bundle.name + '.part')
+    with open(file_part, 'wb') as fid:
+        fid.write(BUNDLE_MAGIC + len(index).to_bytes(8, byteorder='little') + index)
+        for arr in arrays.values():
+            fid.write(b'\x00' * (_align(fid.tell()) - fid.tell()))
+            # arrays are written in their memory order
+            (arr.T if arr.flags.f_contiguous and not arr.flags.c_contiguous else arr).tofile(fid)
+    file_part.replace(file_bundle)
+    return file_bundle
+
+
+def read_bundle_index(file_bundle):
+    """
+    Reads the index of a bundle file without reading the data
+    :param file_bundle: bundle file
+    :return: dictionary of ALF file name: Bunch(descr, shape, fortran_order, offset, nbytes),
+     offsets are absolute in the file
+    """
+    with open(file_bundle, 'rb') as fid:
+        if fid.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f'{file_bundle} is not an ALF bundle file')
+        index_len = int.from_bytes(fid.read(8), byteorder='little')
+        index = json.loads(fid.read(index_len).decode())
+    header_len = _align(len(BUNDLE_MAGIC) + 8 + index_len)
+    out = {}
+    for entry in index:
+        entry['offset'] += header_len
+        entry['shape'] = tuple(entry['shape'])
+        out[entry.pop('name')] = Bunch(entry)
+    return out
+
+
+def load_bundle(file_bundle, names=None, mmap_mode=None):
+    """
+    Loads the arrays of a bundle file at once
+    :param file_bundle: bundle file
+    :param names: optional list of ALF file names to load (default: all)
+    :param mmap_mode: if not None, the arrays are memory-mapped views of the file (see np.load),
+     otherwise the arrays are read from a single open file
+    :return: dictionary of ALF file name: np.ndarray
+    """
+    index = read_bundle_index(file_bundle)
+    if names is not None:
+        index = {n: e for n, e in index.items() if n in names}
+    out = {}
+    with open(file_bundle, 'rb') as fid:
+        if mmap_mode:
+            buffer = np.memmap(fid, dtype=np.uint8, mode=mmap_mode)
+        for name, entry in index.items():
+            dtype = np.lib.format.descr_to_dtype(entry.descr)
+            if mmap_mode:
+                data = buffer[entry.offset:entry.offset + entry.nbytes].view(dtype)
+            else:
+                fid.seek(entry.offset)
+                data = np.fromfile(fid, dtype=dtype, count=entry.nbytes // dtype.itemsize)
+            out[name] = data.reshape(entry.shape, order='F' if entry.fortran_order else 'C')
+    return out
+
+
+def _ls_bundles(alfpath, object=None, **kwargs):
+    """
+    Lists the attributes stored in the bundle files of a folder, except those that also exist
+    as individual files
+    :return: list of pathlib.Path of `<bundle file>/<ALF file name>` and list of ALF parts
+    """
+    names = os.listdir(alfpath)
+    bundles = [n for n in names if BUNDLE_EXP.match(n) and
+               fnmatch.fnmatch(BUNDLE_EXP.match(n).group('object'), object or '*')]
+    files_alf, attributes = [], []
+    for bundle in bundles:
+        bundled = [n for n in read_bundle_index(Path(alfpath).joinpath(bundle)) if n not in names]
+        kwargs_ = dict(kwargs, object=object) if object else kwargs
+        bundled, parts = files._filter_files(bundled, **kwargs_)
+        files_alf.extend([Path(alfpath).joinpath(bundle, n) for n in bundled])
+        attributes.extend(parts)
+    return files_alf, attributes
+
+
+def _is_bundled(fil):
+    return Path(fil).parent.suffix == BUNDLE_EXT
+
+
 def _ls(alfpath, object=None, **kwargs):
     """
     Given a path, an object and a filter, returns all files and associated attributes
+    Attributes stored in a bundle file are returned as `<bundle file>/<ALF file name>` paths
     :param alfpath: containing folder
     :param object: ALF object string; wildcards permitted
     :return: lists of pathlib.Path for each file and list of corresponding attributes
@@ -208,16 +402,21 @@ def _ls(alfpath, object=None, **kwargs):
         else:
             files_alf, attributes = files.filter_by(alfpath, object=object, **kwargs)
     else:
-        object = files.alf_parts(alfpath.name)[1]
+        match = BUNDLE_EXP.match(alfpath.name)
+        object = match.group('object') if match else files.alf_parts(alfpath.name)[1]
         alfpath = alfpath.parent
         files_alf, attributes = files.filter_by(alfpath, object=object, **kwargs)
+    if files_alf is not None:
+        files_alf = [alfpath.joinpath(f) for f in files_alf]
+        bundled, parts = _ls_bundles(alfpath, object, **kwargs)
+        files_alf, attributes = files_alf + bundled, attributes + parts
 
     # raise error if no files found
     if not files_alf:
         err_str = 'object "%s" ' % object if object else 'ALF files'
         raise ALFObjectNotFound(f'No {err_str} found in {alfpath}')
 
-    return [alfpath.joinpath(f) for f in files_alf], attributes
+    return files_alf, attributes
 
 
 def exists(alfpath, object, attributes=None, **kwargs):
@@ -246,7 +445,67 @@ def exists(alfpath, object, attributes=None, **kwargs):
     return set(attributes).issubset(attributes_found)
 
 
-def load_object(alfpath, object=None, short_keys=False, **kwargs):
+def _attribute_keys(parts, short_keys=False):
+    """
+    Dictionary keys of the attributes of an object from the ALF parts of its files
+    :param parts: list of ALF parts tuples as returned by files.filter_by
+    :param short_keys: if True, keys are the attribute and timescale, otherwise the extra parts
+     are appended separated by a dot
+    :return: list of keys
+    """
+    # Take attribute and timescale from parts list
+    attributes = [p[2] if not p[3] else '_'.join(p[2:4]) for p in parts]
+    if not short_keys:  # Include extra parts in the keys
+        attributes = [attr + ('.' + p[4] if p[4] else '') for attr, p in zip(attributes, parts)]
+    return attributes
+
+
+def read_headers(alfpath, object=None, short_keys=False, **kwargs):
+    """
+    Reads the shape, dtype and size of all the attributes of an object from the npy files headers,
+    without loading the data. If a directory is provided without object name, reads all the
+    objects of the directory.
+    Non npy attributes have None shape and dtype, their size is the file size.
+
+    :param alfpath: any alf file pertaining to the object OR directory containing files
+    :param object: ALF object name; if None and a directory is provided, all objects are read
+    :param short_keys: see load_object
+    :return: for an object, AlfBunch of attribute: Bunch(file, shape, dtype, nbytes); for a
+     directory without object, dictionary of object: AlfBunch of attributes
+
+    Examples:
+        # Number of spikes of a probe, in a few milliseconds even for very long recordings
+        nspikes = alf.io.read_headers(probe_path, 'spikes').times.shape[0]
+        # Total size of the ALF datasets of a session in bytes
+        hdr = alf.io.read_headers(session_path.joinpath('alf'))
+        nbytes = sum(a.nbytes for obj in hdr.values() for a in obj.values())
+    """
+    files_alf, parts = _ls(alfpath, object, **kwargs)
+    if Path(alfpath).is_dir() and object is None:
+        objects = sorted(set(p[1] for p in parts))
+        return {obj: read_headers(alfpath, obj, short_keys=short_keys, **kwargs)
+                for obj in objects}
+    out = AlfBunch({})
+    indices = {}
+    for fil, att in zip(files_alf, _attribute_keys(parts, short_keys=short_keys)):
+        if _is_bundled(fil):
+            if fil.parent not in indices:
+                indices[fil.parent] = read_bundle_index(fil.parent)
+            entry = indices[fil.parent][fil.name]
+            out[att] = Bunch({'file': fil, 'shape': entry.shape, 'nbytes': entry.nbytes,
+                              'dtype': np.lib.format.descr_to_dtype(entry.descr)})
+        elif fil.suffix == '.npy' and fil.stat().st_size > 0:
+            header = npy_header.read(fil)
+            out[att] = Bunch({'file': fil, 'shape': header.shape,
+                              'dtype': npy_header.dtype(header),
+                              'nbytes': npy_header.nbytes(header)})
+        else:
+            out[att] = Bunch({'file': fil, 'shape': None, 'dtype': None,
+                              'nbytes': fil.stat().st_size})
+    return out
+
+
+def load_object(alfpath, object=None, short_keys=False, lazy=False, **kwargs):
     """
     Reads all files (ie. attributes) sharing the same object.
     For example, if the file provided to the function is `spikes.times`, the function will
@@ -260,8 +519,13 @@ def load_object(alfpath, object=None, short_keys=False, **kwargs):
     :param short_keys: by default, the output dictionary keys will be compounds of attributes,
      timescale and any eventual parts separated by a dot. Use True to shorten the keys to the
      attribute and timescale.
+    :param lazy: if True, `npy` attributes are read-only memory-mapped: only the headers are read
+     and the data is read from disk on access. Dimensions are checked from the headers.
     :return: a dictionary of all attributes pertaining to the object
 
+    If a bundle file of the object exists (see save_object_npy), its attributes are read at once
+    from it, individual attribute files take precedence over the bundle.
+
     Examples:
         # Load `spikes` object
         spikes = ibllib.io.alf.load_object('/path/to/my/alffolder/', 'spikes')
@@ -269,25 +533,35 @@ def load_object(alfpath, object=None, short_keys=False, **kwargs):
         # Load `trials` object under the `ibl` namespace
         trials = ibllib.io.alf.load_object(session_path, 'trials', namespace='ibl')
 
+        # Memory-map `spikes` attributes, only the times and clusters accessed are read
+        spikes = ibllib.io.alf.load_object(session_path, 'spikes', lazy=True)
+
     """
     if Path(alfpath).is_dir() and object is None:
         raise ValueError('If a directory is provided, the object name should be provided too')
     files_alf, parts = _ls(alfpath, object, **kwargs)
-    # Take attribute and timescale from parts list
-    attributes = [p[2] if not p[3] else '_'.join(p[2:4]) for p in parts]
-    if not short_keys:  # Include extra parts in the keys
-        attributes = [attr + ('.' + p[4] if p[4] else '') for attr, p in zip(attributes, parts)]
+    attributes = _attribute_keys(parts, short_keys=short_keys)
     assert len(set(attributes)) == len(attributes), (
         f'multiple object {object} with the same attribute in {alfpath}, restrict parts/namespace')
     out = AlfBunch({})
+    # bundled attributes are read at once, one bundle file per object namespace
+    bundles = {}
+    for fil in filter(_is_bundled, files_alf):
+        bundles.setdefault(fil.parent, []).append(fil.name)
+    bundles = {f: load_bundle(f, names=names, mmap_mode='r' if lazy else None)
+               for f, names in bundles.items()}
     # load content for each file
     for fil, att in zip(files_alf, attributes):
         # if there is a corresponding metadata file, read it:
-        meta_data_file = _find_metadata(fil)
-        # if this is the actual meta-data file, skip and it will be read later
-        if meta_data_file == fil:
-            continue
-        out[att] = load_file_content(fil)
+        if _is_bundled(fil):
+            meta_data_file = _find_metadata(fil, candidates=files_alf)
+            out[att] = bundles[fil.parent][fil.name]
+        else:
+            meta_data_file = _find_metadata(fil)
+            # if this is the actual meta-data file, skip and it will be read later
+            if meta_data_file == fil:
+                continue
+            out[att] = load_file_content(fil, mmap_mode='r' if lazy else None)
         if meta_data_file:
             meta = load_file_content(meta_data_file)
             # the columns keyword splits array along the last dimension
@@ -305,7 +579,8 @@ def load_object(alfpath, object=None, short_keys=False, **kwargs):
     return out
 
 
-def save_object_npy(alfpath, dico, object, parts=None, namespace=None, timescale=None):
+def save_object_npy(alfpath, dico, object, parts=None, namespace=None, timescale=None,
+                    bundle=False):
     """
     Saves a dictionary in alf format using object as object name and dictionary keys as attribute
     names. Dimensions have to be consistent.
@@ -318,6 +593,8 @@ def save_object_npy(alfpath, dico, object, parts=None, namespace=None, timescale
     :param parts: extra parts to the ALF name
     :param namespace: the optional namespace of the object
     :param timescale: the optional timescale of the object
+    :param bundle: if True, numerical arrays are written in the object bundle file, that is
+     merged with the existing bundle, instead of individual npy files
     :return: List of written files
 
     example: ibllib.io.alf.save_object_npy('/path/to/my/alffolder/', spikes, 'spikes')
@@ -328,11 +605,23 @@ def save_object_npy(alfpath, dico, object, parts=None, namespace=None, timescale
         raise ValueError('Dimensions are not consistent to save all arrays in ALF format: ' +
                          str([(k, v.shape) for k, v in dico.items()]))
     out_files = []
+    bundled = {}
     for k, v in dico.items():
         out_file = alfpath / files.to_alf(object, k, 'npy',
                                           extra=parts, namespace=namespace, timescale=timescale)
+        if bundle and isinstance(v, np.ndarray) and not v.dtype.hasobject:
+            bundled[out_file.name] = v
+            # the individual file would take precedence over the bundle
+            if out_file.exists():
+                out_file.unlink()
+            continue
         np.save(out_file, v)
         out_files.append(out_file)
+    if bundled:
+        file_bundle = alfpath / bundle_name(object, namespace=namespace)
+        if file_bundle.exists():
+            bundled = {**load_bundle(file_bundle, mmap_mode='r'), **bundled}
+        out_files.append(save_bundle(file_bundle, bundled))
     return out_files
 
 
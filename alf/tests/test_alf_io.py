@@ -4,6 +4,7 @@ from pathlib import Path
 import shutil
 import json
 import uuid
+from unittest import mock
 
 import numpy as np
 
@@ -69,6 +70,30 @@ class TestAlfBunch(unittest.TestCase):
         self.assertTrue(len(c['toto']) == 12)
         self.assertTrue(len(a['toto']) == 3)
 
+    def test_append_memmap(self):
+        with tempfile.TemporaryDirectory() as td:
+            for i, n in enumerate([500, 250]):
+                np.save(Path(td).joinpath(f'obj{i}.titi.npy'), np.random.rand(n, 2))
+                np.save(Path(td).joinpath(f'obj{i}.toto.npy'), np.arange(n))
+            a = alf.io.load_object(td, 'obj0', lazy=True)
+            b = alf.io.load_object(td, 'obj1', lazy=True)
+            self.assertIsInstance(a.titi, np.memmap)
+            with mock.patch.object(alf.io, 'CHUNK_SIZE', 1000):
+                c = a.append(b, mmap_path=Path(td).joinpath('concat'))
+                self.assertIsInstance(c.titi, np.memmap)
+                self.assertTrue(np.all(c.titi == np.r_[a.titi, b.titi]))
+                self.assertTrue(np.all(c.toto == np.r_[np.arange(500), np.arange(250)]))
+                # appending to the memmapped output files in place
+                c.append(b, inplace=True, mmap_path=Path(td).joinpath('concat'))
+                self.assertEqual(c.toto.shape, (1000,))
+                self.assertTrue(np.all(c.toto[750:] == b.toto))
+            self.assertEqual(c.check_dimensions, 0)
+            # without output folder, the concatenation is in memory
+            d = a.append(b)
+            self.assertNotIsInstance(d.titi, np.memmap)
+            self.assertTrue(np.all(d.titi == c.titi[:750]))
+            del a, b, c
+
 
 class TestsAlfPartsFilters(unittest.TestCase):
 
@@ -200,11 +225,44 @@ class TestsAlf(unittest.TestCase):
         obj = alf.io.load_object(self.tmpdir, 'neuveu')
         self.assertTrue(set(obj.keys()) == {'riri', 'fifi', 'loulou'})
         self.assertTrue(all([obj[o].shape == (5,) for o in obj]))
+        # lazy loading memory-maps the arrays
+        obj = alf.io.load_object(self.tmpdir, 'neuveu', lazy=True)
+        self.assertTrue(all(isinstance(obj[o], np.memmap) for o in obj))
+        self.assertTrue(np.all(obj.riri == np.load(self.object_files[0])))
+        self.assertEqual(obj.check_dimensions, 0)
+        # arrays of objects can't be memory-mapped and are loaded in memory
+        np.save(self.tmpdir / 'neuveu.fifi.npy', np.array([{'a': 1}] * 5), allow_pickle=True)
+        obj = alf.io.load_object(self.tmpdir, 'neuveu', lazy=True)
+        self.assertNotIsInstance(obj.fifi, np.memmap)
+        self.assertEqual(obj.fifi[0], {'a': 1})
+        del obj
         # providing directory without object will return all ALF files
         with self.assertRaises(ValueError) as context:
             alf.io.load_object(self.tmpdir)
         self.assertTrue('object name should be provided too' in str(context.exception))
 
+    def test_read_headers(self):
+        np.save(self.tmpdir / 'neuveu.fifi.npy', np.zeros((5, 3), dtype=np.int16))
+        hdr = alf.io.read_headers(self.tmpdir, 'neuveu')
+        self.assertEqual(set(hdr.keys()), {'riri', 'fifi', 'loulou'})
+        self.assertEqual(hdr.fifi.shape, (5, 3))
+        self.assertEqual(hdr.fifi.dtype, np.int16)
+        self.assertEqual(hdr.fifi.nbytes, 30)
+        self.assertEqual(hdr.riri.nbytes, 40)
+        # reading a whole folder returns the headers of each object
+        with open(self.tmpdir / 'neuveu.description.json', 'w+') as fid:
+            fid.write(json.dumps({'toto': 'titi'}))
+        hdrs = alf.io.read_headers(self.tmpdir)
+        self.assertEqual(set(hdrs.keys()), {'neuveu', 'object'})
+        self.assertIsNone(hdrs['neuveu'].description.shape)
+        self.assertEqual(hdrs['neuveu'].description.nbytes, 16)
+        # dimensions checks from headers
+        self.assertEqual(alf.io.check_dimensions_headers(self.tmpdir, 'neuveu'), 0)
+        np.save(self.tmpdir / 'neuveu.timestamps.npy', np.zeros((2, 2)))
+        self.assertEqual(alf.io.check_dimensions_headers(self.tmpdir, 'neuveu'), 0)
+        np.save(self.tmpdir / 'neuveu.riri.npy', np.zeros(6))
+        self.assertEqual(alf.io.check_dimensions_headers(self.tmpdir, 'neuveu'), 1)
+
     def test_save_npy(self):
         # test with straight vectors
         a = {'riri': np.random.rand(100),
@@ -231,6 +289,47 @@ class TestsAlf(unittest.TestCase):
             alf.io.save_object_npy(self.tmpdir, a, 'neuveux')
         self.assertTrue('Dimensions are not consistent' in str(context.exception))
 
+    def test_bundle(self):
+        a = {'riri': np.random.rand(100),
+             'fifi': np.asfortranarray(np.random.rand(100, 3)),
+             'loulou': np.arange(100, dtype=np.int8),
+             'tutu': np.array([{'a': 1}] * 100)}
+        out_files = alf.io.save_object_npy(self.tmpdir, a, 'neuveux', namespace='ns', bundle=True)
+        # the object array can't be bundled and is saved as an individual file
+        self.assertEqual(sorted(f.name for f in out_files),
+                         ['_ns_neuveux.alfb', '_ns_neuveux.tutu.npy'])
+        index = alf.io.read_bundle_index(self.tmpdir / '_ns_neuveux.alfb')
+        self.assertTrue(all(e.offset % alf.io.BUNDLE_ALIGN == 0 for e in index.values()))
+        for lazy in [False, True]:
+            b = alf.io.load_object(self.tmpdir, 'neuveux', lazy=lazy)
+            self.assertEqual(set(b.keys()), set(a.keys()))
+            for k in ['riri', 'fifi', 'loulou']:
+                self.assertTrue(np.all(a[k] == b[k]))
+                self.assertEqual(a[k].dtype, b[k].dtype)
+                self.assertEqual(isinstance(b[k], np.memmap), lazy)
+        self.assertTrue(b.fifi.flags.f_contiguous)
+        # wildcards and filters apply to bundled attributes
+        self.assertEqual(set(alf.io.load_object(self.tmpdir, 'neuv*x', namespace='ns').keys()),
+                         set(a.keys()))
+        self.assertTrue(alf.io.exists(self.tmpdir, 'neuveux', attributes=['riri', 'tutu']))
+        self.assertFalse(alf.io.exists(self.tmpdir, 'neuveux', namespace='toto'))
+        self.assertEqual(alf.io.read_headers(self.tmpdir, 'neuveux').fifi.shape, (100, 3))
+        # loading from the bundle file path or from a bundled attribute path
+        self.assertEqual(len(alf.io.load_object(self.tmpdir / '_ns_neuveux.alfb')), 4)
+        riri = alf.io.load_file_content(self.tmpdir.joinpath('_ns_neuveux.alfb',
+                                                             '_ns_neuveux.riri.npy'))
+        self.assertTrue(np.all(riri == a['riri']))
+        # saving more attributes merges them in the bundle
+        alf.io.save_object_npy(self.tmpdir, {'riri': np.zeros(100), 'toto': np.ones(100)},
+                               'neuveux', namespace='ns', bundle=True)
+        b = alf.io.load_object(self.tmpdir, 'neuveux', short_keys=True)
+        self.assertEqual(set(b.keys()), {'riri', 'fifi', 'loulou', 'tutu', 'toto'})
+        self.assertTrue(np.all(b.riri == 0))
+        # individual files take precedence over the bundle
+        np.save(self.tmpdir / '_ns_neuveux.riri.npy', np.ones(100))
+        self.assertTrue(np.all(alf.io.load_object(self.tmpdir, 'neuveux').riri == 1))
+        del b
+
     def test_check_dimensions(self):
         a = {'a': np.ones([10, 10]), 'b': np.ones([10, 2]), 'c': np.ones([10])}
         status = alf.io.check_dimensions(a)
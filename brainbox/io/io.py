@@ -1,12 +1,9 @@
-import time
 import numpy as np
-# (Previously required `os.path` to get file info before memmapping)
-# import os.path as op
 from ibllib.io import spikeglx
 
 
 def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype='int16',
-                      offset=0, car=True):
+                      offset=0, car=True, out=None):
     """
     Extracts spike waveforms from binary ephys data file, after (optionally)
     common-average-referencing (CAR) spatial noise.
@@ -31,11 +28,13 @@ def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype
         The offset (in bytes) from the start of `ephys_file`.
     car: bool (optional)
         A flag to perform CAR before extracting waveforms.
+    out: string (optional)
+        A npy file path to write the waveforms to, as a memmap. Useful for millions of spikes.
 
     Returns
     -------
     waveforms : ndarray
-        An array of shape (#spikes, #samples, #channels) containing the waveforms.
+        A float32 array of shape (#spikes, #samples, #channels) containing the waveforms in Volts.
 
     Examples
     --------
@@ -64,17 +63,9 @@ def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype
         >>> wf_car = bb.io.extract_waveforms(path_to_ephys_file, ts, ch, car=True)
     """
 
-    # (Previously memmaped the file manually, but now use `spikeglx.Reader`)
-    # item_bytes = np.dtype(dtype).itemsize
-    # n_samples = (op.getsize(ephys_file) - offset) // (item_bytes * n_ch_probe)
-    # file_m = np.memmap(ephys_file, shape=(n_samples, n_ch_probe), dtype=dtype, mode='r')
-
-    # Get memmapped array of `ephys_file`
     s_reader = spikeglx.Reader(ephys_file)
-    file_m = s_reader.data  # the memmapped array
-    n_wf_samples = np.int(sr / 1000 * (t / 2))  # number of samples to return on each side of a ts
+    n_wf_samples = int(sr / 1000 * (t / 2))  # number of samples to return on each side of a ts
     ts_samples = np.array(ts * sr).astype(int)  # the samples corresponding to `ts`
-    t_sample_first = ts_samples[0] - n_wf_samples
 
     # Exception handling for impossible channels
     ch = np.asarray(ch)
@@ -88,24 +79,7 @@ def extract_waveforms(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype
         # see https://github.com/int-brain-lab/iblenv/issues/5
         raise NotImplementedError("CAR option is not available")
 
-    # Initialize `waveforms`, extract waveforms from `file_m`, and CAR.
-    waveforms = np.zeros((len(ts), 2 * n_wf_samples, ch.size))
-    # Give time estimate for extracting waveforms.
-    t0 = time.perf_counter()
-    for i in range(5):
-        waveforms[i, :, :] = \
-            file_m[i * n_wf_samples * 2 + t_sample_first:
-                   i * n_wf_samples * 2 + t_sample_first + n_wf_samples * 2, ch].reshape(
-                       (n_wf_samples * 2, ch.size))
-    dt = time.perf_counter() - t0
-    print('Performing waveform extraction. Estimated time is {:.2f} mins. ({})'
-          .format(dt * len(ts) / 60 / 5, time.ctime()))
-    for spk, _ in enumerate(ts):  # extract waveforms
-        spk_ts_sample = ts_samples[spk]
-        spk_samples = np.arange(spk_ts_sample - n_wf_samples, spk_ts_sample + n_wf_samples)
-        # have to reshape to add an axis to broadcast `file_m` into `waveforms`
-        waveforms[spk, :, :] = \
-            file_m[spk_samples[0]:spk_samples[-1] + 1, ch].reshape((spk_samples.size, ch.size))
-    print('Done. ({})'.format(time.ctime()))
-
+    # Extract all waveforms at once, reads are sorted and batched by the reader
+    waveforms = s_reader.read_waveforms(ts_samples, ch.flatten(),
+                                        window=(-n_wf_samples, n_wf_samples), out=out)
     return waveforms
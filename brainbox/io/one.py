@@ -1,4 +1,6 @@
 from pathlib import Path
+import collections
+import concurrent.futures
 import logging
 import numpy as np
 import pandas as pd
@@ -15,6 +17,15 @@ from brainbox.processing import sync
 
 logger = logging.getLogger('ibllib')
 
+SPIKE_SORTING_DTYPES = [
+    'clusters.channels',
+    'clusters.depths',
+    'clusters.metrics',
+    'spikes.clusters',
+    'spikes.times',
+    'probes.description'
+]
+
 
 def load_lfp(eid, one=None, dataset_types=None):
     """
@@ -236,19 +247,7 @@ def load_spike_sorting(eid, one=None, probe=None, dataset_types=None, force=Fals
             return (None, None), 'no session path'
 
         one = one or ONE()
-        dtypes_default = [
-            'clusters.channels',
-            'clusters.depths',
-            'clusters.metrics',
-            'spikes.clusters',
-            'spikes.times',
-            'probes.description'
-        ]
-        if dataset_types is None:
-            dtypes = dtypes_default
-        else:
-            # Append extra optional DS
-            dtypes = list(set(dataset_types + dtypes_default))
+        dtypes = _spike_sorting_dtypes(dataset_types)
 
         if isinstance(probe, str):
             labels = [probe]
@@ -294,6 +293,150 @@ def load_spike_sorting(eid, one=None, probe=None, dataset_types=None, force=Fals
         return spikes, clusters
 
 
+def _spike_sorting_dtypes(dataset_types=None):
+    if dataset_types is None:
+        return SPIKE_SORTING_DTYPES
+    # Append extra optional DS
+    return list(set(dataset_types + SPIKE_SORTING_DTYPES))
+
+
+def _spike_sorting_exists(session_path, probe, dtypes):
+    """
+    Checks that the spikes and clusters files of the dataset types exist locally without loading
+    """
+    probe_path = session_path.joinpath('alf', probe)
+    for obj in ['spikes', 'clusters']:
+        attributes = [dt.split('.')[1] for dt in dtypes if dt.startswith(obj + '.')]
+        if not alf.io.exists(probe_path, obj, attributes=attributes):
+            return False
+    return True
+
+
+def _imap_unordered(func, iterable, nthreads=4):
+    """
+    Applies func to each item in a thread pool and yields (item, result) as they complete.
+    Only nthreads items are processed ahead of the consumer to bound memory usage.
+    """
+    iterable = iter(iterable)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+        futures = {executor.submit(func, item): item
+                   for item, _ in zip(iterable, range(nthreads))}
+        while futures:
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item = futures.pop(future)
+                for next_item in iterable:
+                    futures[executor.submit(func, next_item)] = next_item
+                    break
+                yield item, future.result()
+
+
+def load_spike_sorting_bulk(eids=None, pids=None, one=None, dataset_types=None, force=False,
+                            nthreads=4):
+    """
+    Loads the spike sorting of many sessions or probe insertions. The probes to load are
+    listed first, then the sessions datasets are downloaded concurrently, while the probes of the
+    sessions already downloaded are loaded in a separate thread pool. Results are yielded as
+    soon as they are loaded so that the computation overlaps with downloads.
+
+    >>> for eid, probe, spikes, clusters in load_spike_sorting_bulk(eids, one=one):
+    ...     process(spikes, clusters)
+
+    :param eids: list of sessions UUIDs, all the probes of the sessions are loaded
+    :param pids: list of probe insertions UUIDs, alternative to eids
+    :param one: one instance
+    :param dataset_types: additional spikes/clusters objects to add to the standard default list
+    :param force: if True, downloads the datasets even if files are found locally
+    :param nthreads: number of concurrent downloads and of concurrent loads
+    :return: generator of (eid, probe label, spikes, clusters) in order of completion
+    """
+    one = one or ONE()
+    dtypes = _spike_sorting_dtypes(dataset_types)
+    # plan: list the probes of each session up-front
+    probes = collections.OrderedDict()
+
+    def _read_insertion(pid):
+        return one.alyx.rest('insertions', 'read', id=pid)
+
+    def _list_insertions(eid):
+        return one.alyx.rest('insertions', 'list', session=eid)
+
+    if pids is not None:
+        for _, ins in _imap_unordered(_read_insertion, pids, nthreads=nthreads):
+            probes.setdefault(ins['session'], []).append(ins['name'])
+    else:
+        for eid, insertions in _imap_unordered(_list_insertions, eids, nthreads=nthreads):
+            probes[eid] = [ins['name'] for ins in insertions]
+
+    def _download(eid):
+        session_path = one.path_from_eid(eid)
+        if not session_path:
+            logger.warning(f'Session {eid} not found')
+            return
+        if force or not all(_spike_sorting_exists(session_path, label, dtypes)
+                            for label in probes[eid]):
+            one.load(eid, dataset_types=dtypes, download_only=True)
+        return session_path
+
+    def _load(eid, session_path, label):
+        spikes, clusters = _load_spike_sorting_local(session_path, label)
+        if not spikes or not clusters:
+            logger.warning(f'Could not load spikes and clusters datasets for session '
+                           f'{session_path} and {label}.')
+        return eid, label, spikes, clusters
+
+    dl_pool = concurrent.futures.ThreadPoolExecutor(max_workers=nthreads)
+    load_pool = concurrent.futures.ThreadPoolExecutor(max_workers=nthreads)
+    downloads, to_load, loads = {}, collections.deque(), set()
+    try:
+        downloads.update({dl_pool.submit(_download, eid): eid for eid in probes if probes[eid]})
+        while downloads or to_load or loads:
+            # only nthreads probes are loaded ahead of the consumer to bound memory usage
+            while to_load and len(loads) < nthreads:
+                loads.add(load_pool.submit(_load, *to_load.popleft()))
+            done, _ = concurrent.futures.wait(
+                set(downloads) | loads, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    eid = downloads.pop(future)
+                    try:
+                        session_path = future.result()
+                    except Exception as e:
+                        logger.error(f'Download of session {eid} failed: {e}')
+                        continue
+                    if session_path:
+                        to_load.extend((eid, session_path, label) for label in probes[eid])
+                else:
+                    loads.remove(future)
+                    yield future.result()
+    finally:
+        # if the consumer stops early, the pending downloads and loads are cancelled
+        for future in list(downloads) + list(loads):
+            future.cancel()
+        dl_pool.shutdown(wait=True)
+        load_pool.shutdown(wait=True)
+
+
+def load_channel_locations_bulk(eids, one=None, aligned=False, nthreads=4):
+    """
+    Gets the brain locations of the channels of many sessions concurrently,
+    see load_channel_locations
+
+    :param eids: list of sessions UUIDs
+    :param one: one instance
+    :param aligned: whether to get the latest user aligned channel when not resolved or use
+    histology track
+    :param nthreads: number of sessions processed concurrently
+    :return: generator of (eid, channels) in order of completion
+    """
+    one = one or ONE()
+
+    def _load(eid):
+        return load_channel_locations(eid, one=one, aligned=aligned)
+    yield from _imap_unordered(_load, eids, nthreads=nthreads)
+
+
 def _load_spike_sorting_local(session_path, probe):
     # gets clusters and spikes from a local session folder
     probe_path = session_path.joinpath('alf', probe)
@@ -537,3 +680,20 @@ def load_trials_df(eid, one=None, maxlen=None, t_before=0., t_after=0., ret_whee
             trials.append(np.abs(whlvel))
     trialsdf['wheel_velocity'] = trials
     return trialsdf
+
+
+def load_trials_df_bulk(eids, one=None, nthreads=4, **kwargs):
+    """
+    Generates the trials dataframes of many sessions concurrently, see load_trials_df
+
+    :param eids: list of sessions UUIDs
+    :param one: one instance
+    :param nthreads: number of sessions processed concurrently
+    :param kwargs: load_trials_df parameters
+    :return: generator of (eid, trialsdf) in order of completion
+    """
+    one = one or ONE()
+
+    def _load(eid):
+        return load_trials_df(eid, one=one, **kwargs)
+    yield from _imap_unordered(_load, eids, nthreads=nthreads)
@@ -15,6 +15,7 @@ Run the following to set-up the workspace to run the docstring examples:
 >>> units_b = bb.processing.get_units_bunch(spks_b)  # may take a few mins to compute
 """
 
+import concurrent.futures
 import time
 import logging
 
@@ -28,7 +29,7 @@ from phylib.stats import correlograms
 import brainbox as bb
 from brainbox.core import Bunch
 from brainbox.numerical import ismember
-from brainbox.processing import bincount2D
+from brainbox.processing import bincount2D, group_index
 from brainbox.metrics import electrode_drift
 
 
@@ -539,24 +540,25 @@ def ptp_over_noise(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype='i
 
     # Compute MAD for `ch` in chunks.
     s_reader = spikeglx.Reader(ephys_file)
-    file_m = s_reader.data  # the memmapped array
     n_chunk_samples = 5e6  # number of samples per chunk
-    n_chunks = np.ceil(file_m.shape[0] / n_chunk_samples).astype('int')
+    n_chunks = np.ceil(s_reader.ns / n_chunk_samples).astype('int')
     # Get samples that make up each chunk. e.g. `chunk_sample[1] - chunk_sample[0]` are the
     # samples that make up the first chunk.
-    chunk_sample = np.arange(0, file_m.shape[0], n_chunk_samples, dtype=int)
-    chunk_sample = np.append(chunk_sample, file_m.shape[0])
+    chunk_sample = np.arange(0, s_reader.ns, n_chunk_samples, dtype=int)
+    chunk_sample = np.append(chunk_sample, s_reader.ns)
     # Give time estimate for computing MAD.
     t0 = time.perf_counter()
-    stats.median_absolute_deviation(file_m[chunk_sample[0]:chunk_sample[1], ch], axis=0)
+    stats.median_absolute_deviation(s_reader.read(
+        slice(chunk_sample[0], chunk_sample[1]), ch.flatten(), sync=False), axis=0)
     dt = time.perf_counter() - t0
     print('Performing MAD computation. Estimated time is {:.2f} mins.'
           ' ({})'.format(dt * n_chunks / 60, time.ctime()))
     # Compute MAD for each chunk, then take the median MAD of all chunks.
-    mad_chunks = np.zeros((n_chunks, ch.size), dtype=np.int16)
+    mad_chunks = np.zeros((n_chunks, ch.size), dtype=np.float32)
     for chunk in range(n_chunks):
-        mad_chunks[chunk, :] = stats.median_absolute_deviation(
-            file_m[chunk_sample[chunk]:chunk_sample[chunk + 1], ch], axis=0, scale=1)
+        mad_chunks[chunk, :] = stats.median_absolute_deviation(s_reader.read(
+            slice(chunk_sample[chunk], chunk_sample[chunk + 1]), ch.flatten(), sync=False),
+            axis=0, scale=1)
     print('Done. ({})'.format(time.ctime()))
 
     # Return `mean_ptp` over `mad`
@@ -672,9 +674,11 @@ def _max_acceptable_cont(FR, RP, rec_duration, acceptableCont, thresh):
     time_for_viol = RP * 2 * FR * rec_duration
     expected_count_for_acceptable_limit = acceptableCont * time_for_viol
     max_acceptable = stats.poisson.ppf(thresh, expected_count_for_acceptable_limit)
-    if max_acceptable == 0 and stats.poisson.pmf(0, expected_count_for_acceptable_limit) > 0:
-        max_acceptable = -1
-    return max_acceptable
+    # works on scalars as well as on arrays for the batched computation
+    max_acceptable = np.where(np.logical_and(
+        max_acceptable == 0, stats.poisson.pmf(0, expected_count_for_acceptable_limit) > 0),
+        -1, max_acceptable)
+    return max_acceptable if max_acceptable.ndim else max_acceptable.item()
 
 
 def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1):
@@ -762,6 +766,207 @@ def slidingRP_viol(ts, bin_size=0.25, thresh=0.1, acceptThresh=0.1):
     return didpass
 
 
+def _spikes_by_cluster(spike_times, spike_clusters):
+    """
+    Groups spikes by cluster for the batched ISI metrics. Spike times are expected to be sorted.
+    :return: spike times sorted by (cluster, time), cluster index of each sorted spike and group
+     index (see `brainbox.processing.group_index`)
+    """
+    gidx = group_index(spike_clusters)
+    iclu = np.repeat(np.arange(gidx.ids.size), gidx.last - gidx.first)
+    return np.asarray(spike_times)[gidx.isort], iclu, gidx
+
+
+def _to_cluster_ids(values, ids, cluster_ids, fill_value):
+    """
+    Re-indexes a vector of per-cluster values computed for the clusters ids onto cluster_ids,
+    clusters without spikes get the fill value
+    """
+    if cluster_ids is None:
+        return values
+    out = np.full(np.asarray(cluster_ids).shape, fill_value, dtype=np.float64)
+    ir, ib = ismember(np.asarray(cluster_ids), ids)
+    out[ir] = values[ib]
+    return out
+
+
+def contamination_alt_clusters(spike_times, spike_clusters, rp=0.002, cluster_ids=None):
+    """
+    Batched version of `contamination_alt`: computes the contamination estimate of all
+    clusters at once from the full spike arrays.
+
+    Parameters
+    ----------
+    spike_times : ndarray_like
+        The timestamps (in s) of all spikes, sorted.
+    spike_clusters : ndarray_like
+        The cluster ids of all spikes.
+    rp : float (optional)
+        The refractory period (in s).
+    cluster_ids : ndarray_like (optional)
+        The clusters ids for which to return the metric. Defaults to the unique spike clusters.
+        Clusters without spikes get NaN.
+
+    Returns
+    -------
+    ce : ndarray
+        An estimate of the fraction of contamination for each cluster.
+
+    See Also
+    --------
+    contamination_alt
+    """
+    ts, iclu, gidx = _spikes_by_cluster(spike_times, spike_clusters)
+    n_spks = gidx.last - gidx.first
+    isi_viol = np.logical_and(iclu[1:] == iclu[:-1], np.diff(ts) < rp)
+    n_isi_viol = np.bincount(iclu[1:][isi_viol], minlength=n_spks.size)
+    t = ts[gidx.last - 1] - ts[gidx.first]
+    c = (t * n_isi_viol) / (2 * rp * n_spks ** 2)  # 3rd term in quadratic
+    # smallest absolute root of -x ** 2 + x + c, with c >= 0
+    ce = 2 * c / (1 + np.sqrt(1 + 4 * c))
+    return _to_cluster_ids(ce, gidx.ids, cluster_ids, np.nan)
+
+
+def contamination_clusters(spike_times, spike_clusters, min_time, max_time, rp=0.002,
+                           min_isi=0.0001, cluster_ids=None):
+    """
+    Batched version of `contamination`: computes the contamination estimate and the number of
+    isi violations of all clusters at once from the full spike arrays.
+
+    Parameters
+    ----------
+    spike_times : ndarray_like
+        The timestamps (in s) of all spikes, sorted.
+    spike_clusters : ndarray_like
+        The cluster ids of all spikes.
+    min_time : float
+        The minimum time (in s) that a potential spike occurred.
+    max_time : float
+        The maximum time (in s) that a potential spike occurred.
+    rp : float (optional)
+        The refractory period (in s).
+    min_isi : float (optional)
+        The minimum interspike-interval (in s) for counting duplicate spikes.
+    cluster_ids : ndarray_like (optional)
+        The clusters ids for which to return the metrics. Defaults to the unique spike clusters.
+        Clusters without spikes get NaN.
+
+    Returns
+    -------
+    ce : ndarray
+        An estimate of the contamination for each cluster.
+    num_violations : ndarray
+        The total number of isi violations for each cluster.
+
+    See Also
+    --------
+    contamination
+    """
+    ts, iclu, gidx = _spikes_by_cluster(spike_times, spike_clusters)
+    # remove the duplicate spikes within each cluster
+    duplicate_spikes = np.r_[False, np.logical_and(iclu[1:] == iclu[:-1],
+                                                   np.diff(ts) <= min_isi)]
+    ts, iclu = (ts[~duplicate_spikes], iclu[~duplicate_spikes])
+    isi_viol = np.logical_and(iclu[1:] == iclu[:-1], np.diff(ts) < rp)
+
+    num_spikes = np.bincount(iclu, minlength=gidx.ids.size)
+    num_violations = np.bincount(iclu[1:][isi_viol], minlength=gidx.ids.size)
+    violation_time = 2 * num_spikes * (rp - min_isi)
+    total_rate = num_spikes / (max_time - min_time)
+    violation_rate = num_violations / violation_time
+    ce = violation_rate / total_rate
+
+    return (_to_cluster_ids(ce, gidx.ids, cluster_ids, np.nan),
+            _to_cluster_ids(num_violations, gidx.ids, cluster_ids, np.nan))
+
+
+def slidingRP_viol_clusters(spike_times, spike_clusters, bin_size=0.25, thresh=0.1,
+                            acceptThresh=0.1, cluster_ids=None):
+    """
+    Batched version of `slidingRP_viol`: computes the sliding refractory period metric of all
+    clusters at once from the full spike arrays. Instead of computing an auto-correlogram per
+    cluster, the number of pairs of spikes within each tested delay is counted for all spikes at
+    once, with the same binning as `phylib.stats.correlograms`.
+
+    Parameters
+    ----------
+    spike_times : ndarray_like
+        The timestamps (in s) of all spikes, sorted.
+    spike_clusters : ndarray_like
+        The cluster ids of all spikes.
+    bin_size : float
+        The size of binning for the autocorrelogram.
+    thresh : float
+        Spike rate used to generate poisson distribution (to compute maximum
+              acceptable contamination, see _max_acceptable_cont)
+    acceptThresh : float
+        The fraction of contamination we are willing to accept (default value
+              set to 0.1, or 10% contamination)
+    cluster_ids : ndarray_like (optional)
+        The clusters ids for which to return the metric. Defaults to the unique spike clusters.
+        Clusters without spikes do not pass.
+
+    Returns
+    -------
+    didpass : ndarray
+        For each cluster, 0 if unit didn't pass, 1 if unit did pass
+
+    See Also
+    --------
+    slidingRP_viol
+    """
+    b = np.arange(0, 10.25, bin_size) / 1000 + 1e-6  # bins in seconds
+    bTestIdx = np.array([5, 6, 7, 8, 10, 12, 14, 16, 18, 20, 24, 28, 32, 36, 40])
+    bTest = b[bTestIdx]
+
+    ts, iclu, gidx = _spikes_by_cluster(spike_times, spike_clusters)
+    nclu = gidx.ids.size
+    n_spks = gidx.last - gidx.first
+    didpass = np.zeros(nclu)
+    if ts.size == 0:
+        return _to_cluster_ids(didpass, gidx.ids, cluster_ids, 0)
+    # same discretization as the correlograms computed with a 2 secs window at 20 kHz
+    sample_rate, window_size = (20000, 2)
+    samples = (ts * sample_rate).astype(np.int64)
+    binsize = int(sample_rate * (bin_size / 1000))
+    num_bins_2s = int(.5 * window_size / (bin_size / 1000)) + 1
+    num_bins_1s = int(num_bins_2s / 2)
+    # sortable keys so that spikes of different clusters are never within the acg window
+    offset = np.ptp(samples) + num_bins_2s * binsize + 1
+    keys = iclu * offset + samples - np.min(samples)
+
+    # acg up to the last testing bin: the pairs of spikes within this delay are few, so they are
+    # found by increasing the shift between spikes until no pair is left within the delay
+    nbins = bTestIdx[-1] + 1
+    acg = np.zeros(nclu * nbins)
+    i, shift = (np.arange(keys.size), 1)
+    while i.size:
+        i = i[i + shift < keys.size]
+        ibin = (keys[i + shift] - keys[i]) // binsize
+        i, ibin = (i[ibin < nbins], ibin[ibin < nbins])
+        acg += np.bincount(iclu[i] * nbins + ibin, minlength=nclu * nbins)
+        shift += 1
+    # cumulative sum of acg at each of the testing bins
+    res = np.cumsum(acg.reshape(nclu, nbins), axis=1)[:, bTestIdx]
+
+    def _npairs(ibin):
+        # number of pairs of spikes of the same cluster in the acg bins 0 to ibin (included)
+        nlast = np.searchsorted(keys, keys + (ibin + 1) * binsize - 1, side='right')
+        return np.bincount(iclu, weights=nlast - np.arange(keys.size) - 1, minlength=nclu)
+
+    # compute fr based on the acg from 1 to 2 s, same as in slidingRP_viol
+    fr_count = _npairs(num_bins_2s - 1) - _npairs(num_bins_1s - 1)
+    fr = fr_count / n_spks / bin_size * 1000 / num_bins_1s
+    recDur = ts[gidx.last - 1] - ts[gidx.first]
+    valid = recDur > 0
+    # compute the maximum allowed number of spikes per testing bin
+    m = _max_acceptable_cont(fr[valid, np.newaxis], bTest[np.newaxis, :],
+                             recDur[valid, np.newaxis], fr[valid, np.newaxis] * acceptThresh,
+                             thresh)
+    didpass[valid] = np.any(np.less_equal(res[valid], m), axis=1)
+    return _to_cluster_ids(didpass, gidx.ids, cluster_ids, 0)
+
+
 def noise_cutoff(amps, quartile_length=.2, n_bins=100, n_low_bins=2):
     """
     A metric to determine whether a unit's amplitude distribution is cut off
@@ -827,7 +1032,8 @@ def noise_cutoff(amps, quartile_length=.2, n_bins=100, n_low_bins=2):
     return cutoff
 
 
-def spike_sorting_metrics(times, clusters, amps, depths, cluster_ids=None, params=METRICS_PARAMS):
+def spike_sorting_metrics(times, clusters, amps, depths, cluster_ids=None, params=METRICS_PARAMS,
+                          nprocesses=1):
     """
     Computes:
     -   cell level metrics (cf quick_unit_metrics)
@@ -841,12 +1047,14 @@ def spike_sorting_metrics(times, clusters, amps, depths, cluster_ids=None, param
      the unique set of clusters represented in spike clusters)
     :param params: dict (optional) parameters for qc computation (
      see constant at the top of the module for default values and keys)
+    :param nprocesses: (optional) number of processes for the per-cluster metrics computation
     :return: data_frame of metrics (cluster records, columns are qc attributes)|
     :return: dictionary of recording qc (keys 'time_scale' and 'drift_um')
     """
     # compute metrics and convert to `DataFrame`
     df_units = quick_unit_metrics(
-        clusters, times, amps, depths, cluster_ids=cluster_ids, params=params)
+        clusters, times, amps, depths, cluster_ids=cluster_ids, params=params,
+        nprocesses=nprocesses)
     df_units = pd.DataFrame(df_units)
     # compute drift as a function of time and put in a dictionary
     drift, ts = electrode_drift.estimate_drift(times, amps, depths)
@@ -854,8 +1062,39 @@ def spike_sorting_metrics(times, clusters, amps, depths, cluster_ids=None, param
     return df_units, rec_qc
 
 
+def _cluster_metrics(amps, depths, first, last, tmin, tmax, params):
+    """
+    Computes the amplitude and depth metrics of `quick_unit_metrics` for a batch of clusters
+    whose spikes are grouped contiguously: the spikes of the i-th cluster are
+    amps[first[i]:last[i]]
+    :return: dictionary of metrics, each a vector (nclusters,)
+    """
+    keys = ['noise_cutoff', 'missed_spikes_est', 'drift']
+    r = {k: np.full((first.size,), np.nan) for k in keys}
+    for ic in np.arange(first.size):
+        if first[ic] == last[ic]:  # if this cluster has no spikes, continue
+            continue
+        # contiguous views of the spikes of the cluster
+        camps = amps[first[ic]:last[ic]]
+        cdepths = depths[first[ic]:last[ic]]
+
+        # compute metrics
+        r['noise_cutoff'][ic] = noise_cutoff(camps,
+                                             quartile_length=params['nc_quartile_length'],
+                                             n_bins=params['nc_bins'],
+                                             n_low_bins=params['nc_n_low_bins'])
+        r['missed_spikes_est'][ic], _, _ = missed_spikes_est(
+            camps, spks_per_bin=params['spks_per_bin_for_missed_spks_est'],
+            sigma=params['std_smoothing_kernel_for_missed_spks_est'],
+            min_num_bins=params['min_num_bins_for_missed_spks_est'])
+
+        # wonder if there is a need to low-cut this
+        r['drift'][ic] = np.sum(np.abs(np.diff(cdepths))) / (tmax - tmin) * 3600
+    return r
+
+
 def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
-                       params=METRICS_PARAMS, cluster_ids=None, tbounds=None):
+                       params=METRICS_PARAMS, cluster_ids=None, tbounds=None, nprocesses=1):
     """
     Computes single unit metrics from only the spike times, amplitudes, and
     depths for a set of units.
@@ -890,6 +1129,8 @@ def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
     with the input arrays.
     tbounds: (optional) list or 2 elements array containing a time-selection to perform the
      metrics computation on.
+    nprocesses: (optional) number of processes used to compute the per-cluster metrics,
+     defaults to 1 (no multiprocessing)
     params : dict (optional)
         Parameters used for computing some of the metrics in the function:
             'presence_window': float
@@ -984,35 +1225,44 @@ def quick_unit_metrics(spike_clusters, spike_times, spike_amps, spike_depths,
     r.amp_median[ir] = np.array(10 ** (camp['log_amps'].median() / 20))
     r.amp_std_dB[ir] = np.array(camp['log_amps'].std())
 
-    # loop over each cluster to compute the rest of the metrics
-    for ic in np.arange(nclust):
-        # slice the spike_times array
-        ispikes = spike_clusters == cluster_ids[ic]
-        if np.all(~ispikes):  # if this cluster has no spikes, continue
-            continue
-        ts = spike_times[ispikes]
-        amps = spike_amps[ispikes]
-        depths = spike_depths[ispikes]
-
-        # compute metrics
-        r.contamination_alt[ic] = contamination_alt(ts, rp=params['refractory_period'])
-        r.contamination[ic], _ = contamination(
-            ts, tmin, tmax, rp=params['refractory_period'], min_isi=params['min_isi'])
-        r.slidingRP_viol[ic] = slidingRP_viol(ts,
-                                              bin_size=params['bin_size'],
-                                              thresh=params['RPslide_thresh'],
-                                              acceptThresh=params['acceptable_contamination'])
-        r.noise_cutoff[ic] = noise_cutoff(amps,
-                                          quartile_length=params['nc_quartile_length'],
-                                          n_bins=params['nc_bins'],
-                                          n_low_bins=params['nc_n_low_bins'])
-        r.missed_spikes_est[ic], _, _ = missed_spikes_est(
-            amps, spks_per_bin=params['spks_per_bin_for_missed_spks_est'],
-            sigma=params['std_smoothing_kernel_for_missed_spks_est'],
-            min_num_bins=params['min_num_bins_for_missed_spks_est'])
-
-        # wonder if there is a need to low-cut this
-        r.drift[ic] = np.sum(np.abs(np.diff(depths))) / (tmax - tmin) * 3600
+    # group the spikes per cluster once
+    iclust = np.argsort(cluster_ids, kind='stable')
+    gidx = group_index(spike_clusters, ids=cluster_ids[iclust])
+    ts, amps, depths = (spike_times[gidx.isort], spike_amps[gidx.isort],
+                        spike_depths[gidx.isort])
+    nospikes = np.zeros(nclust, dtype=bool)
+    nospikes[iclust] = gidx.first == gidx.last
+
+    # the ISI based metrics are computed for all clusters at once
+    sclusters = spike_clusters[gidx.isort]
+    r.contamination_alt = contamination_alt_clusters(
+        ts, sclusters, rp=params['refractory_period'], cluster_ids=cluster_ids)
+    r.contamination, _ = contamination_clusters(
+        ts, sclusters, tmin, tmax, rp=params['refractory_period'], min_isi=params['min_isi'],
+        cluster_ids=cluster_ids)
+    r.slidingRP_viol = slidingRP_viol_clusters(
+        ts, sclusters, bin_size=params['bin_size'], thresh=params['RPslide_thresh'],
+        acceptThresh=params['acceptable_contamination'], cluster_ids=cluster_ids)
+    r.slidingRP_viol[nospikes] = np.nan
+
+    # batches are contiguous sets of clusters with balanced spike counts
+    nbatches = 1 if nprocesses == 1 else nprocesses * 4
+    ibatches = np.searchsorted(gidx.last, np.linspace(0, ts.size, nbatches + 1)[1:-1])
+    ibatches = np.unique(np.r_[0, ibatches, nclust])
+    args = []
+    for i0, i1 in zip(ibatches[:-1], ibatches[1:]):
+        sl = slice(gidx.first[i0], gidx.last[i1 - 1])
+        args.append((amps[sl], depths[sl], gidx.first[i0:i1] - sl.start,
+                     gidx.last[i0:i1] - sl.start, tmin, tmax, params))
+    # the rest of the metrics is computed by batch of clusters
+    if nprocesses == 1:
+        batches = [_cluster_metrics(*arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(nprocesses) as executor:
+            batches = list(executor.map(_cluster_metrics, *zip(*args)))
+    for i0, i1, batch in zip(ibatches[:-1], ibatches[1:], batches):
+        for k in batch:
+            r[k][iclust[i0:i1]] = batch[k]
 
     r.label = compute_labels(r)
     return r
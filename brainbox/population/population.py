@@ -5,8 +5,10 @@ Code from https://github.com/cortex-lab/phylib/blob/master/phylib/stats/ccg.py b
 Code for decoding by G. Meijer
 '''
 
+import concurrent.futures
 import numpy as np
 import scipy as sp
+import scipy.special
 import types
 from itertools import groupby
 from sklearn.ensemble import RandomForestClassifier
@@ -16,50 +18,7 @@ from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.model_selection import KFold, LeaveOneOut, LeaveOneGroupOut
 from sklearn.metrics import accuracy_score, f1_score, confusion_matrix, roc_auc_score
 from sklearn.utils import shuffle as sklearn_shuffle
-
-
-def _get_spike_counts_in_bins(spike_times, spike_clusters, intervals):
-    """
-    Return the number of spikes in a sequence of time intervals, for each neuron.
-
-    Parameters
-    ----------
-    spike_times : 1D array
-        spike times (in seconds)
-    spike_clusters : 1D array
-        cluster ids corresponding to each event in `spikes`
-    intervals : 2D array of shape (n_events, 2)
-        the start and end times of the events
-
-    Returns
-    ---------
-    counts : 2D array of shape (n_neurons, n_events)
-        the spike counts of all neurons ffrom scipy.stats import sem, tor all events
-        value (i, j) is the number of spikes of neuron `neurons[i]` in interval #j
-    cluster_ids : 1D array
-        list of cluster ids
-    """
-
-    # Check input
-    assert intervals.ndim == 2
-    assert intervals.shape[1] == 2
-    assert np.all(np.diff(spike_times) >= 0), "Spike times need to be sorted"
-
-    intervals_idx = np.searchsorted(spike_times, intervals)
-
-    # For each neuron and each interval, the number of spikes in the interval.
-    cluster_ids = np.unique(spike_clusters)
-    n_neurons = len(cluster_ids)
-    n_intervals = intervals.shape[0]
-    counts = np.zeros((n_neurons, n_intervals), dtype=np.uint32)
-    for j in range(n_intervals):
-        t0, t1 = intervals[j, :]
-        # Count the number of spikes in the window, for each neuron.
-        x = np.bincount(
-            spike_clusters[intervals_idx[j, 0]:intervals_idx[j, 1]],
-            minlength=cluster_ids.max() + 1)
-        counts[:, j] = x[cluster_ids]
-    return counts, cluster_ids
+from brainbox.processing import get_spike_counts_in_bins as _get_spike_counts_in_bins
 
 
 def _index_of(arr, lookup):
@@ -213,10 +172,195 @@ def xcorr(spike_times, spike_clusters, bin_size=None, window_size=None):
     return _symmetrize_correlograms(correlograms)
 
 
+def _decode_splits(pop_vector, cross_validation, num_splits=5, prob_left=None):
+    """
+    Returns the list of (train_index, test_index) cross-validation splits used by `decode`
+    """
+    if cross_validation == 'leave-one-out':
+        cv = LeaveOneOut().split(pop_vector)
+    elif cross_validation == 'kfold':
+        cv = KFold(n_splits=num_splits).split(pop_vector)
+    elif cross_validation == 'kfold-interleaved':
+        cv = KFold(n_splits=num_splits, shuffle=True).split(pop_vector)
+    elif cross_validation == 'block':
+        block_lengths = [sum(1 for i in g) for k, g in groupby(prob_left)]
+        blocks = np.repeat(np.arange(len(block_lengths)), block_lengths)
+        cv = LeaveOneGroupOut().split(pop_vector, groups=blocks)
+    else:
+        cv = cross_validation
+    return list(cv)
+
+
+def _decode_labels(event_groups, seed, shuffle, pseudo_blocks):
+    """
+    Returns the trial labels of a `decode` iteration, drawn as in `_decode_iterations`
+    """
+    np.random.seed(seed)
+    if shuffle is True:
+        event_groups = sklearn_shuffle(event_groups)
+    if pseudo_blocks:
+        event_groups = _generate_pseudo_blocks(event_groups.shape[0])
+    return event_groups
+
+
+def _decode_iterations(pop_vector, event_groups, clf, cross_validation, splits, num_splits,
+                       prob_left, n_neurons, shuffle, phase_rand, pseudo_blocks, seeds):
+    """
+    Runs `decode` iterations, the numpy random generator is seeded before each iteration.
+    :return: predictions, probabilities and trial labels, arrays (n_iterations, n_trials)
+    """
+    pred = np.zeros([seeds.size, pop_vector.shape[0]])
+    prob = np.zeros([seeds.size, pop_vector.shape[0]])
+    labels = []
+    for i, seed in enumerate(seeds):
+        np.random.seed(seed)
+
+        # Pre-allocate variables for this iteration
+        y_true = event_groups
+        y_pred = np.zeros(event_groups.shape)
+        y_probs = np.zeros(event_groups.shape)
+
+        # Get neurons to use for this iteration
+        if n_neurons == 'all':
+            sub_pop_vector = pop_vector
+        else:
+            use_neurons = np.random.choice(pop_vector.shape[1], n_neurons, replace=False)
+            sub_pop_vector = pop_vector[:, use_neurons]
+
+        # Shuffle trail labels if necessary
+        if shuffle is True:
+            y_true = sklearn_shuffle(y_true)
+
+        # Perform phase randomization of activity over trials if necessary
+        if phase_rand is True:
+            original_pop_vector = sub_pop_vector
+            rand_pop_vector = np.empty(original_pop_vector.shape)
+            frequencies = int((original_pop_vector.shape[0] - 1) / 2)
+            fsignal = sp.fft.fft(original_pop_vector, axis=0)
+            power = np.abs(fsignal[1:1 + frequencies])
+            phases = 2 * np.pi * np.random.rand(frequencies)
+            for k in range(original_pop_vector.shape[1]):
+                newfsignal = fsignal[0, k]
+                newfsignal = np.append(newfsignal, np.exp(1j * phases) * power[:, k])
+                newfsignal = np.append(newfsignal, np.flip(np.exp(-1j * phases) * power[:, k]))
+                newsignal = sp.fft.ifft(newfsignal)
+                rand_pop_vector[:, k] = np.abs(newsignal.real)
+            sub_pop_vector = rand_pop_vector
+
+        # Generate pseudo blocks if necessary
+        if pseudo_blocks:
+            y_true = _generate_pseudo_blocks(y_true.shape[0])
+
+        if cross_validation == 'none':
+
+            # Fit the model on all the data and predict
+            clf.fit(sub_pop_vector, y_true)
+            y_pred = clf.predict(sub_pop_vector)
+
+            #  Get the probability of the prediction for ROC analysis
+            probs = clf.predict_proba(sub_pop_vector)
+            y_probs = probs[:, 1]  # keep positive only
+
+        else:
+            # Perform cross-validation
+            cv = splits if splits is not None else _decode_splits(
+                sub_pop_vector, cross_validation, num_splits, prob_left)
+
+            # Loop over the splits into train and test
+            for train_index, test_index in cv:
+
+                # Fit the model to the training data
+                clf.fit(sub_pop_vector[train_index], y_true[train_index])
+
+                # Predict the test data
+                y_pred[test_index] = clf.predict(sub_pop_vector[test_index])
+
+                # Get the probability of the prediction for ROC analysis
+                probs = clf.predict_proba(sub_pop_vector[test_index])
+                y_probs[test_index] = probs[:, 1]  # keep positive only
+
+        # Add prediction, probability and labels to matrix
+        pred[i, :] = y_pred
+        prob[i, :] = y_probs
+        labels.append(y_true)
+    return pred, prob, np.array(labels)
+
+
+def _decode_linear_batched(pop_vector, labels, classifier, splits=None):
+    """
+    Fits and predicts the linear classifiers of `decode` for all iterations at once, when only
+    the trial labels differ between iterations (shuffles and pseudo-blocks). The fit of each
+    split is a single batched linear algebra problem over iterations, equivalent to:
+        'bayes-multinomial': sklearn MultinomialNB with default parameters
+        'lda': sklearn LinearDiscriminantAnalysis with default parameters (svd solver)
+    :param pop_vector: spike counts (n_trials, n_neurons)
+    :param labels: trial labels of each iteration (n_iterations, n_trials)
+    :param classifier: 'bayes-multinomial' or 'lda'
+    :param splits: list of (train_index, test_index), None to fit and predict all trials
+    :return: predictions, probabilities of the second class (n_iterations, n_trials). A class
+     missing from a training set has a null prior and is never predicted.
+    """
+    X = pop_vector.astype(np.float64)
+    classes = np.unique(labels)
+    n_iter, n_trials = labels.shape
+    pred = np.zeros((n_iter, n_trials))
+    prob = np.zeros((n_iter, n_trials))
+    splits = splits if splits is not None else [(np.arange(n_trials), np.arange(n_trials))]
+    for train_index, test_index in splits:
+        Xtrain, Xtest = (X[train_index], X[test_index])
+        n_train = train_index.size
+        # one-hot encoded labels (n_iterations, n_train, n_classes) and class counts
+        Y = (labels[:, train_index, np.newaxis] == classes).astype(np.float64)
+        class_count = Y.sum(axis=1)
+        if classifier == 'bayes-multinomial':
+            smoothed_fc = Y.transpose(0, 2, 1) @ Xtrain + 1.0  # alpha = 1
+            feature_log_prob = np.log(smoothed_fc) - np.log(smoothed_fc.sum(axis=2))[..., None]
+            with np.errstate(divide='ignore'):
+                class_log_prior = np.log(class_count) - np.log(n_train)
+            jll = Xtest @ feature_log_prob.transpose(0, 2, 1) + class_log_prior[:, None, :]
+            log_prob = jll - sp.special.logsumexp(jll, axis=2)[..., None]
+            y_prob = np.exp(log_prob)
+            ipred = np.argmax(jll, axis=2)
+        elif classifier == 'lda':
+            n_classes = np.sum(class_count > 0, axis=1)
+            priors = class_count / n_train
+            means = Y.transpose(0, 2, 1) @ Xtrain / np.maximum(class_count, 1)[..., None]
+            xbar = (priors[:, None, :] @ means)[:, 0, :]
+            # within class scaling and svd of the centered data, batched over iterations
+            Xc = Xtrain - Y @ means
+            std = np.std(Xc, axis=1)
+            std[std == 0] = 1.0
+            Xc = np.sqrt(1.0 / (n_train - n_classes))[:, None, None] * (Xc / std[:, None, :])
+            _, S, Vt = np.linalg.svd(Xc, full_matrices=False)
+            # scaling of within covariance is V' 1/S, ignoring singular values below tolerance
+            keep = S > 1e-4
+            scalings = (Vt / std[:, None, :]).transpose(0, 2, 1) * (keep / np.where(keep, S, 1))[
+                :, None, :]
+            # the class centers are in the span of the between class projection, that is then
+            # the identity for the coefficients
+            dmeans = means - xbar[:, None, :]
+            proj = dmeans @ scalings
+            coef = proj @ scalings.transpose(0, 2, 1)
+            with np.errstate(divide='ignore'):
+                intercept = -0.5 * np.sum(proj ** 2, axis=2) + np.log(priors)
+            intercept -= (coef @ xbar[..., None])[..., 0]
+            decision = Xtest @ coef.transpose(0, 2, 1) + intercept[:, None, :]
+            if classes.size == 2:
+                d = decision[..., 1] - decision[..., 0]
+                y_prob = np.stack([1 - sp.special.expit(d), sp.special.expit(d)], axis=2)
+                ipred = (d > 0).astype(int)
+            else:
+                y_prob = sp.special.softmax(decision, axis=2)
+                ipred = np.argmax(decision, axis=2)
+        pred[:, test_index] = classes[ipred]
+        prob[:, test_index] = y_prob[..., 1]
+    return pred, prob
+
+
 def decode(spike_times, spike_clusters, event_times, event_groups, pre_time=0, post_time=0.5,
            classifier='bayes-multinomial', cross_validation='kfold', num_splits=5, prob_left=None,
            custom_validation=None, n_neurons='all', iterations=1, shuffle=False, phase_rand=False,
-           pseudo_blocks=False):
+           pseudo_blocks=False, seed=None, nprocesses=1):
     """
     Use decoding to classify groups of trials (e.g. stim left/right). Classification is done using
     the population vector of summed spike counts from the specified time window. Cross-validation
@@ -286,6 +430,13 @@ def decode(spike_times, spike_clusters, event_times, event_groups, pre_time=0, p
     pseudo_blocks : boolean
         whether to generate pseudo blocks with the same statistics as the actual blocks
         to estimate chance level
+    seed : int
+        seed of the random generator drawing one seed per iteration, for reproducible
+        iterations (default None uses the global numpy random state)
+    nprocesses : int
+        number of processes running the iterations (default 1). Iterations of the
+        'lda' and 'bayes-multinomial' classifiers that only differ by the shuffled or pseudo
+        block labels are instead fitted all at once as batched linear algebra
 
     Returns
     -------
@@ -341,103 +492,53 @@ def decode(spike_times, spike_clusters, event_times, event_groups, pre_time=0, p
     else:
         clf = classifier
 
-    # Pre-allocate variables
+    # Cross-validation splits are drawn once, except for the interleaved k-fold which is random
+    if cross_validation in ['none', 'kfold-interleaved']:
+        splits = None
+    else:
+        splits = _decode_splits(pop_vector, cross_validation, num_splits, prob_left)
+
+    # Deterministic seed for each iteration, independent of the number of processes
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    seeds = rng.randint(0, 2 ** 31, iterations)
+
+    # The linear classifiers are fitted on all iterations at once when only the labels change
+    batched = (type(classifier) == str and classifier in ['lda', 'bayes-multinomial']
+               and n_neurons == 'all' and not phase_rand and (shuffle or pseudo_blocks)
+               and cross_validation != 'kfold-interleaved')
+    kwargs = dict(pop_vector=pop_vector, event_groups=event_groups, clf=clf,
+                  cross_validation=cross_validation if type(cross_validation) == str else 'custom',
+                  splits=splits, num_splits=num_splits,
+                  prob_left=prob_left, n_neurons=n_neurons, shuffle=shuffle,
+                  phase_rand=phase_rand, pseudo_blocks=pseudo_blocks)
+    if batched:
+        labels = np.stack([_decode_labels(event_groups, sd, shuffle, pseudo_blocks)
+                           for sd in seeds])
+        pred, prob = _decode_linear_batched(pop_vector, labels, classifier, splits)
+    elif nprocesses == 1:
+        pred, prob, labels = _decode_iterations(seeds=seeds, **kwargs)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(nprocesses) as executor:
+            futures = [executor.submit(_decode_iterations, seeds=sds, **kwargs)
+                       for sds in np.array_split(seeds, nprocesses) if sds.size]
+            pred, prob, labels = [np.concatenate(out) for out in
+                                  zip(*[future.result() for future in futures])]
+
+    # Calculate performance metrics and confusion matrix of each iteration
     acc = np.zeros(iterations)
     f1 = np.zeros(iterations)
     auroc = np.zeros(iterations)
     conf_matrix_norm = np.zeros((np.shape(np.unique(event_groups))[0],
                                  np.shape(np.unique(event_groups))[0],
                                  iterations))
-    pred = np.zeros([iterations, pop_vector.shape[0]])
-    prob = np.zeros([iterations, pop_vector.shape[0]])
-
     for i in range(iterations):
-
-        # Pre-allocate variables for this iteration
-        y_pred = np.zeros(event_groups.shape)
-        y_probs = np.zeros(event_groups.shape)
-
-        # Get neurons to use for this iteration
-        if n_neurons == 'all':
-            sub_pop_vector = pop_vector
-        else:
-            use_neurons = np.random.choice(pop_vector.shape[1], n_neurons, replace=False)
-            sub_pop_vector = pop_vector[:, use_neurons]
-
-        # Shuffle trail labels if necessary
-        if shuffle is True:
-            event_groups = sklearn_shuffle(event_groups)
-
-        # Perform phase randomization of activity over trials if necessary
-        if phase_rand is True:
-            if i == 0:
-                original_pop_vector = sub_pop_vector
-            rand_pop_vector = np.empty(original_pop_vector.shape)
-            frequencies = int((original_pop_vector.shape[0] - 1) / 2)
-            fsignal = sp.fft.fft(original_pop_vector, axis=0)
-            power = np.abs(fsignal[1:1 + frequencies])
-            phases = 2 * np.pi * np.random.rand(frequencies)
-            for k in range(original_pop_vector.shape[1]):
-                newfsignal = fsignal[0, k]
-                newfsignal = np.append(newfsignal, np.exp(1j * phases) * power[:, k])
-                newfsignal = np.append(newfsignal, np.flip(np.exp(-1j * phases) * power[:, k]))
-                newsignal = sp.fft.ifft(newfsignal)
-                rand_pop_vector[:, k] = np.abs(newsignal.real)
-            sub_pop_vector = rand_pop_vector
-
-        # Generate pseudo blocks if necessary
-        if pseudo_blocks:
-            event_groups = _generate_pseudo_blocks(event_groups.shape[0])
-
-        if cross_validation == 'none':
-
-            # Fit the model on all the data and predict
-            clf.fit(sub_pop_vector, event_groups)
-            y_pred = clf.predict(sub_pop_vector)
-
-            #  Get the probability of the prediction for ROC analysis
-            probs = clf.predict_proba(sub_pop_vector)
-            y_probs = probs[:, 1]  # keep positive only
-
-        else:
-            # Perform cross-validation
-            if cross_validation == 'leave-one-out':
-                cv = LeaveOneOut().split(sub_pop_vector)
-            elif cross_validation == 'kfold':
-                cv = KFold(n_splits=num_splits).split(sub_pop_vector)
-            elif cross_validation == 'kfold-interleaved':
-                cv = KFold(n_splits=num_splits, shuffle=True).split(sub_pop_vector)
-            elif cross_validation == 'block':
-                block_lengths = [sum(1 for i in g) for k, g in groupby(prob_left)]
-                blocks = np.repeat(np.arange(len(block_lengths)), block_lengths)
-                cv = LeaveOneGroupOut().split(sub_pop_vector, groups=blocks)
-            elif cross_validation == 'custom':
-                cv = cross_validation
-
-            # Loop over the splits into train and test
-            for train_index, test_index in cv:
-
-                # Fit the model to the training data
-                clf.fit(sub_pop_vector[train_index], event_groups[train_index])
-
-                # Predict the test data
-                y_pred[test_index] = clf.predict(sub_pop_vector[test_index])
-
-                # Get the probability of the prediction for ROC analysis
-                probs = clf.predict_proba(sub_pop_vector[test_index])
-                y_probs[test_index] = probs[:, 1]  # keep positive only
-
-        # Calculate performance metrics and confusion matrix
-        acc[i] = accuracy_score(event_groups, y_pred)
-        f1[i] = f1_score(event_groups, y_pred)
-        auroc[i] = roc_auc_score(event_groups[~np.isnan(y_probs)], y_probs[~np.isnan(y_probs)])
-        conf_matrix = confusion_matrix(event_groups, y_pred)
+        y_true, y_pred, y_probs = (labels[i], pred[i], prob[i])
+        acc[i] = accuracy_score(y_true, y_pred)
+        f1[i] = f1_score(y_true, y_pred)
+        auroc[i] = roc_auc_score(y_true[~np.isnan(y_probs)], y_probs[~np.isnan(y_probs)])
+        conf_matrix = confusion_matrix(y_true, y_pred)
         conf_matrix_norm[:, :, i] = conf_matrix / conf_matrix.sum(axis=1)[:, np.newaxis]
 
-        # Add prediction and probability to matrix
-        pred[i, :] = y_pred
-        prob[i, :] = y_probs
-
     # Make integers from arrays when there's only one iteration
     if iterations == 1:
         acc = acc[0]
@@ -204,6 +204,115 @@ def bin_spikes(spikes, binsize, interval_indices=False):
         return core.TimeSeries(times=tbins, values=rates.T, columns=clusters)
 
 
+def group_index(values, ids=None):
+    """
+    Computes an index to access the elements of a vector by groups of identical values, for
+    example the spikes of each cluster. This costs a single stable sort, as opposed to comparing
+    the full vector with each group label.
+
+    :param values: vector of group labels (for example spike clusters)
+    :param ids: (optional) labels of the groups to index, defaults to the unique values. Labels
+     absent from `values` yield empty groups.
+    :return: Bunch with keys:
+        'isort': stable argsort of `values`, the original order is kept within each group
+        'ids': labels of the groups (ngroups,)
+        'first', 'last': offsets of the groups in the sorted vector (ngroups,), such that
+         values[isort][first[i]:last[i]] are all equal to ids[i]
+    """
+    values = np.asarray(values)
+    isort = np.argsort(values, kind='stable')
+    svalues = values[isort]
+    ids = np.unique(values) if ids is None else np.asarray(ids)
+    first = np.searchsorted(svalues, ids, side='left')
+    last = np.searchsorted(svalues, ids, side='right')
+    return core.Bunch({'isort': isort, 'ids': ids, 'first': first, 'last': last})
+
+
+def group_views(index, array):
+    """
+    Splits an array per group according to a group index. The array is re-ordered once, each
+    group is then a contiguous view of the re-ordered array.
+
+    >>> gidx = group_index(spikes.clusters)
+    >>> for cid, ts in zip(gidx.ids, group_views(gidx, spikes.times)):
+    >>>     print(cid, ts.size)
+
+    :param index: Bunch output of `group_index`
+    :param array: array to split, with the same size as the group labels vector along axis 0
+    :return: list of views of the array, one per group
+    """
+    sarray = np.asarray(array)[index.isort]
+    return [sarray[first:last] for first, last in zip(index.first, index.last)]
+
+
+def spike_counts_index(spike_times, spike_clusters):
+    """
+    Precomputes the index used by `get_spike_counts_in_bins`, so that it can be reused across
+    repeated calls on the same spike train.
+
+    :param spike_times: 1D array of spike times (in seconds)
+    :param spike_clusters: 1D array of cluster ids corresponding to each spike
+    :return: Bunch with keys:
+        'times': spike times, sorted
+        'iclusters': index in 'cluster_ids' of the cluster of each sorted spike
+        'cluster_ids': unique cluster ids
+    """
+    spike_times = np.asarray(spike_times)
+    isort = None if np.all(np.diff(spike_times) >= 0) else np.argsort(spike_times, kind='stable')
+    if isort is not None:
+        spike_times, spike_clusters = (spike_times[isort], np.asarray(spike_clusters)[isort])
+    cluster_ids, iclusters = np.unique(spike_clusters, return_inverse=True)
+    return core.Bunch({'times': spike_times, 'iclusters': iclusters, 'cluster_ids': cluster_ids})
+
+
+def get_spike_counts_in_bins(spike_times, spike_clusters, intervals, index=None):
+    """
+    Return the number of spikes in a sequence of time intervals, for each neuron. Spikes are
+    counted in [start, end) for each interval.
+
+    All intervals are counted at once: if the intervals contain few spikes, the spikes of all
+    intervals are aggregated with a single bincount, otherwise the interval bounds are searched
+    in the spike times of each cluster.
+
+    :param spike_times: 1D array of spike times (in seconds)
+    :param spike_clusters: 1D array of cluster ids corresponding to each spike
+    :param intervals: 2D array of shape (n_events, 2), the start and end times of the events
+    :param index: (optional) output of `spike_counts_index` for this spike train, to avoid
+     computing it at each call
+    :return: counts: 2D array of shape (n_neurons, n_events) the spike counts of all neurons for
+     all events, value (i, j) is the number of spikes of neuron `cluster_ids[i]` in interval #j
+    :return: cluster_ids: 1D array of the unique cluster ids
+    """
+    # Check input
+    assert intervals.ndim == 2
+    assert intervals.shape[1] == 2
+    if index is None:
+        index = spike_counts_index(spike_times, spike_clusters)
+    n_neurons = index.cluster_ids.size
+    n_intervals = intervals.shape[0]
+
+    intervals_idx = np.searchsorted(index.times, intervals)
+    nspikes = np.maximum(intervals_idx[:, 1] - intervals_idx[:, 0], 0)
+    if np.sum(nspikes) <= 4 * n_neurons * n_intervals:
+        # aggregate the spikes of all intervals, the same spike can belong to several intervals
+        iint = np.repeat(np.arange(n_intervals), nspikes)
+        ispikes = np.arange(np.sum(nspikes)) - np.repeat(np.cumsum(nspikes) - nspikes, nspikes)
+        ispikes += np.repeat(intervals_idx[:, 0], nspikes)
+        counts = np.bincount(index.iclusters[ispikes] * n_intervals + iint,
+                             minlength=n_neurons * n_intervals)
+        counts = counts.reshape(n_neurons, n_intervals)
+    else:
+        # long intervals: difference of the spike ranks of each cluster at the interval bounds
+        if 'gtimes' not in index:
+            gidx = group_index(index.iclusters, ids=np.arange(n_neurons))
+            index.gtimes = group_views(gidx, index.times)
+        counts = np.zeros((n_neurons, n_intervals), dtype=np.int64)
+        for i, times in enumerate(index.gtimes):
+            counts[i, :] = np.diff(np.searchsorted(times, intervals), axis=1)[:, 0]
+        counts = np.maximum(counts, 0)
+    return counts.astype(np.uint32), index.cluster_ids
+
+
 def get_units_bunch(spks_b, *args):
     '''
     Returns a bunch, where the bunch keys are keys from `spks` with labels of spike information
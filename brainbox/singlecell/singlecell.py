@@ -3,10 +3,12 @@ Computes properties of single-cells, e.g. the autocorrelation and firing rate.
 '''
 
 import numpy as np
-from scipy.signal import convolve, gaussian
+from scipy.signal import fftconvolve, gaussian
 from brainbox.core import Bunch
 from brainbox.population import xcorr
 
+PETH_CHUNK_SIZE = 1e7  # maximum number of bins processed at once when binned spikes are skipped
+
 
 def acorr(spike_times, bin_size=None, window_size=None):
     """Compute the auto-correlogram of a neuron.
@@ -31,7 +33,8 @@ def acorr(spike_times, bin_size=None, window_size=None):
 
 def calculate_peths(
         spike_times, spike_clusters, cluster_ids, align_times, pre_time=0.2,
-        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True):
+        post_time=0.5, bin_size=0.025, smoothing=0.025, return_fr=True, return_binned=True,
+        dtype=np.float64):
     """
     Calcluate peri-event time histograms; return means and standard deviations
     for each time point across specified clusters
@@ -55,6 +58,11 @@ def calculate_peths(
     :type smoothing: float
     :param return_fr: `True` to return (estimated) firing rate, `False` to return spike counts
     :type return_fr: bool
+    :param return_binned: `False` to skip the binned spikes output (returns None instead): the
+        events are then processed in chunks and only the means and stds are kept in memory
+    :type return_binned: bool
+    :param dtype: float type of the outputs, use np.float32 to halve the memory footprint
+    :type dtype: numpy dtype
     :return: peths, binned_spikes
     :rtype: peths: Bunch({'mean': peth_means, 'std': peth_stds, 'tscale': ts, 'cscale': ids})
     :rtype: binned_spikes: np.array (n_align_times, n_clusters, n_bins)
@@ -65,7 +73,7 @@ def calculate_peths(
     n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
     n_bins_post = int(np.ceil(post_time / bin_size)) + n_offset
     n_bins = n_bins_pre + n_bins_post
-    binned_spikes = np.zeros(shape=(len(align_times), len(cluster_ids), n_bins))
+    align_times = np.asarray(align_times)
 
     # build gaussian kernel if requested
     if smoothing > 0:
@@ -74,62 +82,76 @@ def calculate_peths(
         # half (causal) gaussian filter
         # window[int(np.ceil(w/2)):] = 0
         window /= np.sum(window)
-        binned_spikes_conv = np.copy(binned_spikes)
+        window = window.astype(dtype)
 
     ids = np.unique(cluster_ids)
+    n_clusters = ids.size
 
-    # filter spikes outside of the loop
+    # filter spikes, then sort them by time and get their cluster row index
     idxs = np.bitwise_and(spike_times >= np.min(align_times) - (n_bins_pre + 1) * bin_size,
                           spike_times <= np.max(align_times) + (n_bins_post + 1) * bin_size)
     idxs = np.bitwise_and(idxs, np.isin(spike_clusters, cluster_ids))
-    spike_times = spike_times[idxs]
-    spike_clusters = spike_clusters[idxs]
+    isort = np.argsort(spike_times[idxs], kind='stable')
+    spike_times = spike_times[idxs][isort]
+    spike_iclusters = np.searchsorted(ids, spike_clusters[idxs][isort])
 
     # compute floating tscale
     tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
-    # bin spikes
-    for i, t_0 in enumerate(align_times):
-        # define bin edges
-        ts = tscale + t_0
-        # filter spikes
-        idxs = np.bitwise_and(spike_times >= ts[0], spike_times <= ts[-1])
-        i_spikes = spike_times[idxs]
-        i_clusters = spike_clusters[idxs]
-
+    # first and last bin edges, and the span of sorted spikes within, for each event
+    edges_first = tscale[0] + align_times
+    edges_last = tscale[-1] + align_times
+    ifirst = np.searchsorted(spike_times, edges_first, side='left')
+    ilast = np.searchsorted(spike_times, edges_last, side='right')
+
+    def _bin_events(iev):
+        """
+        Bins spikes for all events iev at once: counts (n_events, n_clusters, n_bins) and
+        smoothed firing rates or counts (n_events, n_clusters, n_bins)
+        """
+        nspikes = ilast[iev] - ifirst[iev]
+        ev = np.repeat(np.arange(iev.size), nspikes)
+        ispikes = np.arange(np.sum(nspikes)) - np.repeat(np.cumsum(nspikes) - nspikes, nspikes)
+        ispikes += np.repeat(ifirst[iev], nspikes)
         # bin spikes similar to bincount2D: x = spike times, y = spike clusters
-        xscale = ts
-        xind = (np.floor((i_spikes - np.min(ts)) / bin_size)).astype(np.int64)
-        yscale, yind = np.unique(i_clusters, return_inverse=True)
-        nx, ny = [xscale.size, yscale.size]
-        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
-        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
-
-        # store (ts represent bin edges, so there are one fewer bins)
-        bs_idxs = np.isin(ids, yscale)
-        binned_spikes[i, bs_idxs, :] = r[:, :-1]
-
-        # smooth
+        xind = np.floor((spike_times[ispikes] - edges_first[iev][ev]) / bin_size)
+        xind = xind.astype(np.int64)
+        # ts represent bin edges, so the last bin contains spikes on the last edge only
+        ind3d = (ev * n_clusters + spike_iclusters[ispikes]) * (n_bins + 1) + xind
+        r = np.bincount(ind3d, minlength=iev.size * n_clusters * (n_bins + 1))
+        r = r.reshape(iev.size, n_clusters, n_bins + 1).astype(dtype)
+        # smooth all events and clusters at once
         if smoothing > 0:
-            idxs = np.where(bs_idxs)[0]
-            for j in range(r.shape[0]):
-                binned_spikes_conv[i, idxs[j], :] = convolve(
-                    r[j, :], window, mode='same', method='auto')[:-1]
-
-    # average
-    if smoothing > 0:
-        binned_spikes_ = np.copy(binned_spikes_conv)
+            r_ = fftconvolve(r, window[np.newaxis, np.newaxis, :], mode='same', axes=-1)
+            r_[np.sum(r, axis=-1) == 0] = 0
+        else:
+            r_ = np.copy(r)
+        r_ = r_[:, :, :-1]
+        if return_fr:
+            r_ /= bin_size
+        return r[:, :, :-1], r_
+
+    if return_binned:
+        binned_spikes, binned_spikes_ = _bin_events(np.arange(align_times.size))
+        peth_means = np.mean(binned_spikes_, axis=0)
+        peth_stds = np.std(binned_spikes_, axis=0)
     else:
-        binned_spikes_ = np.copy(binned_spikes)
-    if return_fr:
-        binned_spikes_ /= bin_size
-
-    peth_means = np.mean(binned_spikes_, axis=0)
-    peth_stds = np.std(binned_spikes_, axis=0)
+        # process events by chunks and accumulate sums to compute means and stds
+        binned_spikes = None
+        n_chunk = max(1, int(PETH_CHUNK_SIZE // (n_clusters * (n_bins + 1))))
+        s1, s2 = (np.zeros((n_clusters, n_bins)), np.zeros((n_clusters, n_bins)))
+        for i in np.arange(0, align_times.size, n_chunk):
+            _, binned_spikes_ = _bin_events(np.arange(i, min(i + n_chunk, align_times.size)))
+            s1 += np.sum(binned_spikes_, axis=0)
+            s2 += np.sum(binned_spikes_.astype(np.float64) ** 2, axis=0)
+        peth_means = s1 / align_times.size
+        peth_stds = np.sqrt(np.maximum(s2 / align_times.size - peth_means ** 2, 0))
+        peth_means, peth_stds = (peth_means.astype(dtype), peth_stds.astype(dtype))
 
     if smoothing > 0:
         peth_means = peth_means[:, n_offset:-n_offset]
         peth_stds = peth_stds[:, n_offset:-n_offset]
-        binned_spikes = binned_spikes[:, :, n_offset:-n_offset]
+        if binned_spikes is not None:
+            binned_spikes = binned_spikes[:, :, n_offset:-n_offset]
         tscale = tscale[n_offset:-n_offset]
 
     # package output
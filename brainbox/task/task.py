@@ -6,47 +6,8 @@ import numpy as np
 from scipy.stats import ranksums, wilcoxon, ttest_ind, ttest_rel
 from ._statsmodels import multipletests
 from sklearn.metrics import roc_auc_score
-
-
-def _get_spike_counts_in_bins(spike_times, spike_clusters, intervals):
-    """
-    Return the number of spikes in a sequence of time intervals, for each neuron.
-
-    Parameters
-    ----------
-    spike_times : 1D array
-        spike times (in seconds)
-    spike_clusters : 1D array
-        cluster ids corresponding to each event in `spikes`
-    intervals : 2D array of shape (n_events, 2)
-        the start and end times of the events
-
-    Returns
-    ---------
-    counts : 2D array of shape (n_neurons, n_events)
-        the spike counts of all neurons ffrom scipy.stats import sem, tor all events
-        value (i, j) is the number of spikes of neuron `neurons[i]` in interval #j
-    cluster_ids : 1D array
-        list of cluster ids
-    """
-
-    # Check input
-    assert intervals.ndim == 2
-    assert intervals.shape[1] == 2
-
-    # For each neuron and each interval, the number of spikes in the interval.
-    cluster_ids = np.unique(spike_clusters)
-    n_neurons = len(cluster_ids)
-    n_intervals = intervals.shape[0]
-    counts = np.zeros((n_neurons, n_intervals), dtype=np.uint32)
-    for j in range(n_intervals):
-        t0, t1 = intervals[j, :]
-        # Count the number of spikes in the window, for each neuron.
-        x = np.bincount(
-            spike_clusters[(t0 <= spike_times) & (spike_times < t1)],
-            minlength=cluster_ids.max() + 1)
-        counts[:, j] = x[cluster_ids]
-    return counts, cluster_ids
+from brainbox.processing import get_spike_counts_in_bins as _get_spike_counts_in_bins
+from brainbox.processing import spike_counts_index
 
 
 def responsive_units(spike_times, spike_clusters, event_times,
@@ -85,10 +46,12 @@ def responsive_units(spike_times, spike_clusters, event_times,
 
     # Get spike counts for baseline and event timewindow
     baseline_times = np.column_stack(((event_times - pre_time[0]), (event_times - pre_time[1])))
+    index = spike_counts_index(spike_times, spike_clusters)
     baseline_counts, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters,
-                                                             baseline_times)
+                                                             baseline_times, index=index)
     times = np.column_stack(((event_times + post_time[0]), (event_times + post_time[1])))
-    spike_counts, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times)
+    spike_counts, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times,
+                                                          index=index)
 
     # Do statistics
     p_values = np.empty(spike_counts.shape[0])
@@ -158,10 +121,13 @@ def differentiate_units(spike_times, spike_clusters, event_times, event_groups,
     # Get spike counts for the two events
     times_1 = np.column_stack(((event_times[event_groups == 0] - pre_time),
                                (event_times[event_groups == 0] + post_time)))
-    counts_1, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times_1)
+    index = spike_counts_index(spike_times, spike_clusters)
+    counts_1, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times_1,
+                                                      index=index)
     times_2 = np.column_stack(((event_times[event_groups == 1] - pre_time),
                                (event_times[event_groups == 1] + post_time)))
-    counts_2, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times_2)
+    counts_2, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times_2,
+                                                      index=index)
 
     # Do statistics
     p_values = np.empty(len(cluster_ids))
@@ -219,10 +185,12 @@ def roc_single_event(spike_times, spike_clusters, event_times,
 
     # Get spike counts for baseline and event timewindow
     baseline_times = np.column_stack(((event_times - pre_time[0]), (event_times - pre_time[1])))
+    index = spike_counts_index(spike_times, spike_clusters)
     baseline_counts, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters,
-                                                             baseline_times)
+                                                             baseline_times, index=index)
     times = np.column_stack(((event_times + post_time[0]), (event_times + post_time[1])))
-    spike_counts, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times)
+    spike_counts, cluster_ids = _get_spike_counts_in_bins(spike_times, spike_clusters, times,
+                                                          index=index)
 
     # Calculate area under the ROC curve per neuron
     auc_roc = np.empty(spike_counts.shape[0])
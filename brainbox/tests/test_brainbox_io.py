@@ -3,6 +3,7 @@ from pathlib import Path
 import tempfile
 import json
 import shutil
+from unittest import mock
 
 import numpy as np
 from brainbox.io import one as bbone
@@ -56,6 +57,26 @@ class TestIO_ALF(unittest.TestCase):
         self.assertTrue(list(spikes.keys()) == self.probes)
         self.assertTrue(list(clusters.keys()) == self.probes)
 
+    def test_load_spike_sorting_bulk(self):
+        eids = ['eid_0', 'eid_1']
+        fake_one = mock.MagicMock()
+        fake_one.alyx.rest.side_effect = \
+            lambda *args, **kwargs: [{'name': p} for p in self.probes]
+        fake_one.path_from_eid.side_effect = \
+            lambda eid: self.session_path if eid == 'eid_0' else None
+        out = list(bbone.load_spike_sorting_bulk(eids, one=fake_one, nthreads=2))
+        self.assertEqual(sorted(o[1] for o in out), self.probes)
+        self.assertTrue(all(o[0] == 'eid_0' for o in out))
+        self.assertTrue(all(o[2].times.size in (10000, 10001) for o in out))
+        # clusters.depths is missing locally so the session datasets are downloaded once
+        fake_one.load.assert_called_once()
+        # nothing is downloaded when all the files exist
+        with mock.patch.object(bbone, 'SPIKE_SORTING_DTYPES', ['spikes.times']):
+            fake_one.load.reset_mock()
+            out = list(bbone.load_spike_sorting_bulk(eids[:1], one=fake_one))
+            fake_one.load.assert_not_called()
+            self.assertEqual(len(out), 2)
+
     def tearDown(self) -> None:
         shutil.rmtree(self.tmpdir)
 
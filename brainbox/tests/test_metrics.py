@@ -1,4 +1,5 @@
 import numpy as np
+from brainbox import metrics
 from brainbox.metrics import quick_unit_metrics, electrode_drift
 from brainbox.numerical import ismember
 
@@ -66,6 +67,39 @@ def test_clusters_metrics():
     dfm = quick_unit_metrics(c, t, a, d, cluster_ids=np.arange(5), tbounds=[100, 900])
     idf, _ = ismember(np.arange(5), cid)
     _assertions(dfm, idf, np.arange(5))
+    # the multiprocessing computation yields the same output for unsorted cluster ids
+    cids = np.array([4, 2, 1, 3, 0])
+    dfm = quick_unit_metrics(c, t, a, d, cluster_ids=cids, tbounds=[100, 900])
+    dfm_ = quick_unit_metrics(c, t, a, d, cluster_ids=cids, tbounds=[100, 900], nprocesses=2)
+    assert all(np.array_equal(dfm[k], dfm_[k], equal_nan=True) for k in dfm)
+    idf, _ = ismember(cids, cid)
+    assert np.all(np.isnan(dfm['drift'][~idf]))
+
+
+def test_batched_isi_metrics():
+    np.random.seed(42)
+    # spike trains with a 2ms refractory period and a few violations added
+    t, c = (np.empty(0), np.empty(0, dtype=np.int32))
+    for i, fr in enumerate([0.1, 2, 5, 20, 50]):
+        ts = np.cumsum(0.002 + np.random.exponential(1 / fr, int(fr * 400)))
+        ts = np.r_[ts, ts[:i * 5] + 0.0005, ts[:i * 2] + 0.00005]
+        t, c = (np.r_[t, ts], np.r_[c, np.zeros(ts.size, dtype=np.int32) + i * 2])
+    ordre = np.argsort(t)
+    t, c = (t[ordre], c[ordre])
+    cids = np.array([8, 5, 6, 4, 2, 0])  # cluster 5 has no spike
+    rp_viol = metrics.slidingRP_viol_clusters(t, c, cluster_ids=cids)
+    ce_alt = metrics.contamination_alt_clusters(t, c, rp=0.0015, cluster_ids=cids)
+    ce, nviol = metrics.contamination_clusters(t, c, t[0], t[-1], rp=0.0015, cluster_ids=cids)
+    assert rp_viol[1] == 0 and np.isnan(ce_alt[1]) and np.isnan(ce[1]) and np.isnan(nviol[1])
+    for i, cid in enumerate(cids):
+        ts = t[c == cid]
+        if ts.size == 0:
+            continue
+        assert rp_viol[i] == metrics.slidingRP_viol(ts)
+        assert np.isclose(ce_alt[i], metrics.contamination_alt(ts, rp=0.0015))
+        assert np.all(np.array([ce[i], nviol[i]]) ==
+                      metrics.contamination(ts, t[0], t[-1], rp=0.0015))
+    assert np.any(rp_viol == 1) and np.any(rp_viol[cids != 5] == 0)
 
 
 def test_drift_estimate():
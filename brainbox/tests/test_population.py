@@ -1,6 +1,8 @@
-from brainbox.population import xcorr
+from brainbox.population import xcorr, decode
 import unittest
 import numpy as np
+from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.naive_bayes import MultinomialNB
 
 
 def _random_data(max_cluster):
@@ -56,6 +58,42 @@ class TestPopulation(unittest.TestCase):
 
         self.assertEqual(c.shape, (max_cluster, max_cluster, 51))
 
+    def test_decode_shuffles(self):
+        np.random.seed(0)
+        spike_times, spike_clusters = _random_data(20)
+        event_times = np.sort(np.random.rand(60) * spike_times[-1] * 0.9)
+        event_groups = np.random.randint(0, 2, 60)
+        kwargs = dict(iterations=6, shuffle=True, seed=42)
+        # the batched linear fit of the shuffles matches the sklearn classifier
+        res = decode(spike_times, spike_clusters, event_times, event_groups, **kwargs)
+        res_ = decode(spike_times, spike_clusters, event_times, event_groups,
+                      classifier=MultinomialNB(), **kwargs)
+        self.assertTrue(np.all(res['predictions'] == res_['predictions']))
+        self.assertTrue(np.allclose(res['probabilities'], res_['probabilities']))
+        self.assertTrue(np.allclose(res['accuracy'], res_['accuracy']))
+        # the iterations are reproducible whatever the number of processes
+        res_ = decode(spike_times, spike_clusters, event_times, event_groups,
+                      classifier=MultinomialNB(), nprocesses=2, **kwargs)
+        self.assertTrue(np.all(res['predictions'] == res_['predictions']))
+        self.assertEqual(res['accuracy'].size, 6)
+
+    def test_decode_lda(self):
+        np.random.seed(0)
+        spike_times, spike_clusters = _random_data(20)
+        event_times = np.sort(np.random.rand(60) * spike_times[-1] * 0.9)
+        event_groups = np.random.randint(0, 2, 60)
+        # the batched linear discriminant analysis matches the sklearn classifier
+        for cross_validation in ['kfold', 'leave-one-out', 'none']:
+            kwargs = dict(iterations=6, shuffle=True, seed=42, cross_validation=cross_validation)
+            res = decode(spike_times, spike_clusters, event_times, event_groups,
+                         classifier='lda', **kwargs)
+            res_ = decode(spike_times, spike_clusters, event_times, event_groups,
+                          classifier=LinearDiscriminantAnalysis(), **kwargs)
+            self.assertTrue(np.all(res['predictions'] == res_['predictions']))
+            self.assertTrue(np.allclose(res['probabilities'], res_['probabilities'],
+                                        rtol=0, atol=1e-14))
+            self.assertTrue(np.all(res['accuracy'] == res_['accuracy']))
+
 
 if __name__ == "__main__":
     np.random.seed(0)
@@ -98,6 +98,41 @@ class TestProcessing(unittest.TestCase):
         self.assertTrue(np.all(yscale == np.arange(3) + 10))
         self.assertTrue(np.all(r.shape == (3, 5)))
 
+    def test_group_index(self):
+        clusters = np.array([3, 1, 3, 0, 1, 3, 7])
+        times = np.arange(clusters.size) * 0.1
+        gidx = processing.group_index(clusters, ids=np.array([0, 1, 2, 3, 7]))
+        views = processing.group_views(gidx, times)
+        for cid, ts in zip(gidx.ids, views):
+            # each group keeps the original order and cluster 2 is empty
+            self.assertTrue(np.all(ts == times[clusters == cid]))
+        self.assertEqual(views[2].size, 0)
+        # default ids are the unique values and the views share memory
+        gidx = processing.group_index(clusters)
+        self.assertTrue(np.all(gidx.ids == np.array([0, 1, 3, 7])))
+        views = processing.group_views(gidx, times)
+        self.assertTrue(views[0].base is views[-1].base)
+
+    def test_get_spike_counts_in_bins(self):
+        np.random.seed(0)
+        spike_times = np.sort(np.random.rand(5000) * 100)
+        spike_clusters = np.random.randint(0, 10, 5000) * 2
+        index = processing.spike_counts_index(spike_times, spike_clusters)
+        event_times = np.sort(np.random.rand(20) * 100)
+        # short intervals are aggregated, long intervals are searched per cluster
+        for pre, post in [(0.2, 0.5), (30, 40)]:
+            intervals = np.c_[event_times - pre, event_times + post]
+            counts, cluster_ids = processing.get_spike_counts_in_bins(
+                spike_times, spike_clusters, intervals)
+            self.assertTrue(np.all(cluster_ids == np.arange(10) * 2))
+            for j, (t0, t1) in enumerate(intervals):
+                in_bin = np.logical_and(t0 <= spike_times, spike_times < t1)
+                expected = np.bincount(spike_clusters[in_bin], minlength=20)[cluster_ids]
+                self.assertTrue(np.all(counts[:, j] == expected))
+            counts_, _ = processing.get_spike_counts_in_bins(
+                spike_times, spike_clusters, intervals, index=index)
+            self.assertTrue(np.all(counts == counts_))
+
 
 def test_get_unit_bunches():
     pass
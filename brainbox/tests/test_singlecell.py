@@ -1,6 +1,7 @@
 from brainbox.singlecell import acorr, calculate_peths
 import unittest
 import numpy as np
+from scipy.signal import gaussian
 
 
 class TestPopulation(unittest.TestCase):
@@ -48,6 +49,50 @@ class TestPeths(unittest.TestCase):
         self.assertTrue(np.all(fr.shape == (n_events, len(cluster_sel), 28)))
         self.assertTrue(peth.tscale.size == 28)
 
+    def test_peths_vectorized(self):
+        np.random.seed(seed=42)
+        spike_times = np.random.rand(5000, ) * 300
+        spike_clusters = np.random.randint(0, 10, 5000)
+        event_times = np.sort(np.random.rand(50, ) * 300)
+        event_times[1] = event_times[0]  # overlapping events share spikes
+        cluster_sel = [8, 2, 3]
+        peth, binned = calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel,
+                                       align_times=event_times, smoothing=0, return_fr=False)
+        # reference counts computed event by event and cluster by cluster, same bin edges
+        tscale = np.arange(-8, 21) * 0.025
+        for i, t0 in enumerate(event_times):
+            for j, c in enumerate(np.unique(cluster_sel)):
+                counts, _ = np.histogram(spike_times[spike_clusters == c], bins=tscale + t0)
+                self.assertTrue(np.array_equal(binned[i, j, :], counts))
+        self.assertTrue(np.array_equal(peth.means, np.mean(binned, axis=0)))
+        self.assertTrue(np.allclose(peth.tscale, (tscale[:-1] + tscale[1:]) / 2))
+        # the smoothed firing rates match a direct convolution of the reference counts
+        peth, binned = calculate_peths(spike_times, spike_clusters, cluster_ids=cluster_sel,
+                                       align_times=event_times, smoothing=0.025)
+        tscale = np.arange(-13, 26) * 0.025  # 5 bins of margin on each side for smoothing
+        window = gaussian(37, std=1)
+        window /= np.sum(window)
+        rates = np.zeros((event_times.size, len(cluster_sel), tscale.size - 1))
+        for i, t0 in enumerate(event_times):
+            for j, c in enumerate(np.unique(cluster_sel)):
+                counts, _ = np.histogram(spike_times[spike_clusters == c], bins=tscale + t0)
+                self.assertTrue(np.array_equal(binned[i, j, :], counts[5:-5]))
+                rates[i, j, :] = np.convolve(np.r_[counts, 0], window, mode='same')[:-1] / 0.025
+        self.assertTrue(np.allclose(peth.means, np.mean(rates, axis=0)[:, 5:-5]))
+        self.assertTrue(np.allclose(peth.stds, np.std(rates, axis=0)[:, 5:-5]))
+        self.assertTrue(np.allclose(peth.tscale, (tscale[5:-6] + tscale[6:-5]) / 2))
+        # the low-memory single precision output matches the default output
+        for smoothing in [0, 0.025]:
+            peth, _ = calculate_peths(spike_times, spike_clusters, cluster_sel, event_times,
+                                      smoothing=smoothing)
+            peth32, binned32 = calculate_peths(spike_times, spike_clusters, cluster_sel,
+                                               event_times, smoothing=smoothing,
+                                               return_binned=False, dtype=np.float32)
+            self.assertIsNone(binned32)
+            self.assertEqual(peth32.means.dtype, np.float32)
+            self.assertTrue(np.allclose(peth32.means, peth.means, atol=1e-3))
+            self.assertTrue(np.allclose(peth32.stds, peth.stds, atol=1e-3))
+
 
 def test_firing_rate():
     pass
@@ -1,7 +1,9 @@
 from dataclasses import dataclass
 import logging
 import matplotlib.pyplot as plt
+import os
 from pathlib import Path
+import threading
 
 import numpy as np
 import nrrd
@@ -13,6 +15,10 @@ from oneibl.webclient import http_download_file
 
 _logger = logging.getLogger('ibllib')
 ALLEN_CCF_LANDMARKS_MLAPDV_UM = {'bregma': np.array([5739, 5400, 332])}
+# derived volumes and surfaces, in volume indices, saved in the memory-mapped atlas cache
+ATLAS_CACHE_ARRAYS = ('image', 'label', 'top', 'bottom', 'surface', 'srf_ixyz')
+_SHARED_ATLASES = {}
+_SHARED_ATLASES_LOCK = threading.Lock()
 
 
 def cart2sph(x, y, z):
@@ -175,7 +181,7 @@ class BrainAtlas:
     yet this class can be used for other atlases arises.
     """
     def __init__(self, image, label, dxyz, regions, iorigin=[0, 0, 0],
-                 dims2xyz=[0, 1, 2], xyz2dims=[0, 1, 2]):
+                 dims2xyz=[0, 1, 2], xyz2dims=[0, 1, 2], surfaces=None):
         """
         self.image: image volume (ap, ml, dv)
         self.label: label volume (ap, ml, dv)
@@ -183,37 +189,54 @@ class BrainAtlas:
         self.regions: atlas.BrainRegions object
         self.top: 2d np array (ap, ml) containing the z-coordinate (m) of the surface of the brain
         self.dims2xyz and self.zyz2dims: map image axis order to xyz coordinates order
+        :param surfaces: optional dictionary of precomputed surfaces in volume indices, as output
+         by compute_surfaces(). If not provided they are computed from the label volume
         """
         self.image = image
         self.label = label
         self.regions = regions
         self.dims2xyz = dims2xyz
         self.xyz2dims = xyz2dims
+        self._index_grids = {}  # index grids of the tilted slices per (axis, shape, step)
         assert(np.all(self.dims2xyz[self.xyz2dims] == np.array([0, 1, 2])))
         assert(np.all(self.xyz2dims[self.dims2xyz] == np.array([0, 1, 2])))
         # create the coordinate transform object that maps volume indices to real world coordinates
         nxyz = np.array(self.image.shape)[self.dims2xyz]
         bc = BrainCoordinates(nxyz=nxyz, xyz0=(0, 0, 0), dxyz=dxyz)
         self.bc = BrainCoordinates(nxyz=nxyz, xyz0=- bc.i2xyz(iorigin), dxyz=dxyz)
+        # the surfaces are in volume indices so that they don't depend on the scaling
+        surfaces = surfaces or self.compute_surfaces(self.label, self.xyz2dims)
+        self.top = self.bc.i2z(surfaces['top'])
+        self.bottom = self.bc.i2z(surfaces['bottom'])
+        self.surface = surfaces['surface']
+        self.srf_xyz = self.bc.i2xyz(surfaces['srf_ixyz'].astype(np.float))
 
+    @staticmethod
+    def compute_surfaces(label, xyz2dims):
         """
         Get the volume top, bottom, left and right surfaces, and from these the outer surface of
         the image volume. This is needed to compute probe insertions intersections
+        :param label: label volume
+        :param xyz2dims: map xyz coordinates order to volume axis order
+        :return: dictionary with keys
+            top: 2d array of the dv index of the brain top surface (nan outside of the brain)
+            bottom: 2d array of the dv index of the brain bottom surface (nan outside)
+            surface: int8 volume set to 1 on the outer surface of the brain
+            srf_ixyz: [n, 3] array of the ml, ap, dv indices of the outer surface voxels
         """
-        axz = self.xyz2dims[2]  # this is the dv axis
-        _surface = (self.label == 0).astype(np.int8) * 2
+        axz = xyz2dims[2]  # this is the dv axis
+        nz = label.shape[axz]
+        _surface = (label == 0).astype(np.int8) * 2
         l0 = np.diff(_surface, axis=axz, append=2)
         _top = np.argmax(l0 == -2, axis=axz).astype(np.float)
         _top[_top == 0] = np.nan
-        _bottom = self.bc.nz - np.argmax(np.flip(l0, axis=axz) == 2, axis=axz).astype(np.float)
-        _bottom[_bottom == self.bc.nz] = np.nan
-        self.top = self.bc.i2z(_top + 1)
-        self.bottom = self.bc.i2z(_bottom - 1)
-        self.surface = np.diff(_surface, axis=self.xyz2dims[0], append=2) + l0
-        idx_srf = np.where(self.surface != 0)
-        self.surface[idx_srf] = 1
-        self.srf_xyz = self.bc.i2xyz(np.c_[idx_srf[self.xyz2dims[0]], idx_srf[self.xyz2dims[1]],
-                                           idx_srf[self.xyz2dims[2]]].astype(np.float))
+        _bottom = nz - np.argmax(np.flip(l0, axis=axz) == 2, axis=axz).astype(np.float)
+        _bottom[_bottom == nz] = np.nan
+        surface = np.diff(_surface, axis=xyz2dims[0], append=2) + l0
+        idx_srf = np.where(surface != 0)
+        surface[idx_srf] = 1
+        srf_ixyz = np.c_[idx_srf[xyz2dims[0]], idx_srf[xyz2dims[1]], idx_srf[xyz2dims[2]]]
+        return {'top': _top + 1, 'bottom': _bottom - 1, 'surface': surface, 'srf_ixyz': srf_ixyz}
 
     def _lookup_inds(self, ixyz):
         """
@@ -280,40 +303,127 @@ class BrainAtlas:
         :return: np.array, abscissa extent (width), ordinate extent (height),
         squeezed axis extent (depth)
         """
+        tslices, width, height, depth = self.tilted_slices([xyz], axis, volume=volume,
+                                                           mode='wrap')
+        return tslices[0], width[0], height[0], depth[0]
+
+    def tilted_slices(self, xyzs, axis, volume='image', mode='raise', step=1, interpolate=False,
+                      mapping='Allen', region_values=None):
+        """
+        Batched version of tilted_slice: extracts the tilted planes containing each line from the
+        3D volume in a single lookup
+        :param xyzs: list of np.arrays of points defining probe trajectories (xyz triplets)
+        :param axis:
+            0: along ml = sagittal-slice
+            1: along ap = coronal-slice
+            2: along dv = horizontal-slice
+        :param volume: 'image', 'annotation', 'value', 'surface' or np.array volume
+        :param mode: error mode for trajectories leaving the volume along the squeezed axis
+            -   'raise' raise an error
+            -   'clip' gets the first or last index
+        :param step: subsampling of the planes, ie. step=4 gives a 4 times lower resolution
+         preview
+        :param interpolate: if True, the image is linearly interpolated along the squeezed axis,
+         which is trilinear sampling as the other coordinates fall on the grid. Labels are always
+         sampled at the nearest voxel
+        :param mapping: brain region mapping for the 'annotation' and 'value' volumes
+        :param region_values: values per region for the 'value' volume
+        :return: np.array [ntrajectories, height, width(, 3)], abscissa extents (width) [n, 2],
+         ordinate extents (height) [n, 2], squeezed axis extents (depth) [n, 2]
+        """
+        wdim, hdim, ddim = self._slice_dims(axis)
+        sub_volumes, inds = [], []
+        for xyz in xyzs:
+            # get the best fit and find exit points of the volume along squeezed axis
+            trj = Trajectory.fit(xyz)
+            sub_volume = trj._eval(self.bc.lim(axis=hdim), axis=hdim)
+            sub_volume[:, wdim] = self.bc.lim(axis=wdim)
+            sub_volume_i = self.bc.xyz2i(sub_volume)
+            nh = np.diff(sub_volume_i[:, hdim])[0] + 1
+            sub_volumes.append(sub_volume)
+            inds.append(np.linspace(*self.bc.xyz2i(sub_volume, round=False)[:, ddim], nh)
+                        if interpolate else np.linspace(*sub_volume_i[:, ddim], nh))
+        # the planes span the volume along the height dimension so they have the same shape
+        inds = np.array(inds)[:, ::step]
+        INDX, INDY = self._index_grid(axis, inds.shape[1] * step, self.bc.nxyz[wdim], step)
+        order = np.argsort([wdim, hdim, ddim])[self.xyz2dims]
+
+        def _take(ind_d):
+            ind_d = self._check_index(np.int64(np.around(ind_d)), self.bc.nxyz[ddim], mode)
+            indsl = [[INDX, INDY, ind_d[:, :, np.newaxis]][i] for i in order]
+            return self._take_volume(volume, tuple(indsl), mapping, region_values)
+
+        if interpolate and self._interpolable(volume):
+            inds = np.clip(inds, 0, self.bc.nxyz[ddim] - 1) if mode == 'clip' else inds
+            i0 = np.floor(inds)
+            w = (inds - i0)[:, :, np.newaxis]
+            tslices = _take(i0) * (1 - w) + _take(np.minimum(i0 + 1, self.bc.nxyz[ddim] - 1)) * w
+        else:
+            tslices = _take(inds)
+
+        #  get extents with correct convention NB: matplotlib flips the y-axis on imshow !
+        lims = [np.argsort(self.bc.lim(axis=d)) for d in (wdim, hdim, ddim)]
+        width = np.array([np.sort(sv[:, wdim])[lims[0]] for sv in sub_volumes])
+        height = np.array([np.flipud(np.sort(sv[:, hdim])[lims[1]]) for sv in sub_volumes])
+        depth = np.array([np.flipud(np.sort(sv[:, ddim])[lims[2]]) for sv in sub_volumes])
+        return tslices, width, height, depth
+
+    @staticmethod
+    def _slice_dims(axis):
+        """
+        :return: width, height and squeezed (depth) xyz dimensions of slices along an axis
+        """
         if axis == 0:   # sagittal slice (squeeze/take along ml-axis)
-            wdim, hdim, ddim = (1, 2, 0)
+            return 1, 2, 0
         elif axis == 1:  # coronal slice (squeeze/take along ap-axis)
-            wdim, hdim, ddim = (0, 2, 1)
+            return 0, 2, 1
         elif axis == 2:  # horizontal slice (squeeze/take along dv-axis)
-            wdim, hdim, ddim = (0, 1, 2)
-        # get the best fit and find exit points of the volume along squeezed axis
-        trj = Trajectory.fit(xyz)
-        sub_volume = trj._eval(self.bc.lim(axis=hdim), axis=hdim)
-        sub_volume[:, wdim] = self.bc.lim(axis=wdim)
-        sub_volume_i = self.bc.xyz2i(sub_volume)
-        tile_shape = np.array([np.diff(sub_volume_i[:, hdim])[0] + 1, self.bc.nxyz[wdim]])
-        # get indices along each dimension
-        indx = np.arange(tile_shape[1])
-        indy = np.arange(tile_shape[0])
-        inds = np.linspace(*sub_volume_i[:, ddim], tile_shape[0])
-        # compute the slice indices and output the slice
-        _, INDS = np.meshgrid(indx, np.int64(np.around(inds)))
-        INDX, INDY = np.meshgrid(indx, indy)
-        indsl = [[INDX, INDY, INDS][i] for i in np.argsort([wdim, hdim, ddim])[self.xyz2dims]]
+            return 0, 1, 2
+        raise ValueError('axis should be 0, 1 or 2')
+
+    def _index_grid(self, axis, nh, nw, step=1):
+        """
+        Cached index grids of the tilted slices, as they are the same for all planes of a shape
+        :return: INDX, INDY: [nh / step, nw / step] width and height indices
+        """
+        key = (axis, nh, nw, step)
+        if key not in self._index_grids:
+            self._index_grids[key] = np.meshgrid(np.arange(0, nw, step), np.arange(0, nh, step))
+        return self._index_grids[key]
+
+    @staticmethod
+    def _check_index(ind, n, mode='raise'):
+        """
+        Handles the indices out of a dimension of size n according to the error mode: 'raise',
+        'clip', or 'wrap' for negative indices as per numpy indexing
+        """
+        if mode == 'clip':
+            return np.minimum(np.maximum(ind, 0), n - 1)
+        elif mode == 'raise' and np.any((ind < 0) | (ind >= n)):
+            raise IndexError(f'index out of the volume bounds [0, {n - 1}]')
+        return ind
+
+    @staticmethod
+    def _interpolable(volume):
+        return isinstance(volume, np.ndarray) or volume == 'image'
+
+    def _take_volume(self, volume, indices, mapping='Allen', region_values=None):
+        """
+        Lookup in a volume with the same conventions as slice()
+        :param volume: 'image', 'annotation', 'value', 'surface' or np.array volume
+        :param indices: tuple of indices arrays or slices in the volume dimensions order
+        """
         if isinstance(volume, np.ndarray):
-            tslice = volume[indsl[0], indsl[1], indsl[2]]
+            return volume[indices]
         elif volume.lower() == 'annotation':
-            tslice = self._label2rgb(self.label[indsl[0], indsl[1], indsl[2]])
+            return self._label2rgb(self._get_mapping(mapping=mapping)[self.label[indices]])
+        elif volume.lower() == 'value':
+            return region_values[self._get_mapping(mapping=mapping)[self.label[indices]]]
         elif volume.lower() == 'image':
-            tslice = self.image[indsl[0], indsl[1], indsl[2]]
-        elif volume.lower() == 'surface':
-            tslice = self.surface[indsl[0], indsl[1], indsl[2]]
-
-        #  get extents with correct convention NB: matplotlib flips the y-axis on imshow !
-        width = np.sort(sub_volume[:, wdim])[np.argsort(self.bc.lim(axis=wdim))]
-        height = np.flipud(np.sort(sub_volume[:, hdim])[np.argsort(self.bc.lim(axis=hdim))])
-        depth = np.flipud(np.sort(sub_volume[:, ddim])[np.argsort(self.bc.lim(axis=ddim))])
-        return tslice, width, height, depth
+            return self.image[indices]
+        elif volume.lower() in ['surface', 'edges']:
+            return self.surface[indices]
+        raise ValueError(f'Unknown volume {volume}')
 
     def plot_tilted_slice(self, xyz, axis, volume='image', cmap=None, ax=None, **kwargs):
         """
@@ -413,6 +523,41 @@ class BrainAtlas:
         elif volume in ['surface', 'edges']:
             return _take(self.surface, index, axis=self.xyz2dims[axis])
 
+    def slices(self, coordinates, axis, volume='image', mode='raise', region_values=None,
+               mapping="Allen", step=1, interpolate=False):
+        """
+        Batched version of slice: extracts the planes at several coordinates in a single lookup
+        :param coordinates: np.array of coordinates
+        :param axis: xyz convention:  0 for ml, 1 for ap, 2 for dv
+        :param volume: 'image', 'annotation', 'value', 'surface' or np.array volume
+        :param mode: error mode for out of bounds coordinates
+            -   'raise' raise an error
+            -   'clip' gets the first or last index
+        :param region_values: values per region for the 'value' volume
+        :param mapping: brain region mapping for the 'annotation' and 'value' volumes
+        :param step: subsampling of the planes, ie. step=4 gives a 4 times lower resolution
+         preview
+        :param interpolate: if True, the image is linearly interpolated between the two closest
+         planes. Labels are always sampled at the nearest voxel
+        :return: np.array [ncoordinates, ...] of slices as returned by slice()
+        """
+        coordinates = np.atleast_1d(coordinates)
+        n, adim = self.bc.nxyz[axis], self.xyz2dims[axis]
+        inds = self.bc.xyz2i(np.tile(coordinates[:, np.newaxis], (1, 3)), round=False)[:, axis]
+
+        def _take(ind):
+            indices = [slice(None, None, step)] * 3
+            indices[adim] = self._check_index(np.int64(np.around(ind)), n, mode)
+            return np.moveaxis(self._take_volume(volume, tuple(indices), mapping, region_values),
+                               adim, 0)
+
+        if not (interpolate and self._interpolable(volume)):
+            return _take(inds)
+        inds = np.clip(inds, 0, n - 1) if mode == 'clip' else inds
+        i0 = np.floor(inds)
+        w = (inds - i0)[:, np.newaxis, np.newaxis]
+        return _take(i0) * (1 - w) + _take(np.minimum(i0 + 1, n - 1)) * w
+
     def plot_cslice(self, ap_coordinate, volume='image', **kwargs):
         """
         Imshow a coronal slice
@@ -700,29 +845,44 @@ class AllenAtlas(BrainAtlas):
     """
 
     def __init__(self, res_um=25, brainmap='Allen', scaling=np.array([1, 1, 1]),
-                 mock=False, hist_path=None):
+                 mock=False, hist_path=None, cache=True):
         """
         :param res_um: 10, 25 or 50 um
         :param brainmap: defaults to 'Allen', see ibllib.atlas.BrainRegion for re-mappings
         :param scaling: scale factor along ml, ap, dv for squeeze and stretch ([1, 1, 1])
         :param mock: for testing purpose
         :param hist_path
+        :param cache: if True, the volumes and surfaces are memory-mapped from an uncompressed
+         cache written on first use, so that construction is immediate and the pages are shared
+         by all processes using the atlas. The volumes are copy-on-write.
         :return: atlas.BrainAtlas
         """
         par = params.read('one_params')
         FLAT_IRON_ATLAS_REL_PATH = Path('histology', 'ATLAS', 'Needles', 'Allen')
         regions = BrainRegions()
+        surfaces = None
         if mock:
             image, label = [np.zeros((528, 456, 320), dtype=np.int16) for _ in range(2)]
             label[:, :, 100:105] = 1327  # lookup index for retina, id 304325711 (no id 1327)
         else:
             path_atlas = Path(par.CACHE_DIR).joinpath(FLAT_IRON_ATLAS_REL_PATH)
             file_image = hist_path or path_atlas.joinpath(f'average_template_{res_um}.nrrd')
+            file_label = path_atlas.joinpath(f'annotation_{res_um}.nrrd')
+            # the image from a custom histology path is not cached
+            cache_files = self._cache_files(path_atlas, res_um, hist_path is None) if cache else {}
+            if cache_files and all(f.exists() for f in cache_files.values()) and \
+                    min(f.stat().st_mtime for f in cache_files.values()) >= \
+                    max([f.stat().st_mtime for f in [Path(file_image), file_label] if f.exists()],
+                        default=0):
+                cached = {k: np.load(f, mmap_mode='c') for k, f in cache_files.items()}
+                image = cached.pop('image') if 'image' in cached else self._read_volume(file_image)
+                label = cached.pop('label')
+                surfaces = cached
+        if not mock and surfaces is None:
             # get the image volume
             if not file_image.exists():
                 _download_atlas_flatiron(file_image, FLAT_IRON_ATLAS_REL_PATH, par)
             # get the remapped label volume
-            file_label = path_atlas.joinpath(f'annotation_{res_um}.nrrd')
             if not file_label.exists():
                 _download_atlas_flatiron(file_label, FLAT_IRON_ATLAS_REL_PATH, par)
             file_label_remap = path_atlas.joinpath(f'annotation_{res_um}_lut.npz')
@@ -737,12 +897,29 @@ class AllenAtlas(BrainAtlas):
             image = self._read_volume(file_image)
         xyz2dims = np.array([1, 0, 2])  # this is the c-contiguous ordering
         dims2xyz = np.array([1, 0, 2])
+        if not mock and cache and surfaces is None:
+            _logger.info(f"writing the brain atlas cache in {path_atlas.joinpath('cache')}")
+            surfaces = self.compute_surfaces(label, xyz2dims)
+            arrays = dict(surfaces, image=image, label=label)
+            for k, f in cache_files.items():
+                _save_npy(f, arrays[k])
+                arrays[k] = np.load(f, mmap_mode='c')
+            image, label = arrays.pop('image', image), arrays.pop('label')
+            surfaces = arrays
         dxyz = res_um * 1e-6 * np.array([1, -1, -1]) * scaling
         # we use Bregma as the origin
         ibregma = (ALLEN_CCF_LANDMARKS_MLAPDV_UM['bregma'] / res_um)
         self.res_um = res_um
         super().__init__(image, label, dxyz, regions, ibregma,
-                         dims2xyz=dims2xyz, xyz2dims=xyz2dims)
+                         dims2xyz=dims2xyz, xyz2dims=xyz2dims, surfaces=surfaces)
+
+    @staticmethod
+    def _cache_files(path_atlas, res_um, image=True):
+        """
+        :return: dictionary of the memory-mapped cache npy files of the atlas
+        """
+        return {k: Path(path_atlas).joinpath('cache', f'{k}_{res_um}.npy')
+                for k in ATLAS_CACHE_ARRAYS if image or k != 'image'}
 
     @staticmethod
     def _read_volume(file_volume):
@@ -813,6 +990,33 @@ def NeedlesAtlas(*args, **kwargs):
     return AllenAtlas(*args, **kwargs)
 
 
+def get_allen_atlas(res_um=25, **kwargs):
+    """
+    Returns the AllenAtlas instance shared by the whole process for the given arguments,
+    instantiated on first call. Unless cache=False is specified, the volumes are memory-mapped
+    copy-on-write so that processes on the same machine share the pages of the atlas.
+    The shared instance should not be modified, use AllenAtlas() to get an own instance.
+    :param res_um: 10, 25 or 50 um
+    :param kwargs: AllenAtlas arguments
+    :return: atlas.AllenAtlas
+    """
+    key = (res_um,) + tuple((k, np.array(v).tobytes() if isinstance(v, np.ndarray) else v)
+                            for k, v in sorted(kwargs.items()))
+    with _SHARED_ATLASES_LOCK:
+        if key not in _SHARED_ATLASES:
+            _SHARED_ATLASES[key] = AllenAtlas(res_um=res_um, **kwargs)
+        return _SHARED_ATLASES[key]
+
+
+def _save_npy(file, array):
+    """Writes a npy file atomically, as it may be memory-mapped by other processes"""
+    file.parent.mkdir(exist_ok=True, parents=True)
+    file_part = file.with_suffix(f'.{os.getpid()}.part')
+    with open(file_part, 'wb') as fid:
+        np.save(fid, array)
+    file_part.replace(file)
+
+
 def _download_atlas_flatiron(file_image, FLAT_IRON_ATLAS_REL_PATH, par):
     file_image.parent.mkdir(exist_ok=True, parents=True)
     url = (par.HTTP_DATA_SERVER + '/' +
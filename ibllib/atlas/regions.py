@@ -5,7 +5,6 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 from brainbox.core import Bunch
-from brainbox.numerical import ismember
 
 _logger = logging.getLogger('ibllib')
 BERYL = np.array([184, 985, 993, 353, 329, 480149202, 337, 345, 369, 361, 182305689, 378, 1057, 677, 1011, 480149230, 1002, 1027, 1018, 402, 394, 409, 385, 425, 533, 312782574, 312782628, 39, 48, 972, 44, 723, 731, 738, 746, 104, 111, 119, 894, 879, 886, 312782546, 417, 541, 922, 895, 507, 151, 159, 597, 605, 814, 961, 619, 639, 647, 788, 566, 382, 423, 463, 726, 982, 19, 918, 926, 843, 1037, 1084, 502, 484682470, 589508447, 484682508, 583, 952, 966, 131, 295, 319, 780, 672, 56, 998, 754, 250, 258, 266, 310, 333, 23, 292, 536, 1105, 403, 1022, 1031, 342, 298, 564, 596, 581, 351, 629, 685, 718, 725, 733, 741, 563807435, 406, 609, 1044, 475, 170, 218, 1020, 1029, 325, 560581551, 255, 127, 64, 1120, 1113, 155, 59, 362, 366, 1077, 149, 15, 181, 560581559, 189, 599, 907, 575, 930, 560581563, 262, 1014, 27, 563807439, 178, 321, 483, 186, 1097, 390, 38, 30, 118, 223, 72, 263, 272, 830, 452, 523, 1109, 126, 133, 347, 286, 338, 576073699, 689, 88, 210, 491, 525, 557, 515, 980, 1004, 63, 693, 946, 194, 226, 364, 576073704, 173, 470, 614, 797, 302, 4, 580, 271, 874, 381, 749, 607344830, 246, 128, 294, 795, 50, 67, 587, 215, 531, 628, 634, 706, 1061, 549009203, 616, 214, 35, 549009211, 975, 115, 606826663, 757, 231, 66, 75, 58, 374, 1052, 12, 100, 197, 591, 872, 612, 7, 867, 398, 280, 880, 599626927, 898, 931, 1093, 318, 534, 574, 621, 549009215, 549009219, 549009223, 549009227, 679, 147, 162, 604, 146, 238, 350, 358, 207, 96, 101, 711, 1039, 903, 642, 651, 429, 437, 445, 589508451, 653, 661, 135, 839, 1048, 372, 83, 136, 106, 203, 235, 307, 395, 852, 859, 938, 177, 169, 995, 1069, 209, 202, 225, 217, 765, 773, 781, 206, 230, 222, 912, 976, 984, 1091, 936, 944, 951, 957, 968, 1007, 1056, 1064, 1025, 1033, 1041, 1049, 989, 91, 846, 589508455,])  # noqa
@@ -40,21 +39,71 @@ class BrainRegions(_BrainRegions):
                          rgb=c,
                          level=df_regions.depth.to_numpy(),
                          parent=df_regions.parent_structure_id.to_numpy())
+        self._compute_hierarchy()
         # mappings are indices not ids: they range from 0 to n regions -1
         self.mappings = {
             'Allen': np.arange(self.id.size),
             'Beryl': self._mapping_from_regions_list(BERYL),
         }
 
+    def _compute_hierarchy(self):
+        """
+        Indexes the regions tree once so that the hierarchy queries are vectorized lookups:
+        self._isort: argsort of the ids for the id to row lookup
+        self._order: rows in depth first order (nested set), the descendants of the region at
+         position self._tin[i] of the order are at positions self._tin[i] to self._tout[i]
+        self._ancestors_table: [nregions, depth + 1] array of the row of the ancestor at each
+         depth, -1 below the depth of the region
+        """
+        self._isort = np.argsort(self.id)
+        iparent = self.id2index(np.nan_to_num(self.parent, nan=-1))
+        nr = self.id.size
+        children = [[] for _ in range(nr)]
+        for i, ip in enumerate(iparent):
+            if ip >= 0:
+                children[ip].append(i)
+        order, depth = [], np.zeros(nr, dtype=int)
+        stack = [i for i in range(nr - 1, -1, -1) if iparent[i] < 0]
+        while stack:
+            i = stack.pop()
+            order.append(i)
+            for c in reversed(children[i]):
+                depth[c] = depth[i] + 1
+                stack.append(c)
+        self._order = np.array(order)
+        self._tin = np.zeros(nr, dtype=int)
+        self._tin[self._order] = np.arange(nr)
+        # the last descendant in depth first order is reached before the next sibling
+        self._tout = np.zeros(nr, dtype=int)
+        for i in self._order[::-1]:
+            self._tout[i] = max([self._tin[i]] + [self._tout[c] for c in children[i]])
+        self._depth = depth
+        self._ancestors_table = np.full((nr, depth.max() + 1), -1)
+        self._ancestors_table[np.arange(nr), depth] = np.arange(nr)
+        for i in self._order:
+            if iparent[i] >= 0:
+                self._ancestors_table[i, :depth[i]] = self._ancestors_table[iparent[i], :depth[i]]
+
+    def id2index(self, ids):
+        """
+        Vectorized lookup of the rows of region ids in the regions arrays
+        :param ids: np.array or scalar of region ids
+        :return: np.array of indices, -1 for ids not found
+        """
+        ids = np.asarray(ids)
+        isorted = np.minimum(np.searchsorted(self.id, ids, sorter=self._isort), self.id.size - 1)
+        rows = self._isort[isorted]
+        return np.where(self.id[rows] == ids, rows, -1)
+
     def get(self, ids) -> Bunch:
         """
         Get a bunch of the name/id
         """
-        uid, uind = np.unique(ids, return_inverse=True)
-        a, iself, _ = np.intersect1d(self.id, uid, assume_unique=False, return_indices=True)
+        rows = self.id2index(np.atleast_1d(ids).flatten())
+        rows = rows[rows >= 0]
         b = Bunch()
         for k in self.__dataclass_fields__.keys():
-            b[k] = self.__getattribute__(k)[iself[uind]]
+            b[k] = self.__getattribute__(k)[rows]
         return b
 
     def _navigate_tree(self, ids, direction='down'):
@@ -64,19 +113,20 @@ class BrainRegions(_BrainRegions):
         :param direction:
         :return: Bunch
         """
-        indices = ismember(self.id, ids)[0]
-        count = np.sum(indices)
-        while True:
-            if direction == 'down':
-                indices |= ismember(self.parent, self.id[indices])[0]
-            elif direction == 'up':
-                indices |= ismember(self.id, self.parent[indices])[0]
-            else:
-                raise ValueError("direction should be either 'up' or 'down'")
-            if count == np.sum(indices):  # last iteration didn't find any match
-                break
-            else:
-                count = np.sum(indices)
+        rows = self.id2index(np.atleast_1d(ids).flatten())
+        rows = rows[rows >= 0]
+        indices = np.zeros(self.id.size, dtype=bool)
+        if direction == 'down':
+            # union of the nested sets intervals of the regions
+            cover = np.zeros(self.id.size + 1, dtype=int)
+            np.add.at(cover, self._tin[rows], 1)
+            np.add.at(cover, self._tout[rows] + 1, -1)
+            indices[self._order[np.cumsum(cover[:-1]) > 0]] = True
+        elif direction == 'up':
+            ancestors = self._ancestors_table[rows].flatten()
+            indices[ancestors[ancestors >= 0]] = True
+        else:
+            raise ValueError("direction should be either 'up' or 'down'")
         return self.get(self.id[indices])
 
     def descendants(self, ids):
@@ -95,13 +145,36 @@ class BrainRegions(_BrainRegions):
         """
         return self._navigate_tree(ids, direction='up')
 
+    def is_descendant(self, ids, ancestor_ids):
+        """
+        Vectorized test of the hierarchy, a region is considered its own descendant
+        :param ids: np.array or scalar of region ids
+        :param ancestor_ids: np.array or scalar of region ids, broadcast against ids
+        :return: boolean np.array, False for ids not found
+        """
+        rows, arows = self.id2index(ids), self.id2index(ancestor_ids)
+        tin = self._tin[rows]
+        return (rows >= 0) & (arows >= 0) & (self._tin[arows] <= tin) & (tin <= self._tout[arows])
+
+    def remap_level(self, ids, level):
+        """
+        Remaps regions to their ancestor at a given depth in the hierarchy
+        :param ids: np.array or scalar of region ids
+        :param level: depth in the hierarchy (root is 0). Regions higher up are not remapped
+        :return: np.array of region ids
+        """
+        rows = self.id2index(ids)
+        assert np.all(rows >= 0), "All ids should be represented in the Allen ids"
+        level = min(level, self._ancestors_table.shape[1] - 1)
+        return self.id[np.where(self._depth[rows] > level,
+                                self._ancestors_table[rows, level], rows)]
+
     def leaves(self):
         """
         Get all regions that do not have children
         :return:
         """
-        leaves = np.setxor1d(self.id, self.parent)
-        return self.get(np.int64(leaves[~np.isnan(leaves)]))
+        return self.get(np.sort(self.id[self._tin == self._tout]))
 
     def _mapping_from_regions_list(self, new_map):
         """
@@ -112,15 +185,12 @@ class BrainRegions(_BrainRegions):
         I_ROOT = 1
         I_VOID = 0
         assert np.all(np.sort(new_map) == np.unique(new_map)), "Mapping ids should be unique"
-        _, iid, inm = np.intersect1d(self.id, new_map, return_indices=True)
-        assert (iid.size == new_map.size), "All mapping ids should be represented in the Allen ids"
+        iid = self.id2index(new_map)
+        assert np.all(iid >= 0), "All mapping ids should be represented in the Allen ids"
         mapind = np.zeros_like(self.id) + I_ROOT  # non assigned regions are root
-        mapind[iid] = iid  # regions present in the list have the same index
         # Starting by the higher up levels in the hierarchy, assign all descendants to the mapping
-        for i in np.argsort(self.level[iid]):
-            descendants = self.descendants(self.id[iid[i]]).id
-            _, idesc, _ = np.intersect1d(self.id, descendants, return_indices=True)
-            mapind[idesc] = iid[i]
+        for i in iid[np.argsort(self._depth[iid], kind='stable')]:
+            mapind[self._order[self._tin[i]:self._tout[i] + 1]] = i
         mapind[0] = I_VOID  # void stays void
         return mapind
 
@@ -2,6 +2,7 @@
 Quality control of raw Neuropixel electrophysiology data.
 """
 from pathlib import Path
+import concurrent.futures
 import logging
 import shutil
 
@@ -12,7 +13,7 @@ from scipy import signal
 import alf.io
 from brainbox.core import Bunch
 from brainbox.metrics import spike_sorting_metrics
-from ibllib.ephys import sync_probes
+from ibllib.ephys import scan, sync_probes
 from ibllib.io import spikeglx, raw_data_loaders
 import ibllib.dsp as dsp
 from ibllib.io.extractors import ephys_fpga, training_wheel
@@ -24,20 +25,55 @@ _logger = logging.getLogger('ibllib')
 
 RMS_WIN_LENGTH_SECS = 3
 WELCH_WIN_LENGTH_SAMPLES = 1024
+RMS_BATCH_NWIN = 16  # number of RMS windows processed by a worker at once
 NCH_WAVEFORMS = 32  # number of channels to be saved in templates.waveforms and channels.waveforms
 
 
-def rmsmap(fbin):
+def _rms_window(D, fs):
     """
-    Computes RMS map in time domain and spectra for each channel of Neuropixel probe
+    Computes the time domain RMS and the welch spectral density of a single window
 
-    :param fbin: binary file in spike glx format (will look for attached metatdata)
-    :type fbin: str or pathlib.Path
-    :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
-     and frequency scales
+    :param D: float32 array (nc, ns) of samples in Volts
+    :param fs: sampling frequency (Hz)
+    :return: tuple (rms, nsamples, spectral_density). The spectral density is None for windows
+     too short for the welch method.
+    """
+    # remove low frequency noise below 1 Hz
+    D = dsp.hp(D, 1 / fs, [0, 1])
+    w = None
+    # the last window may be smaller than what is needed for welch
+    if D.shape[1] >= WELCH_WIN_LENGTH_SAMPLES:
+        # compute a smoothed spectrum using welch method
+        _, w = signal.welch(D, fs=fs, window='hann', nperseg=WELCH_WIN_LENGTH_SAMPLES,
+                            detrend='constant', return_onesided=True, scaling='density', axis=-1)
+        w = w.T
+    return dsp.rms(D), D.shape[1], w
+
+
+def _rmsmap_windows(fbin, firstlast):
+    """
+    Computes the time domain RMS and the welch spectral density for a batch of windows.
+    This is the unit of work of `rmsmap`: the reader is instantiated here so that each worker
+    process reads the memmap / mtscomp chunks directly instead of receiving the data.
+
+    :param fbin: binary file in spike glx format (will look for attached metadata)
+    :param firstlast: list of (first, last) sample indices of the windows to process
+    :return: list of (rms, nsamples, spectral_density) tuples, one per window
+    """
+    sglx = spikeglx.Reader(fbin)
+    out = []
+    for first, last in firstlast:
+        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
+        out.append(_rms_window(D, sglx.fs))
+    return out
+
+
+def _rmsmap_init(sglx):
+    """
+    Window generator and pre-allocated output dictionary of the RMS map of a file
+    :param sglx: spikeglx.Reader object
+    :return: dsp.WindowGenerator, dictionary of numpy arrays
     """
-    if not isinstance(fbin, spikeglx.Reader):
-        sglx = spikeglx.Reader(fbin)
     rms_win_length_samples = 2 ** np.ceil(np.log2(sglx.fs * RMS_WIN_LENGTH_SECS))
     # the window generator will generates window indices
     wingen = dsp.WindowGenerator(ns=sglx.ns, nswin=rms_win_length_samples, overlap=0)
@@ -47,28 +83,105 @@ def rmsmap(fbin):
            'fscale': dsp.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sglx.fs, one_sided=True),
            'tscale': wingen.tscale(fs=sglx.fs)}
     win['spectral_density'] = np.zeros((len(win['fscale']), sglx.nc))
-    # loop through the whole session
-    for first, last in wingen.firstlast:
-        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
-        # remove low frequency noise below 1 Hz
-        D = dsp.hp(D, 1 / sglx.fs, [0, 1])
-        iw = wingen.iw
-        win['TRMS'][iw, :] = dsp.rms(D)
-        win['nsamples'][iw] = D.shape[1]
-        # the last window may be smaller than what is needed for welch
-        if last - first < WELCH_WIN_LENGTH_SAMPLES:
-            continue
-        # compute a smoothed spectrum using welch method
-        _, w = signal.welch(D, fs=sglx.fs, window='hanning', nperseg=WELCH_WIN_LENGTH_SAMPLES,
-                            detrend='constant', return_onesided=True, scaling='density', axis=-1)
-        win['spectral_density'] += w.T
-        # print at least every 20 windows
-        if (iw % min(20, max(int(np.floor(wingen.nwin / 75)), 1))) == 0:
-            print_progress(iw, wingen.nwin)
+    return wingen, win
+
+
+def _rmsmap_append(win, iw, rms, nsamples, w):
+    win['TRMS'][iw, :] = rms
+    win['nsamples'][iw] = nsamples
+    if w is not None:
+        win['spectral_density'] += w
+
+
+def rmsmap(fbin, nprocesses=1):
+    """
+    Computes RMS map in time domain and spectra for each channel of Neuropixel probe
+
+    :param fbin: binary file in spike glx format (will look for attached metatdata)
+    :type fbin: str or pathlib.Path
+    :param nprocesses: number of worker processes. Windows are split in batches of
+     RMS_BATCH_NWIN processed in parallel, the output is identical to the single process run
+    :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
+     and frequency scales
+    """
+    sglx = fbin if isinstance(fbin, spikeglx.Reader) else spikeglx.Reader(fbin)
+    wingen, win = _rmsmap_init(sglx)
+    # split the whole session in batches of windows
+    firstlast = list(wingen.firstlast)
+    batches = [firstlast[i:i + RMS_BATCH_NWIN] for i in range(0, len(firstlast), RMS_BATCH_NWIN)]
+    if nprocesses > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=nprocesses)
+        results = executor.map(_rmsmap_windows, [sglx.file_bin] * len(batches), batches)
+    else:
+        executor = None
+        results = map(_rmsmap_windows, [sglx.file_bin] * len(batches), batches)
+    # results are yielded in window order, the spectra are summed in the same order as for a
+    # serial run so that the output does not depend on the number of processes
+    iw = 0
+    try:
+        for ib, batch in enumerate(results):
+            for rms, nsamples, w in batch:
+                _rmsmap_append(win, iw, rms, nsamples, w)
+                iw += 1
+            print_progress(ib + 1, len(batches))
+    finally:
+        if executor is not None:
+            executor.shutdown()
     return win
 
 
-def extract_rmsmap(fbin, out_folder=None, overwrite=False):
+class RmsMapConsumer(scan.WindowedConsumer):
+    """
+    Computes the RMS map while scanning a raw binary file, the output is the same as `rmsmap`
+    """
+
+    def window_generator(self, sr):
+        wingen, self.win = _rmsmap_init(sr)
+        self.iw = 0
+        return wingen
+
+    def process_window(self, samples, first, last):
+        _rmsmap_append(self.win, self.iw, *_rms_window(self.sr._raw2v(samples).T, self.sr.fs))
+        self.iw += 1
+
+    def finalize(self):
+        return self.win
+
+
+def _rmsmap_alf_names(sglx):
+    return f'ephysTimeRms{sglx.type.upper()}', f'ephysSpectralDensity{sglx.type.upper()}'
+
+
+def _rmsmap_existing_files(sglx, out_folder):
+    """
+    :return: list of existing rmsmap ALF files if complete, None otherwise
+    """
+    alf_object_time, alf_object_freq = _rmsmap_alf_names(sglx)
+    files_time = list(out_folder.glob(f"_iblqc_{alf_object_time}*"))
+    files_freq = list(out_folder.glob(f"_iblqc_{alf_object_freq}*"))
+    if len(files_time) == 2 == len(files_freq):
+        return files_time + files_freq
+
+
+def _rmsmap_save(sglx, rms, out_folder):
+    """
+    Outputs ALF files, single precision with the optional label as suffix before extension
+    :return: list of ALF files
+    """
+    alf_object_time, alf_object_freq = _rmsmap_alf_names(sglx)
+    if not out_folder.exists():
+        out_folder.mkdir()
+    tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single)}
+    fdict = {'power': rms['spectral_density'].astype(np.single),
+             'freqs': rms['fscale'].astype(np.single)}
+    out_time = alf.io.save_object_npy(
+        out_folder, object=alf_object_time, dico=tdict, namespace='iblqc')
+    out_freq = alf.io.save_object_npy(
+        out_folder, object=alf_object_freq, dico=fdict, namespace='iblqc')
+    return out_time + out_freq
+
+
+def extract_rmsmap(fbin, out_folder=None, overwrite=False, nprocesses=1):
     """
     Wrapper for rmsmap that outputs _ibl_ephysRmsMap and _ibl_ephysSpectra ALF files
 
@@ -77,6 +190,7 @@ def extract_rmsmap(fbin, out_folder=None, overwrite=False):
      the `fbin` file lives.
     :param overwrite: do not re-extract if all ALF files already exist
     :param label: string or list of strings that will be appended to the filename before extension
+    :param nprocesses: number of worker processes used to compute the RMS map (defaults to 1)
     :return: None
     """
     _logger.info(f"Computing QC for {fbin}")
@@ -86,46 +200,93 @@ def extract_rmsmap(fbin, out_folder=None, overwrite=False):
         out_folder = Path(fbin).parent
     else:
         out_folder = Path(out_folder)
-    alf_object_time = f'ephysTimeRms{sglx.type.upper()}'
-    alf_object_freq = f'ephysSpectralDensity{sglx.type.upper()}'
-    files_time = list(out_folder.glob(f"_iblqc_{alf_object_time}*"))
-    files_freq = list(out_folder.glob(f"_iblqc_{alf_object_freq}*"))
-    if (len(files_time) == 2 == len(files_freq)) and not overwrite:
+    existing_files = _rmsmap_existing_files(sglx, out_folder)
+    if existing_files and not overwrite:
         _logger.warning(f'{fbin.name} QC already exists, skipping. Use overwrite option.')
-        return files_time + files_freq
+        return existing_files
     # crunch numbers
-    rms = rmsmap(fbin)
-    # output ALF files, single precision with the optional label as suffix before extension
-    if not out_folder.exists():
-        out_folder.mkdir()
-    tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single)}
-    fdict = {'power': rms['spectral_density'].astype(np.single),
-             'freqs': rms['fscale'].astype(np.single)}
-    out_time = alf.io.save_object_npy(
-        out_folder, object=alf_object_time, dico=tdict, namespace='iblqc')
-    out_freq = alf.io.save_object_npy(
-        out_folder, object=alf_object_freq, dico=fdict, namespace='iblqc')
-    return out_time + out_freq
+    rms = rmsmap(fbin, nprocesses=nprocesses)
+    return _rmsmap_save(sglx, rms, out_folder)
 
 
-def raw_qc_session(session_path, overwrite=False):
+def raw_qc_session(session_path, overwrite=False, nprocesses=1):
     """
     Wrapper that exectutes QC from a session folder and outputs the results whithin the same folder
     as the original raw data.
     :param session_path: path of the session (Subject/yyyy-mm-dd/number
     :param overwrite: bool (False) Force means overwriting an existing QC file
+    :param nprocesses: number of worker processes used to compute each RMS map (defaults to 1)
     :return: None
     """
     efiles = spikeglx.glob_ephys_files(session_path)
     qc_files = []
     for efile in efiles:
         if efile.get('ap') and efile.ap.exists():
-            qc_files.extend(extract_rmsmap(efile.ap, out_folder=None, overwrite=overwrite))
+            qc_files.extend(extract_rmsmap(efile.ap, out_folder=None, overwrite=overwrite,
+                                           nprocesses=nprocesses))
         if efile.get('lf') and efile.lf.exists():
-            qc_files.extend(extract_rmsmap(efile.lf, out_folder=None, overwrite=overwrite))
+            qc_files.extend(extract_rmsmap(efile.lf, out_folder=None, overwrite=overwrite,
+                                           nprocesses=nprocesses))
     return qc_files
 
 
+def raw_scan_session(session_path, overwrite=False, consumers=None):
+    """
+    Extracts the sync fronts and computes the raw data QC (RMS map, spectral density and
+    saturation) of all the ephys binary files of a session, reading each file only once.
+    Outputs are the same as `ephys_fpga.extract_sync` and `raw_qc_session`.
+
+    :param session_path: path of the session (Subject/yyyy-mm-dd/number
+    :param overwrite: bool (False) Force means overwriting existing sync and QC files
+    :param consumers: optional function returning a list of additional scan.ScanConsumer
+     objects given a binary file. The consumers objects hold their own results
+    :return: list of sync files, list of QC files
+    """
+    efiles = spikeglx.glob_ephys_files(session_path)
+    sync_files, qc_files = [], []
+    for efi in efiles:
+        sync_file = efi.get('ap', efi.get('nidq', None))
+        for bin_file in [efi.get(k) for k in ['ap', 'lf', 'nidq'] if efi.get(k)]:
+            sr = spikeglx.Reader(bin_file)
+            scan_consumers = {}
+            if bin_file == sync_file:
+                alfname = dict(object='sync', namespace='spikeglx')
+                if efi.label:
+                    alfname['extra'] = efi.label
+                if alf.io.exists(bin_file.parent, **alfname) and not overwrite:
+                    _logger.warning(f'Skipping raw sync: SGLX sync found for probe {efi.label} !')
+                    sync_files.extend(alf.io._ls(bin_file.parent, **alfname)[0])
+                else:
+                    scan_consumers['sync'] = ephys_fpga.SyncFrontsConsumer(bin_file.parent)
+            if sr.type in ['ap', 'lf']:
+                existing_files = _rmsmap_existing_files(sr, bin_file.parent)
+                if existing_files and not overwrite:
+                    _logger.warning(f'{bin_file.name} QC already exists, skipping.')
+                    qc_files.extend(existing_files)
+                else:
+                    scan_consumers['rms'] = RmsMapConsumer()
+                    scan_consumers['saturation'] = scan.SaturationConsumer()
+            if consumers:
+                scan_consumers.update({f'user_{i}': c for i, c in enumerate(consumers(bin_file))})
+            if len(scan_consumers) == 0:
+                continue
+            # one read of the binary file for all the consumers
+            outputs = dict(zip(scan_consumers.keys(),
+                               scan.scan(sr, list(scan_consumers.values()))))
+            if 'sync' in outputs:
+                sync_files.extend(alf.io.save_object_npy(
+                    bin_file.parent, outputs.pop('sync'), '_spikeglx_sync', parts=efi.label))
+            if 'rms' in outputs:
+                qc_files.extend(_rmsmap_save(sr, outputs.pop('rms'), bin_file.parent))
+            if 'saturation' in outputs:
+                sat = outputs.pop('saturation')
+                nsat = np.sum(sat['count'] > 0)
+                if nsat:
+                    _logger.warning(f'{bin_file.name}: {nsat} channels saturated, up to '
+                                    f'{np.max(sat["count"]) / sat["nsamples"]:.2%} of samples')
+    return sync_files, qc_files
+
+
 def validate_ttl_test(ses_path, display=False):
     """
     For a mock session on the Ephys Choice world task, check the sync channels for all
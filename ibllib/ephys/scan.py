@@ -0,0 +1,196 @@
+"""
+Single pass scan of raw electrophysiology binary files.
+
+The raw file is read sequentially, chunk by chunk, and each decoded chunk is handed to all the
+registered consumers (sync fronts detection, RMS / spectral QC, saturation checks or user
+callbacks). This way, a session only needs one read of the raw data whatever the number of
+computations performed on it.
+
+>>> sr = spikeglx.Reader(ap_file)
+>>> rms, sat = scan(sr, [ephysqc.RmsMapConsumer(), SaturationConsumer()])
+"""
+import abc
+import logging
+
+import numpy as np
+
+import ibllib.dsp as dsp
+from ibllib.io import spikeglx
+from ibllib.misc import print_progress
+
+_logger = logging.getLogger('ibllib')
+
+SCAN_BATCH_SIZE_SECS = 3  # approximate duration of chunks read at once in the bin file
+
+
+class ScanConsumer(abc.ABC):
+    """
+    Base class for objects registered to a raw data scan.
+    The scan calls `setup` once with the reader, then `process` for each chunk of raw samples
+    in sequential order and finally `finalize` whose output is returned by the scan.
+    """
+    sr = None
+
+    def setup(self, sr):
+        """
+        :param sr: spikeglx.Reader object of the scanned file
+        """
+        self.sr = sr
+
+    @abc.abstractmethod
+    def process(self, raw, first, last):
+        """
+        :param raw: int16 array (last - first, nc) of raw samples as stored in the binary file
+        :param first: index of the first sample of the chunk
+        :param last: index of the last sample of the chunk, python slice-wise
+        """
+
+    def finalize(self):
+        """
+        :return: output of the consumer
+        """
+
+
+class WindowedConsumer(ScanConsumer):
+    """
+    Consumer working on its own windowing of the file, independent of the scan chunk size.
+    Samples are buffered across scan chunks so that `process_window` is called with exactly the
+    windows yielded by `window_generator`, as if they were read one by one from the file.
+    """
+
+    @abc.abstractmethod
+    def window_generator(self, sr):
+        """
+        :param sr: spikeglx.Reader object of the scanned file
+        :return: dsp.WindowGenerator object
+        """
+
+    @abc.abstractmethod
+    def process_window(self, samples, first, last):
+        """
+        :param samples: array (last - first, ncolumns) output of `select` for the window
+        :param first: index of the first sample of the window
+        :param last: index of the last sample of the window, python slice-wise
+        """
+
+    def select(self, raw):
+        """
+        Reduces raw samples to the columns needed by the consumer before buffering.
+        :param raw: int16 array (nsamples, nc)
+        :return: array (nsamples, ncolumns)
+        """
+        return raw
+
+    def setup(self, sr):
+        super(WindowedConsumer, self).setup(sr)
+        self.wg = self.window_generator(sr)
+        self._windows = self.wg.firstlast
+        self._window = next(self._windows, None)
+        self._buffer = None
+        self._buffer_first = 0
+
+    def process(self, raw, first, last):
+        samples = self.select(raw)
+        if self._buffer is None or self._buffer.shape[0] == 0:
+            self._buffer, self._buffer_first = samples, first
+        else:
+            self._buffer = np.concatenate((self._buffer, samples), axis=0)
+        while self._window is not None and self._window[1] <= last:
+            wfirst, wlast = self._window
+            i0 = wfirst - self._buffer_first
+            self.process_window(self._buffer[i0:i0 + wlast - wfirst], wfirst, wlast)
+            self._window = next(self._windows, None)
+        # only keep the samples needed for the next windows
+        if self._window is None:
+            self._buffer = None
+        else:
+            i0 = self._window[0] - self._buffer_first
+            self._buffer, self._buffer_first = self._buffer[i0:], self._window[0]
+
+
+class CallbackConsumer(ScanConsumer):
+    """
+    Wraps a user function called on each chunk of the scan.
+
+    >>> maxs = []
+    >>> scan(sr, [CallbackConsumer(lambda raw, first, last: maxs.append(raw.max(axis=0)))])
+    """
+
+    def __init__(self, callback, volts=False):
+        """
+        :param callback: function called with (data, first, last) on each chunk
+        :param volts: (False) if True, data is converted to Volts (float32), raw int16 otherwise
+        """
+        self.callback = callback
+        self.volts = volts
+
+    def setup(self, sr):
+        super(CallbackConsumer, self).setup(sr)
+        self.outputs = []
+
+    def process(self, raw, first, last):
+        data = self.sr._raw2v(raw) if self.volts else raw
+        self.outputs.append(self.callback(data, first, last))
+
+    def finalize(self):
+        """
+        :return: list of the callback outputs for each chunk
+        """
+        return self.outputs
+
+
+class SaturationConsumer(ScanConsumer):
+    """
+    Counts the samples that reach the range of the analog to digital converter on each channel.
+    The sync channels are not checked.
+    """
+
+    def setup(self, sr):
+        super(SaturationConsumer, self).setup(sr)
+        # the imec ADC is 10 bits whereas the nidq is 16 bits
+        self.adc_max = 512 if sr.type in ['ap', 'lf'] else 32768
+        self.csel = np.setdiff1d(np.arange(sr.nc),
+                                 spikeglx._get_sync_trace_indices_from_meta(sr.meta))
+        self.count = np.zeros(self.csel.size, dtype=np.int64)
+        self.ns = 0
+
+    def process(self, raw, first, last):
+        samples = raw[:, self.csel]
+        self.count += np.sum(np.logical_or(samples >= self.adc_max - 1,
+                                           samples <= - self.adc_max), axis=0)
+        self.ns += last - first
+
+    def finalize(self):
+        """
+        :return: dictionary with the number of saturated samples per channel, the checked
+         channels indices and the total number of samples scanned
+        """
+        return {'count': self.count, 'channels': self.csel, 'nsamples': self.ns}
+
+
+def scan(sr, consumers, nswin=None):
+    """
+    Reads the raw binary file sequentially, once, and hands each chunk of samples to all
+    consumers.
+
+    :param sr: spikeglx.Reader object, or path to the binary file
+    :param consumers: list of ScanConsumer objects
+    :param nswin: number of samples read at once. Defaults to the power of 2 closest to
+     SCAN_BATCH_SIZE_SECS
+    :return: list of consumers outputs, in the same order as the consumers
+    """
+    if not isinstance(sr, spikeglx.Reader):
+        sr = spikeglx.Reader(sr)
+    if nswin is None:
+        nswin = 2 ** np.ceil(np.log2(sr.fs * SCAN_BATCH_SIZE_SECS))
+    for consumer in consumers:
+        consumer.setup(sr)
+    wg = dsp.WindowGenerator(ns=sr.ns, nswin=nswin, overlap=0)
+    _logger.info(f"Scanning {sr.file_bin} with {len(consumers)} consumers")
+    for first, last in wg.firstlast:
+        # copy the chunk in memory so that memmaps are read only once for all consumers
+        raw = np.array(sr._raw[first:last, :])
+        for consumer in consumers:
+            consumer.process(raw, first, last)
+        print_progress(wg.iw, wg.nwin)
+    return [consumer.finalize() for consumer in consumers]
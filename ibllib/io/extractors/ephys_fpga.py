@@ -14,6 +14,7 @@ import alf.io
 from brainbox.core import Bunch
 import ibllib.dsp as dsp
 import ibllib.exceptions as err
+from ibllib.ephys import scan
 from ibllib.io import raw_data_loaders, spikeglx
 from ibllib.io.extractors import biased_trials
 from ibllib.io.extractors.base import (
@@ -80,6 +81,54 @@ def get_ibl_sync_map(ef, version):
     return spikeglx.get_sync_map(ef['path']) or default_chmap
 
 
+class SyncFrontsConsumer(scan.WindowedConsumer):
+    """
+    Detects the fronts of the sync traces while scanning a raw binary file, see `_sync_to_alf`.
+    Fronts are swapped to a temporary file in `output_path` as they may not fit in memory.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = Path(output_path)
+
+    def window_generator(self, sr):
+        return dsp.WindowGenerator(sr.ns, int(SYNC_BATCH_SIZE_SECS * sr.fs), overlap=1)
+
+    def setup(self, sr):
+        super(SyncFrontsConsumer, self).setup(sr)
+        self.digital = spikeglx._get_sync_trace_indices_from_meta(sr.meta)
+        self.analog = spikeglx._get_analog_sync_trace_indices_from_meta(sr.meta)
+        self.file_ftcp = self.output_path.joinpath(
+            f'fronts_times_channel_polarity{str(uuid.uuid4())}.bin')
+        self.fid_ftcp = open(self.file_ftcp, 'wb')
+
+    def select(self, raw):
+        # only the sync traces are buffered
+        return raw[:, self.digital + self.analog]
+
+    def process_window(self, samples, first, last):
+        # same as spikeglx.Reader.read_sync on the window
+        nd = len(self.digital)
+        digital = spikeglx.split_sync(samples[:, :nd])
+        analog = self.sr._raw2v(samples[:, nd:], csel=self.analog) if self.analog else None
+        ss = spikeglx._merge_sync_traces(digital, analog)
+        ind, fronts = dsp.fronts(ss, axis=0)
+        sav = np.c_[(ind[0, :] + first) / self.sr.fs, ind[1, :], fronts.astype(np.double)]
+        sav.tofile(self.fid_ftcp)
+
+    def finalize(self):
+        """
+        :return: Bunch with sync times, channels and polarities
+        """
+        # close temp file, read from it and delete
+        self.fid_ftcp.close()
+        tim_chan_pol = np.fromfile(str(self.file_ftcp))
+        tim_chan_pol = tim_chan_pol.reshape((int(tim_chan_pol.size / 3), 3))
+        self.file_ftcp.unlink()
+        return Bunch({'times': tim_chan_pol[:, 0],
+                      'channels': tim_chan_pol[:, 1],
+                      'polarities': tim_chan_pol[:, 2]})
+
+
 def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
     """
     Extracts sync.times, sync.channels and sync.polarities from binary ephys dataset
@@ -98,28 +147,9 @@ def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
         sr = spikeglx.Reader(raw_ephys_apfile)
     # if no output, need a temp folder to swap for big files
     if not output_path:
-        output_path = raw_ephys_apfile.parent
-    file_ftcp = Path(output_path).joinpath(f'fronts_times_channel_polarity{str(uuid.uuid4())}.bin')
-
+        output_path = sr.file_bin.parent
     # loop over chunks of the raw ephys file
-    wg = dsp.WindowGenerator(sr.ns, int(SYNC_BATCH_SIZE_SECS * sr.fs), overlap=1)
-    fid_ftcp = open(file_ftcp, 'wb')
-    for sl in wg.slice:
-        ss = sr.read_sync(sl)
-        ind, fronts = dsp.fronts(ss, axis=0)
-        # a = sr.read_sync_analog(sl)
-        sav = np.c_[(ind[0, :] + sl.start) / sr.fs, ind[1, :], fronts.astype(np.double)]
-        sav.tofile(fid_ftcp)
-        # print progress
-        wg.print_progress()
-    # close temp file, read from it and delete
-    fid_ftcp.close()
-    tim_chan_pol = np.fromfile(str(file_ftcp))
-    tim_chan_pol = tim_chan_pol.reshape((int(tim_chan_pol.size / 3), 3))
-    file_ftcp.unlink()
-    sync = {'times': tim_chan_pol[:, 0],
-            'channels': tim_chan_pol[:, 1],
-            'polarities': tim_chan_pol[:, 2]}
+    sync = scan.scan(sr, [SyncFrontsConsumer(output_path)])[0]
     if save:
         out_files = alf.io.save_object_npy(output_path, sync, '_spikeglx_sync', parts=parts)
         return Bunch(sync), out_files
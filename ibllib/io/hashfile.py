@@ -1,40 +1,245 @@
+import concurrent.futures
+import contextlib
 import hashlib
+import logging
+import sqlite3
+import threading
 from pathlib import Path
 
 import numpy as np
 from tqdm import tqdm
 
+from ibllib.io import params
+
+_logger = logging.getLogger('ibllib')
+
 BUF_SIZE = 2 ** 28  # 256 megs
+FOLLOW_BUF_SIZE = 2 ** 22  # 4 megs, read size when hashing a file being written
+THREAD_BUF_SIZE = 2 ** 22  # 4 megs, read size of each thread when hashing files in parallel
+FOLLOW_POLL = 0.1  # seconds between reads when waiting for a file being written
+HASH_THREADS = 4  # hashlib releases the GIL so files are hashed in parallel in threads
+CACHE_FILE = params.getfile('ibl_hash_cache.sqlite')
 
 
-def md5(file_path):
+def md5(file_path, cache=False):
     """
     Computes md5 hash in a memory reasoned way
     md5hash = hashfile.md5(file_path)
+    :param cache: if True, the hash is read from/written to the persistent hash cache
     """
-    return _hash_file(file_path, hashlib.md5())
+    return _cached_hash(file_path, 'md5', cache=cache)
 
 
-def sha1(file_path):
+def sha1(file_path, cache=False):
     """
     Computes sha1 hash in a memory reasoned way
     md5hash = hashfile.sha1(file_path)
+    :param cache: if True, the hash is read from/written to the persistent hash cache
+    """
+    return _cached_hash(file_path, 'sha1', cache=cache)
+
+
+def hash_files(file_list, algorithm='md5', nthreads=HASH_THREADS, cache=True, max_size=None):
+    """
+    Computes the hashes of a list of files in parallel.
+    hashes = hashfile.hash_files(file_list)
+
+    :param file_list: list of files
+    :param algorithm: 'md5' or 'sha1'
+    :param nthreads: number of files hashed concurrently
+    :param cache: if True, the hashes of unchanged files are read from the persistent hash cache
+     and computed hashes are written to it
+    :param max_size: if specified, files above this size in bytes are not hashed unless their
+     hash is in the cache, and their hash is None
+    :return: list of hex digests, in the order of the file list
+    """
+    hash_cache = HashCache() if cache else None
+
+    def _hash(file_path):
+        if hash_cache is not None:
+            hash = hash_cache.get(file_path, algorithm)
+            if hash is not None:
+                return hash
+        if max_size and Path(file_path).stat().st_size >= max_size:
+            return
+        # a small buffer per thread and no progress bar as several files are hashed at once
+        kwargs = dict(buf_size=THREAD_BUF_SIZE, progress_bar=False)
+        if hash_cache is None:
+            return _hash_file(file_path, hashlib.new(algorithm), **kwargs)
+        return _hash_and_cache(file_path, algorithm, hash_cache, **kwargs)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+        return list(executor.map(_hash, file_list))
+
+
+def _cached_hash(file_path, algorithm, cache=False):
+    """
+    :param cache: bool or HashCache instance
+    """
+    if not cache:
+        return _hash_file(file_path, hashlib.new(algorithm))
+    hash_cache = cache if isinstance(cache, HashCache) else HashCache()
+    hash = hash_cache.get(file_path, algorithm)
+    if hash is None:
+        hash = _hash_and_cache(file_path, algorithm, hash_cache)
+    return hash
+
+
+def _hash_and_cache(file_path, algorithm, hash_cache, **kwargs):
+    """
+    Hashes the file and writes the hash to the cache
+    :param kwargs: _hash_file parameters
     """
-    return _hash_file(file_path, hashlib.sha1())
+    stat = Path(file_path).stat()
+    hash = _hash_file(file_path, hashlib.new(algorithm), **kwargs)
+    # do not cache the hash if the file changed while hashing
+    if _stat_key(Path(file_path).stat()) == _stat_key(stat):
+        hash_cache.set(file_path, hash, algorithm, stat=stat)
+    return hash
 
 
-def _hash_file(file_path, hash_obj, progress_bar=None):
+def _hash_file(file_path, hash_obj, progress_bar=None, buf_size=BUF_SIZE):
     file_path = Path(file_path)
     file_size = file_path.stat().st_size
     # by default prints a progress bar only for files above 512 Mo
     if progress_bar is None:
         progress_bar = file_size > (512 * 1024 * 1024)
-    b = bytearray(BUF_SIZE)
+    b = bytearray(buf_size)
     mv = memoryview(b)
-    pbar = tqdm(total=np.ceil(file_size / BUF_SIZE), disable=not progress_bar)
+    pbar = tqdm(total=np.ceil(file_size / buf_size), disable=not progress_bar)
     with open(file_path, 'rb', buffering=0) as f:
         for n in iter(lambda: f.readinto(mv), 0):
             hash_obj.update(mv[:n])
             pbar.update(1)
     pbar.close()
     return hash_obj.hexdigest()
+
+
+def _stat_key(stat):
+    return stat.st_size, stat.st_mtime_ns
+
+
+class HashCache:
+    """
+    Persistent cache of file hashes keyed by (path, algorithm), valid as long as the file size
+    and modification time are unchanged. Stored in a sqlite database that can be shared
+    between processes. Errors accessing the database are logged and treated as cache misses.
+    """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = Path(cache_file or CACHE_FILE)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.cache_file, timeout=60)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT, algorithm TEXT, "
+                         "size INTEGER, mtime_ns INTEGER, hash TEXT, "
+                         "PRIMARY KEY (path, algorithm))")
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, file_path, algorithm='md5'):
+        """
+        :return: the cached hash of the file, None if the file changed or is not in the cache
+        """
+        size, mtime_ns = _stat_key(Path(file_path).stat())
+        try:
+            with self._connect() as conn:
+                rec = conn.execute(
+                    "SELECT hash FROM hashes WHERE path=? AND algorithm=? AND size=? "
+                    "AND mtime_ns=?", (_key(file_path), algorithm, size, mtime_ns)).fetchone()
+        except sqlite3.Error as e:
+            _logger.warning(f'Hash cache {self.cache_file} unavailable: {e}')
+            return
+        return rec[0] if rec else None
+
+    def set(self, file_path, hash, algorithm='md5', stat=None):
+        """
+        :param stat: os.stat_result of the file when hashed (default: current)
+        """
+        size, mtime_ns = _stat_key(stat or Path(file_path).stat())
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                             (_key(file_path), algorithm, size, mtime_ns, hash))
+        except sqlite3.Error as e:
+            _logger.warning(f'Hash cache {self.cache_file} unavailable: {e}')
+
+
+def _key(file_path):
+    return str(Path(file_path).resolve())
+
+
+class _FileFollower(threading.Thread):
+    """
+    Hashes a file while it is being written sequentially, until the done event is set
+    """
+
+    def __init__(self, file_path, algorithm='md5'):
+        super().__init__(daemon=True)
+        self.file_path = Path(file_path)
+        self.hash_obj = hashlib.new(algorithm)
+        self.nbytes = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            while not self.file_path.exists():
+                if self.done.wait(FOLLOW_POLL) and not self.file_path.exists():
+                    return
+            mv = memoryview(bytearray(FOLLOW_BUF_SIZE))
+            with open(self.file_path, 'rb', buffering=0) as f:
+                while True:
+                    # if the writer was done before the read, an empty read is the end of file
+                    finished = self.done.is_set()
+                    n = f.readinto(mv)
+                    if n:
+                        self.hash_obj.update(mv[:n])
+                        self.nbytes += n
+                    elif finished:
+                        break
+                    else:
+                        self.done.wait(FOLLOW_POLL)
+        except Exception as e:
+            self.error = e
+
+    def hexdigest(self):
+        return self.hash_obj.hexdigest()
+
+
+@contextlib.contextmanager
+def hash_while_writing(file_path, algorithm='md5', register_as=None, cache_file=None):
+    """
+    Hashes a file while it is written in the context, and stores the hash in the persistent
+    hash cache so that subsequent hashing/registration of the file is immediate.
+    The file has to be written sequentially from the beginning, it may not exist before.
+
+    >>> with hashfile.hash_while_writing(file_tmp, register_as=file_out) as hasher:
+    ...     compress(file_in, out=file_tmp)
+    >>> file_tmp.rename(file_out)
+
+    :param file_path: file being written
+    :param algorithm: 'md5' or 'sha1'
+    :param register_as: path under which the hash is cached, if the file is renamed afterwards
+    :param cache_file: optional hash cache sqlite file
+    :return: the follower thread, its hexdigest() method gives the hash after the context
+    """
+    follower = _FileFollower(file_path, algorithm)
+    follower.start()
+    try:
+        yield follower
+    finally:
+        follower.done.set()
+        follower.join()
+    file_path = Path(file_path)
+    # the writer rewinding or truncating the file would result in a wrong hash
+    if follower.error is not None or not file_path.exists() or \
+            file_path.stat().st_size != follower.nbytes:
+        _logger.warning(f'Could not hash {file_path} while writing: {follower.error}')
+        return
+    HashCache(cache_file).set(register_as or file_path, follower.hexdigest(), algorithm,
+                              stat=file_path.stat())
@@ -1,19 +1,51 @@
 from collections import namedtuple
 import ast
 
+import numpy as np
+
+NpyHeader = namedtuple('npy_header',
+                       'magic_string, version, header_len, descr, fortran_order, shape')
 
-def read(filename):
-    header = namedtuple('npy_header',
-                        'magic_string, version, header_len, descr, fortran_order, shape')
 
+def read(filename):
+    """
+    Reads the header of a npy file without loading the data
+    :param filename: npy file
+    :return: npy_header namedtuple (magic_string, version, header_len, descr, fortran_order,
+     shape). The data starts at byte offset(header)
+    """
     with open(filename, 'rb') as fid:
-        header.magic_string = fid.read(6)
-        header.version = fid.read(2)
-        header.header_len = int.from_bytes(fid.read(2), byteorder='little')
-        d = ast.literal_eval(fid.read(header.header_len).decode())
+        magic_string = fid.read(6)
+        if magic_string != b'\x93NUMPY':
+            raise ValueError(f'{filename} is not a npy file')
+        version = fid.read(2)
+        # version 1 stores the header length on 2 bytes, versions 2 and 3 on 4 bytes
+        nbytes = 2 if version[0] == 1 else 4
+        header_len = int.from_bytes(fid.read(nbytes), byteorder='little')
+        d = ast.literal_eval(fid.read(header_len).decode('latin1' if version[0] < 3 else 'utf8'))
+    return NpyHeader(magic_string=magic_string, version=version, header_len=header_len,
+                     descr=d['descr'], fortran_order=d['fortran_order'], shape=d['shape'])
+
+
+def offset(header):
+    """
+    :param header: npy_header namedtuple
+    :return: byte offset of the data in the file
+    """
+    return 6 + 2 + (2 if header.version[0] == 1 else 4) + header.header_len
+
+
+def dtype(header):
+    """
+    :param header: npy_header namedtuple
+    :return: numpy dtype of the array
+    """
+    return np.lib.format.descr_to_dtype(header.descr)
 
-    for k in d.keys():
-        print(k)
-        setattr(header, k, d[k])
 
-    return header
+def nbytes(header):
+    """
+    :param header: npy_header namedtuple
+    :return: size of the array data in bytes
+    """
+    return int(np.prod(header.shape)) * dtype(header).itemsize
@@ -1,7 +1,10 @@
+from collections import OrderedDict
+import concurrent.futures
 import json
 import logging
 from pathlib import Path
 import re
+import threading
 
 import numpy as np
 
@@ -12,16 +15,130 @@ from ibllib.io import hashfile
 
 SAMPLE_SIZE = 2  # int16
 DEFAULT_BATCH_SIZE = 1e6
+MTSCOMP_NTHREADS = 4  # number of threads decompressing mtscomp chunks
+MTSCOMP_CACHE_SIZE = 16  # maximum number of decompressed mtscomp chunks kept in memory
+WAVEFORMS_BATCH_SIZE = 2 ** 15  # maximum number of samples read at once to extract waveforms
 _logger = logging.getLogger('ibllib')
 
 
+class _MtscompReader(mtscomp.Reader):
+    """
+    mtscomp reader decompressing chunks in a thread pool, with a bounded LRU cache of decompressed
+    chunks for random access and read-ahead of the next chunks for sequential scans.
+    All chunks needed by a slice are decompressed in parallel, and repeated reads within the same
+    chunk (ie. waveforms snippets) only cost one decompression.
+    """
+
+    def __init__(self, nthreads=MTSCOMP_NTHREADS, cache_size=MTSCOMP_CACHE_SIZE,
+                 read_ahead=None, **kwargs):
+        """
+        :param nthreads: number of decompression threads
+        :param cache_size: maximum number of decompressed chunks kept in memory
+        :param read_ahead: number of chunks decompressed in advance when reading sequentially,
+         defaults to the number of threads
+        """
+        super(_MtscompReader, self).__init__(**kwargs)
+        self.nthreads = nthreads
+        self.cache_size = cache_size
+        self.read_ahead = nthreads if read_ahead is None else read_ahead
+        self._cache = OrderedDict()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._last_chunk = None
+        self.n_decompressed = 0
+
+    def set_cache_size(self, cache_size=None):
+        # the cache is handled by _get_chunk, do not wrap read_chunk in the mtscomp lru cache
+        self.cache_size = cache_size or self.cache_size
+
+    def _decompress(self, chunk_idx):
+        chunk_start = self.chunk_offsets[chunk_idx]
+        chunk_length = self.chunk_offsets[chunk_idx + 1] - chunk_start
+        with self._lock:
+            self.n_decompressed += 1
+        return mtscomp.Reader.read_chunk(self, chunk_idx, chunk_start, chunk_length)
+
+    def _submit(self, chunk_idx):
+        """ schedules the decompression of a chunk if needed. Must be called within the lock """
+        if chunk_idx in self._cache or chunk_idx in self._futures:
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads)
+        self._futures[chunk_idx] = self._executor.submit(self._decompress, chunk_idx)
+
+    def _get_chunk(self, chunk_idx):
+        with self._lock:
+            if chunk_idx in self._cache:
+                self._cache.move_to_end(chunk_idx)
+                return self._cache[chunk_idx]
+            self._submit(chunk_idx)
+            future = self._futures[chunk_idx]
+        chunk = future.result()
+        with self._lock:
+            self._futures.pop(chunk_idx, None)
+            self._cache[chunk_idx] = chunk
+            self._cache.move_to_end(chunk_idx)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return chunk
+
+    def read_chunk(self, chunk_idx, chunk_start, chunk_length):
+        return self._get_chunk(chunk_idx)
+
+    def prefetch(self, first_sample, last_sample):
+        """
+        Schedules the decompression of all chunks containing samples in [first_sample, last_sample[
+        :return: first and last chunk indices, None if the interval is empty
+        """
+        i0 = self._validate_index(first_sample, 0)
+        i1 = self._validate_index(last_sample, self.n_samples)
+        if i1 <= i0:
+            return
+        first_chunk, last_chunk = self._chunks_for_interval(i0, i1)
+        with self._lock:
+            for chunk_idx in range(first_chunk, last_chunk + 1):
+                self._submit(chunk_idx)
+        return first_chunk, last_chunk
+
+    def __getitem__(self, item):
+        nsel = item[0] if isinstance(item, tuple) else item
+        # decompress all the chunks of the slice in parallel
+        chunks = self.prefetch(nsel.start, nsel.stop) if isinstance(nsel, slice) else None
+        if chunks is not None:
+            first_chunk, last_chunk = chunks
+            # sequential access: decompress the next chunks in advance
+            sequential = self._last_chunk is not None and \
+                first_chunk in (self._last_chunk, self._last_chunk + 1)
+            if sequential:
+                last_ahead = min(last_chunk + 1 + self.read_ahead, self.n_chunks)
+                with self._lock:
+                    for chunk_idx in range(last_chunk + 1, last_ahead):
+                        self._submit(chunk_idx)
+            self._last_chunk = last_chunk
+        return super(_MtscompReader, self).__getitem__(item)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._cache = OrderedDict()
+        self._futures = {}
+        super(_MtscompReader, self).close()
+
+
 class Reader:
     """
     Class for SpikeGLX reading purposes
     Some format description was found looking at the Matlab SDK here
     https://github.com/billkarsh/SpikeGLX/blob/master/MATLAB-SDK/DemoReadSGLXData.m
     """
-    def __init__(self, sglx_file):
+    def __init__(self, sglx_file, nthreads=MTSCOMP_NTHREADS, cache_size=MTSCOMP_CACHE_SIZE):
+        """
+        :param sglx_file: path to the binary file (.bin) or mtscomp compressed file (.cbin)
+        :param nthreads: number of threads used to decompress mtscomp chunks
+        :param cache_size: number of decompressed mtscomp chunks kept in memory
+        """
         self.file_bin = Path(sglx_file)
         self.nbytes = self.file_bin.stat().st_size
         file_meta_data = Path(sglx_file).with_suffix('.meta')
@@ -37,7 +154,7 @@ class Reader:
         self.channel_conversion_sample2v = _conversion_sample2v_from_meta(self.meta)
         # if we are not looking at a compressed file, use a memmap, otherwise instantiate mtscomp
         if self.is_mtscomp:
-            self._raw = mtscomp.Reader()
+            self._raw = _MtscompReader(nthreads=nthreads, cache_size=cache_size)
             self._raw.open(self.file_bin, self.file_bin.with_suffix('.ch'))
         else:
             if self.nc * self.ns * 2 != self.nbytes:
@@ -107,13 +224,23 @@ class Reader:
         :param slice_c: slice or channel indices
         :return: float32 array
         """
-        darray = np.float32(self._raw[nsel, csel])
-        darray *= self.channel_conversion_sample2v[self.type][csel]
+        darray = self._raw2v(self._raw[nsel, csel], csel=csel)
         if sync:
             return darray, self.read_sync(nsel)
         else:
             return darray
 
+    def _raw2v(self, samples, csel=slice(None)):
+        """
+        Converts raw int16 samples to Volts
+        :param samples: int16 array (nsamples, nchannels) as stored in the binary file
+        :param csel: slice or channel indices of the samples columns
+        :return: float32 array
+        """
+        darray = np.float32(samples)
+        darray *= self.channel_conversion_sample2v[self.type][csel]
+        return darray
+
     def read_samples(self, first_sample=0, last_sample=10000, channels=None):
         """
         reads all channels from first_sample to last_sample, following numpy slicing convention
@@ -129,6 +256,63 @@ class Reader:
             channels = slice(None)
         return self.read(slice(first_sample, last_sample), channels)
 
+    def read_waveforms(self, sample_indices, channels=None, window=(-30, 30), out=None):
+        """
+        Extracts snippets of data around sample indices, ie. spike waveforms.
+        Requests are sorted by file offset and overlapping or close snippets are read at once, so
+        that each part of the file is read only once. The conversion to Volts is applied once per
+        batch of snippets.
+
+        >>> wfs = sr.read_waveforms(spike_samples, channels=np.arange(10, 20), window=(-30, 52))
+
+        :param sample_indices: (nspikes,) array of sample indices around which to read the data
+        :param channels: (nchannels,) channel indices common to all snippets, or
+         (nspikes, nchannels) array of channel indices for each snippet. Defaults to all channels
+        :param window: (first, last) sample offsets relative to the sample index, python
+         slice-wise. Samples out of the file are set to 0
+        :param out: optional output, either a float32 array of shape
+         (nspikes, last - first, nchannels) or a file path. If a path is provided, the output is
+         a npy file opened as a memmap, which allows extracting waveforms for millions of spikes
+        :return: float32 array (nspikes, last - first, nchannels)
+        """
+        sample_indices = np.asarray(sample_indices, dtype=np.int64).flatten()
+        channels = np.arange(self.nc) if channels is None else np.asarray(channels)
+        nspikes, nsw = (sample_indices.size, window[1] - window[0])
+        shape = (nspikes, nsw, channels.shape[-1])
+        if out is None:
+            out = np.zeros(shape, dtype=np.float32)
+        elif isinstance(out, (str, Path)):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float32, shape=shape)
+        assert out.shape == shape
+        if nspikes == 0:
+            return out
+        # sort the requests by file offset and group the close ones in batches
+        order = np.argsort(sample_indices, kind='stable')
+        first = sample_indices[order] + window[0]
+        breaks = np.r_[True, first[1:] > first[:-1] + 2 * nsw]
+        group_first = first[np.maximum.accumulate(np.where(breaks, np.arange(nspikes), 0))]
+        batch = np.cumsum(breaks) * (self.ns // WAVEFORMS_BATCH_SIZE + 1) + \
+            (first - group_first) // WAVEFORMS_BATCH_SIZE
+        ibatches = np.r_[0, np.where(np.diff(batch))[0] + 1, nspikes]
+        iw = np.arange(nsw)
+        for i0, i1 in zip(ibatches[:-1], ibatches[1:]):
+            b0, b1 = (max(first[i0], 0), min(first[i1 - 1] + nsw, self.ns))
+            if b1 <= b0:
+                continue
+            isamp = first[i0:i1, np.newaxis] + iw - b0
+            valid = np.logical_and(isamp >= 0, isamp < b1 - b0)
+            isamp = np.clip(isamp, 0, b1 - b0 - 1)
+            raw = self._raw[b0:b1, :]
+            if channels.ndim == 1:
+                wfs = self._raw2v(raw[:, channels][isamp], csel=channels)
+            else:
+                csel = channels[order[i0:i1]]
+                wfs = np.float32(raw[isamp[:, :, np.newaxis], csel[:, np.newaxis, :]])
+                wfs *= self.channel_conversion_sample2v[self.type][csel][:, np.newaxis, :]
+            wfs[~valid] = 0
+            out[order[i0:i1]] = wfs
+        return out
+
     def read_sync_digital(self, _slice=slice(0, 10000)):
         """
         Reads only the digital sync trace at specified samples using slicing syntax
@@ -162,13 +346,8 @@ class Reader:
         """
         digital = self.read_sync_digital(_slice)
         analog = self.read_sync_analog(_slice)
-        if analog is not None and floor_percentile:
-            analog -= np.percentile(analog, 10, axis=0)
-        if analog is None:
-            return digital
-        analog[np.where(analog < threshold)] = 0
-        analog[np.where(analog >= threshold)] = 1
-        return np.concatenate((digital, np.int8(analog)), axis=1)
+        return _merge_sync_traces(digital, analog, threshold=threshold,
+                                  floor_percentile=floor_percentile)
 
     def compress_file(self, keep_original=True, **kwargs):
         """
@@ -179,15 +358,19 @@ class Reader:
         :return: pathlib.Path of the compressed *.cbin file
         """
         file_tmp = self.file_bin.with_suffix('.cbin_tmp')
-        assert not self.is_mtscomp
-        mtscomp.compress(self.file_bin,
-                         out=file_tmp,
-                         outmeta=self.file_bin.with_suffix('.ch'),
-                         sample_rate=self.fs,
-                         n_channels=self.nc,
-                         dtype=np.int16,
-                         **kwargs)
         file_out = file_tmp.with_suffix('.cbin')
+        assert not self.is_mtscomp
+        if file_tmp.exists():
+            file_tmp.unlink()
+        # the compressed file is hashed while written so that its registration is immediate
+        with hashfile.hash_while_writing(file_tmp, register_as=file_out):
+            mtscomp.compress(self.file_bin,
+                             out=file_tmp,
+                             outmeta=self.file_bin.with_suffix('.ch'),
+                             sample_rate=self.fs,
+                             n_channels=self.nc,
+                             dtype=np.int16,
+                             **kwargs)
         file_tmp.rename(file_out)
         if not keep_original:
             self.file_bin.unlink()
@@ -228,7 +411,7 @@ class Reader:
             sm = sm.upper()
         else:
             sm = self.meta.fileSHA1
-        sc = hashfile.sha1(self.file_bin).upper()
+        sc = hashfile.sha1(self.file_bin, cache=True).upper()
         if sm == sc:
             log_func = _logger.info
         else:
@@ -416,6 +599,25 @@ def _conversion_sample2v_from_meta(meta_data):
     return out
 
 
+def _merge_sync_traces(digital, analog, threshold=1.2, floor_percentile=10):
+    """
+    Convert analog sync traces to digital with selected threshold and append to digital traces
+    :param digital: int8 array of split digital sync traces (see split_sync)
+    :param analog: float32 array of analog sync traces in Volts, or None
+    :param threshold: (V) threshold for front detection, defaults to 1.2 V
+    :param floor_percentile: 10% removes the percentile value of the analog trace before
+     thresholding. This is to avoid DC offset drift
+    :return: int8 array
+    """
+    if analog is not None and floor_percentile:
+        analog -= np.percentile(analog, 10, axis=0)
+    if analog is None:
+        return digital
+    analog[np.where(analog < threshold)] = 0
+    analog[np.where(analog >= threshold)] = 1
+    return np.concatenate((digital, np.int8(analog)), axis=1)
+
+
 def split_sync(sync_tr):
     """
     The synchronization channels are stored as single bits, this will split the int16 original
@@ -15,7 +15,7 @@ class EphysAlignment:
                  feature_prev=None, brain_atlas=None):
 
         if not brain_atlas:
-            self.brain_atlas = atlas.AllenAtlas(25)
+            self.brain_atlas = atlas.get_allen_atlas(25)
         else:
             self.brain_atlas = brain_atlas
 
@@ -211,7 +211,7 @@ class EphysAlignment:
         :type region_id: np.array((n_bound))
         """
         if not brain_atlas:
-            brain_atlas = atlas.AllenAtlas(25)
+            brain_atlas = atlas.get_allen_atlas(25)
 
         region_ids = brain_atlas.get_labels(xyz_coords)
         region_info = brain_atlas.regions.get(region_ids)
@@ -262,7 +262,7 @@ class EphysAlignment:
         :type nearest_bound: dict
         """
         if not brain_atlas:
-            brain_atlas = atlas.AllenAtlas(25)
+            brain_atlas = atlas.get_allen_atlas(25)
 
         vector = atlas.Insertion.from_track(xyz_coords, brain_atlas=brain_atlas).trajectory.vector
         nearest_bound = dict()
@@ -277,55 +277,56 @@ class EphysAlignment:
             # nearest_bound['parent_adj_id'] = np.zeros((xyz_coords.shape[0]))
             nearest_bound['parent_col'] = []
 
-        for iP, point in enumerate(xyz_coords):
-            d = np.dot(vector, point)
-            x_vals = np.r_[np.linspace(point[0] - extent / 1e6, point[0] + extent / 1e6, steps),
-                           point[0]]
-            y_vals = np.r_[np.linspace(point[1] - extent / 1e6, point[1] + extent / 1e6, steps),
-                           point[1]]
-
-            X, Y = np.meshgrid(x_vals, y_vals)
-            Z = (d - vector[0] * X - vector[1] * Y) / vector[2]
-            XYZ = np.c_[np.reshape(X, X.size), np.reshape(Y, Y.size), np.reshape(Z, Z.size)]
-            dist = np.sqrt(np.sum((XYZ - point) ** 2, axis=1))
-
-            try:
-                brain_id = brain_atlas.regions.get(brain_atlas.get_labels(XYZ))['id']
-            except Exception as err:
-                print(err)
-                continue
-
-            dist_sorted = np.argsort(dist)
-            brain_id_sorted = brain_id[dist_sorted]
-            nearest_bound['id'][iP] = brain_id_sorted[0]
-            nearest_bound['col'].append(allen['color_hex_triplet'][np.where(allen['id'] ==
-                                                                   brain_id_sorted[0])[0][0]])
-            bound_idx = np.where(brain_id_sorted != brain_id_sorted[0])[0]
-            if np.any(bound_idx):
-                nearest_bound['dist'][iP] = dist[dist_sorted[bound_idx[0]]] * 1e6
-                # nearest_bound['adj_id'][iP] = brain_id_sorted[bound_idx[0]]
-            else:
-                nearest_bound['dist'][iP] = np.max(dist) * 1e6
-                # nearest_bound['adj_id'][iP] = brain_id_sorted[0]
-
-            if parent:
-                # Now compute for the parents
-                brain_parent = np.array([allen['parent_structure_id'][np.where(allen['id'] == br)
-                                        [0][0]] for br in brain_id_sorted])
-                brain_parent[np.isnan(brain_parent)] = 0
-
-                nearest_bound['parent_id'][iP] = brain_parent[0]
-                nearest_bound['parent_col'].append(allen['color_hex_triplet']
-                                                   [np.where(allen['id'] ==
-                                                             brain_parent[0])[0][0]])
-
-                parent_idx = np.where(brain_parent != brain_parent[0])[0]
-                if np.any(parent_idx):
-                    nearest_bound['parent_dist'][iP] = dist[dist_sorted[parent_idx[0]]] * 1e6
-                    # nearest_bound['parent_adj_id'][iP] = brain_parent[parent_idx[0]]
-                else:
-                    nearest_bound['parent_dist'][iP] = np.max(dist) * 1e6
-                    # nearest_bound['parent_adj_id'][iP] = brain_parent[0]
+        # the planes perpendicular to the trajectory are sampled for all points at once: for each
+        # point, a (steps + 1) x (steps + 1) grid including the point itself as the last sample
+        npts, nsteps, ext = xyz_coords.shape[0], steps + 1, extent / 1e6
+        x_vals = np.c_[np.linspace(xyz_coords[:, 0] - ext, xyz_coords[:, 0] + ext, steps, axis=1),
+                       xyz_coords[:, 0]]
+        y_vals = np.c_[np.linspace(xyz_coords[:, 1] - ext, xyz_coords[:, 1] + ext, steps, axis=1),
+                       xyz_coords[:, 1]]
+        X = np.tile(x_vals, (1, nsteps))
+        Y = np.repeat(y_vals, nsteps, axis=1)
+        d = np.dot(xyz_coords, vector)
+        Z = (d[:, np.newaxis] - vector[0] * X - vector[1] * Y) / vector[2]
+        XYZ = np.stack([X, Y, Z], axis=-1)
+        dist = np.sqrt(np.sum((XYZ - xyz_coords[:, np.newaxis, :]) ** 2, axis=-1))
+
+        # points whose plane falls outside of the atlas volume are skipped
+        ixyz = brain_atlas.bc.xyz2i(XYZ)
+        valid = np.all((ixyz >= 0) & (ixyz < brain_atlas.bc.nxyz), axis=(1, 2))
+        brain_id = np.zeros((npts, nsteps ** 2))
+        brain_id[valid] = np.reshape(brain_atlas.get_labels(np.reshape(XYZ[valid], (-1, 3))),
+                                     (-1, nsteps ** 2))
+
+        # rows of the allen dataframe of the region ids, sorted lookup instead of linear searches
+        allen_ids = allen['id'].values
+        isort = np.argsort(allen_ids)
+
+        def allen_rows(ids):
+            return isort[np.searchsorted(allen_ids, ids, sorter=isort)]
+
+        def nearest(ids):
+            # region at the point and distance to the closest sample of another region
+            id0 = ids[np.arange(npts), np.argmin(dist, axis=1)]
+            dist_other = np.where(ids != id0[:, np.newaxis], dist, np.inf).min(axis=1)
+            no_bound = np.isinf(dist_other)
+            dist_other[no_bound] = np.max(dist[no_bound], axis=1)
+            return id0[valid], dist_other[valid] * 1e6
+
+        colours = allen['color_hex_triplet'].values
+        nearest_bound['id'][valid], nearest_bound['dist'][valid] = nearest(brain_id)
+        nearest_bound['col'] = list(colours[allen_rows(nearest_bound['id'][valid])])
+
+        if parent:
+            # Now compute for the parents
+            brain_parent = np.zeros_like(brain_id)
+            brain_parent[valid] = allen['parent_structure_id'].values[
+                allen_rows(brain_id[valid])]
+            brain_parent[np.isnan(brain_parent)] = 0
+            nearest_bound['parent_id'][valid], nearest_bound['parent_dist'][valid] = \
+                nearest(brain_parent)
+            nearest_bound['parent_col'] = list(colours[allen_rows(
+                nearest_bound['parent_id'][valid])])
 
         return nearest_bound
 
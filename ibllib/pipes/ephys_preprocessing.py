@@ -35,9 +35,14 @@ class EphysPulses(tasks.Task):
     priority = 90  # a lot of jobs depend on this one
     level = 0  # this job doesn't depend on anything
 
-    def _run(self, overwrite=False):
+    def _run(self, overwrite=False, raw_qc=True):
         # outputs numpy
-        syncs, out_files = ephys_fpga.extract_sync(self.session_path, overwrite=overwrite)
+        if raw_qc:
+            # the raw data QC is computed in the same read of the binary files as the sync, the
+            # RawEphysQC task then finds and registers the QC files without reading raw data
+            out_files, _ = ephysqc.raw_scan_session(self.session_path, overwrite=overwrite)
+        else:
+            syncs, out_files = ephys_fpga.extract_sync(self.session_path, overwrite=overwrite)
         for out_file in out_files:
             _logger.info(f"extracted pulses for {out_file}")
 
@@ -48,15 +53,20 @@ class EphysPulses(tasks.Task):
 class RawEphysQC(tasks.Task):
     """
     Computes raw electrophysiology QC
+    The QC files are computed by the EphysPulses scan of the raw data: this task runs after it
+    and only registers them. Raw files are read only if the QC files are missing.
     """
 
     cpu = 2
-    io_charge = 30  # this jobs reads raw ap files
+    io_charge = 30  # this jobs reads raw ap files if the QC hasn't been computed by EphysPulses
     priority = 10  # a lot of jobs depend on this one
-    level = 0  # this job doesn't depend on anything
+    level = 1  # depends on EphysPulses, that computes the QC while reading the raw data
 
-    def _run(self, overwrite=False):
-        qc_files = ephysqc.raw_qc_session(self.session_path, overwrite=overwrite)
+    def _run(self, overwrite=False, nprocesses=None):
+        # by default, use as many worker processes as the cpu resources declared by the task
+        nprocesses = nprocesses or self.cpu
+        qc_files = ephysqc.raw_qc_session(self.session_path, overwrite=overwrite,
+                                          nprocesses=nprocesses)
         return qc_files
 
 
@@ -87,7 +97,7 @@ class SpikeSorting_KS2_Matlab(tasks.Task):
     gpu = 1
     io_charge = 70  # this jobs reads raw ap files
     priority = 60
-    level = 1  # this job doesn't depend on anything
+    level = 3  # depends on EphysMtscomp
 
     @staticmethod
     def _sample2v(ap_file):
@@ -276,7 +286,7 @@ class EphysTrials(tasks.Task):
 
 class EphysCellsQc(tasks.Task):
     priority = 90
-    level = 3
+    level = 4
 
     def _compute_cell_qc(self, folder_probe):
         """
@@ -286,11 +296,12 @@ class EphysCellsQc(tasks.Task):
         """
         # compute the straight qc
         _logger.info(f"Computing cluster qc for {folder_probe}")
-        spikes = alf.io.load_object(folder_probe, 'spikes')
-        clusters = alf.io.load_object(folder_probe, 'clusters')
+        spikes = alf.io.load_object(folder_probe, 'spikes', lazy=True)
+        # the number of clusters is read from the file header, without loading the clusters
+        nclusters = alf.io.read_headers(folder_probe, 'clusters').channels.shape[0]
         df_units, drift = ephysqc.spike_sorting_metrics(
             spikes.times, spikes.clusters, spikes.amps, spikes.depths,
-            cluster_ids=np.arange(clusters.channels.size))
+            cluster_ids=np.arange(nclusters), nprocesses=self.cpu)
         # if the ks2 labels file exist, load them and add the column
         file_labels = folder_probe.joinpath('cluster_KSLabel.tsv')
         if file_labels.exists():
@@ -357,7 +368,7 @@ class EphysCellsQc(tasks.Task):
 
 class EphysMtscomp(tasks.Task):
     priority = 50  # ideally after spike sorting
-    level = 0
+    level = 2  # the raw files are deleted after compression, after the tasks reading them
 
     def _run(self):
         """
@@ -424,16 +435,19 @@ class EphysExtractionPipeline(tasks.Pipeline):
         # level 0
         tasks["EphysRegisterRaw"] = EphysRegisterRaw(self.session_path)
         tasks["EphysPulses"] = EphysPulses(self.session_path)
-        tasks["EphysRawQC"] = RawEphysQC(self.session_path)
         tasks["EphysAudio"] = EphysAudio(self.session_path)
         tasks["EphysVideoCompress"] = EphysVideoCompress(self.session_path)
-        tasks["EphysMtscomp"] = EphysMtscomp(self.session_path)
         # level 1
-        tasks['SpikeSorting'] = SpikeSorting_KS2_Matlab(
-            self.session_path, parents=[tasks['EphysMtscomp'], tasks['EphysPulses']])
+        tasks["EphysRawQC"] = RawEphysQC(self.session_path, parents=[tasks["EphysPulses"]])
         tasks['EphysTrials'] = EphysTrials(self.session_path, parents=[tasks['EphysPulses']])
         tasks['EphysDLC'] = EphysDLC(self.session_path, parents=[tasks['EphysVideoCompress']])
         tasks["EphysPassive"] = EphysPassive(self.session_path, parents=[tasks["EphysPulses"]])
-        # level 2
+        # level 2: the compression deletes the raw binary files read or hashed by these tasks
+        tasks["EphysMtscomp"] = EphysMtscomp(self.session_path, parents=[
+            tasks["EphysRegisterRaw"], tasks["EphysPulses"], tasks["EphysRawQC"]])
+        # level 3
+        tasks['SpikeSorting'] = SpikeSorting_KS2_Matlab(
+            self.session_path, parents=[tasks['EphysMtscomp'], tasks['EphysPulses']])
+        # level 4
         tasks["EphysCellsQc"] = EphysCellsQc(self.session_path, parents=[tasks["SpikeSorting"]])
         self.tasks = tasks
@@ -1,3 +1,4 @@
+import concurrent.futures
 from pathlib import Path
 import logging
 
@@ -16,8 +17,11 @@ from ibllib.qc import base
 
 _logger = logging.getLogger('ibllib')
 
+# in um. Coverage = 1 below the first value, 0 after the second, cosine taper in between
+COVERAGE_DIST_FCN_UM = [100, 150]
+ACTIVE_LENGTH_UM = 3.5 * 1e3
 # origin Allen left, front, up
-brain_atlas = atlas.AllenAtlas(res_um=25)
+brain_atlas = atlas.get_allen_atlas(res_um=25)
 
 
 def load_track_csv(file_track):
@@ -478,74 +482,81 @@ def detect_missing_histology_tracks(path_tracks=None, one=None, subject=None):
                     continue
 
 
-def coverage(trajs, ba=None):
+def insertion_coverage(traj, ba):
+    """
+    Computes the sparse coverage contribution of a single insertion, for any track angle
+    :param traj: trajectory dictionary from Alyx rest endpoint
+    :param ba: ibllib.atlas.BrainAtlas instance
+    :return: inds: np.array of flat indices in the atlas volume
+    :return: values: np.array (float32) of the coverage at those indices
+    """
+    ins = atlas.Insertion.from_dict(traj)
+    max_dist = COVERAGE_DIST_FCN_UM[1] / 1e6  # max distance around the probe to be searched for
+    uvec = (ins.entry - ins.tip) / np.linalg.norm(ins.entry - ins.tip)
+    # sample the active track path along the axis with the biggest deviation, extended so that
+    # the samples cover the end caps of the search cylinder
+    axis = np.argmax(np.abs(uvec))
+    cos_axis = np.abs(uvec[axis])
+    sites_bounds = ins.tip + uvec * (np.array([[ACTIVE_LENGTH_UM], [0]]) + TIP_SIZE_UM) / 1e6
+    top_bottom = sites_bounds + uvec * np.array([[1], [-1]]) * max_dist / cos_axis
+    tbi = ba.bc.xyz2i(top_bottom)
+    nsamples = np.abs(tbi[1, axis] - tbi[0, axis]) + 1
+    ishank = np.round(np.array(
+        [np.linspace(tbi[0, i], tbi[1, i], nsamples) for i in np.arange(3)]).T).astype(np.int64)
+    # around each sample, a square slice perpendicular to the axis contains the ellipse section
+    # of the search cylinder. Samples have distinct indices along the axis so that the candidate
+    # voxels are unique
+    ab = [i for i in range(3) if i != axis]
+    na, nb = (int(np.ceil(max_dist / cos_axis / np.abs(ba.bc.dxyz[i]))) + 1 for i in ab)
+    offsets = np.zeros(((2 * na + 1) * (2 * nb + 1), 3), dtype=np.int64)
+    offsets[:, ab[0]], offsets[:, ab[1]] = (v.flatten() for v in np.meshgrid(
+        np.arange(-na, na + 1), np.arange(-nb, nb + 1)))
+    ixyz = (ishank[:, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, 3)
+    # if any, remove indices that lie outside of the volume bounds
+    ixyz = ixyz[np.all((ixyz >= 0) & (ixyz < ba.bc.nxyz), axis=1)]
+    # get the minimum distance to the trajectory, to which is applied the cosine taper
+    xyz = np.c_[ba.bc.xscale[ixyz[:, 0]], ba.bc.yscale[ixyz[:, 1]], ba.bc.zscale[ixyz[:, 2]]]
+    mdist = ins.trajectory.mindist(xyz, bounds=sites_bounds)
+    iok = mdist < max_dist
+    values = 1 - fcn_cosine(np.array(COVERAGE_DIST_FCN_UM) / 1e6)(mdist[iok])
+    return ba._lookup_inds(ixyz[iok]).reshape(-1), values.astype(np.float32)
+
+
+def _batch_coverage(trajs, ba):
+    """
+    Reduces the sparse coverage contributions of a batch of insertions
+    :return: unique flat indices and summed coverage values
+    """
+    contribs = [insertion_coverage(traj, ba) for traj in trajs]
+    if len(contribs) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+    inds = np.concatenate([c[0] for c in contribs])
+    uinds, iinv = np.unique(inds, return_inverse=True)
+    values = np.bincount(iinv, weights=np.concatenate([c[1] for c in contribs]))
+    return uinds, values.astype(np.float32)
+
+
+def coverage(trajs, ba=None, full_coverage=None, nthreads=4, batch_size=20):
     """
     Computes a coverage volume from
     :param trajs: dictionary of trajectories from Alyx rest endpoint (one.alyx.rest...)
     :param ba: ibllib.atlas.BrainAtlas instance
+    :param full_coverage: optional coverage volume previously computed, to which the coverage of
+     the new trajectories is added in place
+    :param nthreads: number of batches of trajectories processed concurrently
+    :param batch_size: number of trajectories per batch
     :return: 3D np.array the same size as the volume provided in the brain atlas
     """
-    # in um. Coverage = 1 below the first value, 0 after the second, cosine taper in between
-    DIST_FCN = [100, 150]
-    ACTIVE_LENGTH_UM = 3.5 * 1e3
-    MAX_DIST_UM = DIST_FCN[1]  # max distance around the probe to be searched for
     if ba is None:
-        ba = atlas.AllenAtlas()
-
-    def crawl_up_from_tip(ins, d):
-        return (ins.entry - ins.tip) * (d[:, np.newaxis] /
-                                        np.linalg.norm(ins.entry - ins.tip)) + ins.tip
-
-    full_coverage = np.zeros(ba.image.shape, dtype=np.float32).flatten()
-
-    for p in np.arange(len(trajs)):
-        if p % 20 == 0:
-            print(p / len(trajs))
-        traj = trajs[p]
-
-        ins = atlas.Insertion.from_dict(traj)
-        # those are the top and bottom coordinates of the active part of the shank extended
-        # to maxdist
-        d = (np.array([ACTIVE_LENGTH_UM + MAX_DIST_UM * np.sqrt(2),
-                       -MAX_DIST_UM * np.sqrt(2)]) + TIP_SIZE_UM)
-        top_bottom = crawl_up_from_tip(ins, d / 1e6)
-        # this is the axis that has the biggest deviation. Almost always z
-        axis = np.argmax(np.abs(np.diff(top_bottom, axis=0)))
-        if axis != 2:
-            _logger.warning(f"This works only for 45 degree or vertical tracks so far, skipping"
-                            f" {ins}")
-            continue
-        # sample the active track path along this axis
-        tbi = ba.bc.xyz2i(top_bottom)
-        nz = tbi[1, axis] - tbi[0, axis] + 1
-        ishank = np.round(np.array(
-            [np.linspace(tbi[0, i], tbi[1, i], nz) for i in np.arange(3)]).T).astype(np.int32)
-
-        # creates a flattened "column" of candidate volume indices around the track
-        # around each sample get an horizontal square slice of nx *2 +1 and ny *2 +1 samples
-        # flatten the corresponding xyz indices and  compute the min distance to the track only
-        # for those
-        nx = int(np.floor(MAX_DIST_UM / 1e6 / np.abs(ba.bc.dxyz[0]) * np.sqrt(2) / 2)) * 2 + 1
-        ny = int(np.floor(MAX_DIST_UM / 1e6 / np.abs(ba.bc.dxyz[1]) * np.sqrt(2) / 2)) * 2 + 1
-        ixyz = np.stack([v.flatten() for v in np.meshgrid(
-            np.arange(-nx, nx + 1), np.arange(-ny, ny + 1), np.arange(nz))]).T
-        ixyz[:, 0] = ishank[ixyz[:, 2], 0] + ixyz[:, 0]
-        ixyz[:, 1] = ishank[ixyz[:, 2], 1] + ixyz[:, 1]
-        ixyz[:, 2] = ishank[ixyz[:, 2], 2]
-        # if any, remove indices that lie outside of the volume bounds
-        iok = np.logical_and(0 <= ixyz[:, 0], ixyz[:, 0] < ba.bc.nx)
-        iok &= np.logical_and(0 <= ixyz[:, 1], ixyz[:, 1] < ba.bc.ny)
-        iok &= np.logical_and(0 <= ixyz[:, 2], ixyz[:, 2] < ba.bc.nz)
-        ixyz = ixyz[iok, :]
-        # get the minimum distance to the trajectory, to which is applied the cosine taper
-        xyz = np.c_[ba.bc.xscale[ixyz[:, 0]], ba.bc.yscale[ixyz[:, 1]], ba.bc.zscale[ixyz[:, 2]]]
-        sites_bounds = crawl_up_from_tip(
-            ins, (np.array([ACTIVE_LENGTH_UM, 0]) + TIP_SIZE_UM) / 1e6)
-        mdist = ins.trajectory.mindist(xyz, bounds=sites_bounds)
-        coverage = 1 - fcn_cosine(np.array(DIST_FCN) / 1e6)(mdist)
-        # remap to the coverage volume
-        full_coverage[ba._lookup_inds(ixyz)] += coverage
-
-    full_coverage = full_coverage.reshape(ba.image.shape)
-    full_coverage[ba.label == 0] = np.nan
+        ba = atlas.get_allen_atlas()
+    if full_coverage is None:
+        full_coverage = np.zeros(ba.image.shape, dtype=np.float32)
+        full_coverage[ba.label == 0] = np.nan
+    flat_coverage = full_coverage.reshape(-1)
+    if not np.shares_memory(flat_coverage, full_coverage):
+        raise ValueError('The coverage volume to update should be contiguous')
+    batches = [trajs[i:i + batch_size] for i in range(0, len(trajs), batch_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+        for inds, values in executor.map(lambda b: _batch_coverage(b, ba), batches):
+            flat_coverage[inds] += values
     return full_coverage
@@ -1,4 +1,9 @@
+import collections
+import json
 import logging
+import signal
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -8,7 +13,7 @@ import subprocess
 import sys
 
 from ibllib.io.extractors.base import get_session_extractor_type
-from ibllib.pipes import ephys_preprocessing, training_preprocessing, tasks
+from ibllib.pipes import ephys_preprocessing, training_preprocessing, tasks, scheduler
 import ibllib.exceptions
 from ibllib.time import date2isostr
 
@@ -119,6 +124,7 @@ def job_runner(subjects_path, lab=None, dry=False, one=None, count=5):
     """
     Function to be used as a process to run the jobs as they are created on the database
     THis will query waiting jobs from the specified Lab
+    For a long-lived process running the jobs concurrently, see JobRunner
     :param subjects_path: on servers: /mnt/s0/Data/Subjects. Contains sessions
     :param lab: lab name as per Alyx
     :param dry:
@@ -136,7 +142,198 @@ def job_runner(subjects_path, lab=None, dry=False, one=None, count=5):
     tasks_runner(subjects_path, tasks, one=one, count=count, time_out=3600, dry=dry)
 
 
-def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_out=None, **kwargs):
+class JobRunner:
+    """
+    Long-lived job runner: keeps a local queue of the Waiting tasks of the lab across sessions,
+    refills it incrementally from Alyx and runs the tasks through a scheduler.TaskScheduler
+    worker pool, by decreasing priority and as soon as their parents are complete.
+
+    >>> runner = JobRunner('/mnt/s0/Data/Subjects', one=one, metrics_file='/tmp/runner.json')
+    >>> runner.run()  # until SIGTERM / SIGINT
+
+    On shutdown no new task is started, the running tasks are given `shutdown_timeout` seconds to
+    finish after which they are terminated and set back to Waiting on Alyx.
+    The queue depth, tasks per hour and mean run time per task class are returned by `metrics()`
+    and written as json to the metrics file at each refill.
+    """
+
+    def __init__(self, subjects_path, one=None, lab=None, task_scheduler=None,
+                 refill_interval=60, metrics_file=None, shutdown_timeout=600, **kwargs):
+        """
+        :param subjects_path: on servers: /mnt/s0/Data/Subjects. Contains sessions
+        :param one: ONE instance
+        :param lab: lab name or list of lab names as per Alyx (default: lab of the server)
+        :param task_scheduler: scheduler.TaskScheduler instance (default: all cores, 1 gpu)
+        :param refill_interval: seconds between queries of the Waiting tasks
+        :param metrics_file: optional json file to which the metrics are written
+        :param shutdown_timeout: seconds given to the running tasks to finish on shutdown
+        :param kwargs: arguments passed downstream to run_alyx_task
+        """
+        self.one = one or ONE()
+        self.lab = lab or _get_lab(self.one)
+        self.scheduler = task_scheduler or scheduler.TaskScheduler(one=self.one)
+        self.refill_interval = refill_interval
+        self.metrics_file = Path(metrics_file) if metrics_file else None
+        self.shutdown_timeout = shutdown_timeout
+        self.kwargs = kwargs
+        self.session_path = scheduler.session_path_from_alyx(self.one, subjects_path)
+        self.queue = {}  # task id: (sort key, task dictionary)
+        self.statuses = {}  # task id: known Alyx status
+        self.completed = collections.deque()  # (end time, stat Bunch) of the last hour
+        self.start_time = time.time()
+        self._seq = 0
+        self._stopping = False
+
+    def refill(self):
+        """
+        Queries the Waiting tasks of the lab: new tasks are queued and tasks that are not
+        Waiting anymore, eg. picked up by another runner, are dropped from the queue
+        :return: number of new tasks queued
+        """
+        waiting = self.one.alyx.rest('tasks', 'list', status='Waiting',
+                                     django=f'session__lab__name__in,{self.lab}')
+        waiting = {t['id']: t for t in waiting if t['id'] not in self.scheduler.running}
+        nnew = 0
+        for tid, tdict in waiting.items():
+            if tid not in self.queue:
+                self._seq += 1
+                nnew += 1
+            seq = self.queue[tid][0][-1] if tid in self.queue else self._seq
+            # highest priority first, then parents before children, then first come first served
+            key = (-(tdict.get('priority') or 0), tdict.get('level') or 0, seq)
+            self.queue[tid] = (key, tdict)
+        for tid in set(self.queue) - set(waiting):
+            self.queue.pop(tid)
+        # only the final Complete status is kept, other parents statuses are read again
+        self.statuses = {k: v for k, v in self.statuses.items() if v == 'Complete'}
+        self.statuses.update({tid: 'Waiting' for tid in self.queue})
+        _logger.info(f'{nnew} new tasks queued, queue depth {len(self.queue)}')
+        return nnew
+
+    def _parent_status(self, pid):
+        if pid not in self.statuses:
+            self.statuses[pid] = self.one.alyx.rest('tasks', 'read', id=pid)['status']
+        return self.statuses[pid]
+
+    def dispatch(self):
+        """
+        Starts the queued tasks whose parents are complete, as long as they fit in the scheduler
+        budget. Tasks with a failed parent are set to Held.
+        :return: number of tasks started or held
+        """
+        n = 0
+        for _, tdict in sorted(self.queue.values(), key=lambda q: q[0]):
+            parents = {p: self._parent_status(p) for p in tdict['parents']}
+            job_deck = [{'id': p, 'status': s} for p, s in parents.items()]
+            if any(s in scheduler.FAILED_STATUSES for s in parents.values()):
+                # run_alyx_task labels the task as Held without running it
+                self.queue.pop(tdict['id'])
+                tdict, _ = tasks.run_alyx_task(tdict=tdict, session_path=self.session_path(tdict),
+                                               one=self.one, job_deck=job_deck, **self.kwargs)
+                self.statuses[tdict['id']] = tdict['status']
+                n += 1
+            elif all(s == 'Complete' for s in parents.values()) and self.scheduler.fits(tdict):
+                self.queue.pop(tdict['id'])
+                self.scheduler.start(tdict, self.session_path(tdict), job_deck=job_deck,
+                                     **self.kwargs)
+                self.statuses[tdict['id']] = 'Started'
+                n += 1
+        return n
+
+    def collect(self, timeout=None):
+        """
+        Collects the finished tasks, see scheduler.TaskScheduler.collect
+        :return: list of (task dictionary, registered datasets) of the finished tasks
+        """
+        nstats = len(self.scheduler.stats)
+        finished = self.scheduler.collect(timeout=timeout)
+        for tdict, _ in finished:
+            self.statuses[tdict['id']] = tdict['status']
+        self.completed.extend((time.time(), stat) for stat in self.scheduler.stats[nstats:])
+        return finished
+
+    def metrics(self):
+        """
+        :return: dictionary with the queue depth, the number of running tasks, the number of tasks
+         finished per hour over the last hour, and the number of runs and mean wall time in
+         seconds per task class since the start of the runner
+        """
+        now = time.time()
+        while self.completed and now - self.completed[0][0] > 3600:
+            self.completed.popleft()
+        runtimes = collections.defaultdict(list)
+        for stat in self.scheduler.stats:
+            runtimes[stat.name].append(stat.wall_time)
+        return {'time': date2isostr(datetime.now()),
+                'queue_depth': len(self.queue),
+                'running': len(self.scheduler.running),
+                'tasks_per_hour': len(self.completed) * 3600 / min(max(now - self.start_time, 1),
+                                                                   3600),
+                'tasks': {name: {'count': len(rt), 'mean_runtime': sum(rt) / len(rt)}
+                          for name, rt in runtimes.items()}}
+
+    def write_metrics(self):
+        if self.metrics_file is None:
+            return
+        tmp_file = self.metrics_file.with_suffix('.part')
+        tmp_file.write_text(json.dumps(self.metrics(), indent=1))
+        tmp_file.replace(self.metrics_file)
+
+    def stop(self, *args):
+        """
+        Requests a graceful shutdown of the run loop, also used as signal handler
+        """
+        _logger.info('Job runner shutting down')
+        self._stopping = True
+
+    def run(self, until_empty=False):
+        """
+        Runs the tasks until stop() is called or a SIGTERM/SIGINT is received
+        :param until_empty: if True, returns once no task is running and none can be started
+        """
+        if self.lab is None:
+            return  # if the lab is none, this will return empty tasks each time
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            handlers = {sig: signal.signal(sig, self.stop)
+                        for sig in (signal.SIGTERM, signal.SIGINT)}
+        self._stopping = False
+        next_refill, refreshed = 0, False
+        try:
+            while not self._stopping:
+                if time.time() >= next_refill:
+                    self.refill()
+                    self.write_metrics()
+                    next_refill, refreshed = time.time() + self.refill_interval, True
+                if self.dispatch():
+                    refreshed = False
+                if self.scheduler.running:
+                    if self.collect():
+                        refreshed = False
+                elif until_empty:
+                    if refreshed:
+                        break
+                    next_refill = 0
+                else:
+                    time.sleep(self.scheduler.poll)
+            self._shutdown()
+        finally:
+            for sig, handler in handlers.items():
+                signal.signal(sig, handler)
+            self.write_metrics()
+
+    def _shutdown(self):
+        tend = time.time() + self.shutdown_timeout
+        while self.scheduler.running and time.time() < tend:
+            self.collect(timeout=min(self.scheduler.poll, max(tend - time.time(), 0)))
+        if self.scheduler.running:
+            _logger.warning(f'Terminating {len(self.scheduler.running)} running tasks and setting '
+                            f'them back to Waiting')
+            self.scheduler.terminate()
+
+
+def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_out=None,
+                 task_scheduler=None, **kwargs):
     """
     Function to run a list of tasks (task dictionary from Alyx query) on a local server
     :param subjects_path:
@@ -145,11 +342,17 @@ def tasks_runner(subjects_path, tasks_dict, one=None, dry=False, count=5, time_o
     :param dry:
     :param count: maximum number of tasks to run
     :param time_out: between each task, if time elapsed is greater than time out, returns (seconds)
+    :param task_scheduler: optional scheduler.TaskScheduler to run the tasks concurrently, in
+     which case count and time_out are not used
     :param kwargs:
     :return: list of dataset dictionaries
     """
     if one is None:
         one = ONE()
+    if task_scheduler is not None and not dry:
+        session_path = scheduler.session_path_from_alyx(one, subjects_path)
+        _, all_datasets = task_scheduler.run(tasks_dict, session_path, **kwargs)
+        return all_datasets
     import time
     tstart = time.time()
     c = 0
@@ -0,0 +1,359 @@
+"""
+Local scheduler running Alyx tasks concurrently in worker processes.
+
+Tasks are started as soon as their parents are complete, by decreasing priority, as long as the
+sum of the cpu, gpu, ram and io_charge declared by the running tasks fits the machine budget.
+Each task runs in its own process through tasks.run_alyx_task, so that the Alyx statuses, logs
+and datasets registration are the same as for a serial run. The worker processes lead their own
+process group so that the subprocesses started by a task are terminated with it.
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+import traceback
+from pathlib import Path
+
+from brainbox.core import Bunch
+from ibllib.pipes import tasks
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+_logger = logging.getLogger('ibllib')
+
+RESOURCES = ('cpu', 'gpu', 'ram', 'io_charge')
+FAILED_STATUSES = ('Errored', 'Held', 'Empty')
+
+
+def _total_ram():
+    """Physical memory in Go, 16 if it can't be determined"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return 16
+
+
+def _peak_rss_mb(who):
+    """
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    :return: peak resident memory in Mb of the process or of its largest terminated child
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def _reset_peak_rss():
+    """
+    Resets the resident memory high-water mark that a forked process inherits from its parent
+    (linux only)
+    """
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+    except OSError:
+        pass
+
+
+def _process_group_memory_mb(pgid):
+    """
+    Memory used by the processes of a group, as the sum of their private (unshared) resident
+    pages, so that the pages a forked worker shares with its parent are not counted (linux only)
+    :param pgid: process group id
+    :return: memory in Mb, None if it can't be determined
+    """
+    total, found = 0, False
+    for proc in Path('/proc').glob('[0-9]*'):
+        try:
+            # the process group is the 3rd field after the command name, that may contain spaces
+            if int(proc.joinpath('stat').read_text().rsplit(')', 1)[1].split()[2]) != pgid:
+                continue
+            rollup = proc.joinpath('smaps_rollup').read_text()
+        except (OSError, ValueError, IndexError):
+            continue
+        found = True
+        total += sum(int(line.split()[1]) for line in rollup.splitlines()
+                     if line.startswith('Private_'))
+    return total / 1024 if found else None
+
+
+def _kill_process_group(process, timeout=10):
+    """
+    Terminates a worker process and the subprocesses started by its task
+    """
+    if not hasattr(os, 'killpg'):  # windows
+        process.terminate()
+        process.join()
+        return
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            # the worker may not have created its group yet, or the group is gone
+            if process.is_alive():
+                process.terminate()
+        process.join(timeout)
+
+
+def _task_process(conn, tdict, session_path, one, job_deck, kwargs):
+    """
+    Worker process entry point: runs the Alyx task and sends back the updated task dictionary,
+    the registered datasets, the peak resident memory used by the task in the worker process and
+    the peak resident memory of the largest subprocess started by the task in Mb
+    """
+    # own process group, so that the scheduler can terminate the subprocesses of the task
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    # the parent may handle those signals to shut down gracefully, the workers have to stop
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if resource is not None:
+        # the forked worker shares the memory pages of its parent, only the memory used on top
+        # of its initial footprint is attributed to the task
+        _reset_peak_rss()
+        rss0 = _peak_rss_mb(resource.RUSAGE_SELF)
+    try:
+        tdict, dsets = tasks.run_alyx_task(tdict=tdict, session_path=session_path, one=one,
+                                           job_deck=job_deck, **kwargs)
+        result = {'task': tdict, 'datasets': dsets}
+    except BaseException:
+        result = {'error': traceback.format_exc()}
+    if resource is not None:
+        result['peak_rss_mb'] = max(_peak_rss_mb(resource.RUSAGE_SELF) - rss0, 0)
+        # subprocesses started by the task (ffmpeg, spike sorting...). NB: a subprocess forked
+        # before executing its program also accounts for the memory of the worker
+        result['children_peak_rss_mb'] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    conn.send(result)
+    conn.close()
+
+
+class TaskScheduler:
+    """
+    Runs Alyx tasks concurrently in worker processes within a cpu/gpu/ram/io_charge budget.
+
+    >>> scheduler = TaskScheduler(one=one, cpu=32, gpu=1)
+    >>> task_deck, datasets = scheduler.run(task_deck, session_path)
+
+    Tasks requiring more than the budget are clipped to the budget, ie. run alone.
+    The wall time, peak memory and status of each task run are recorded in `stats`.
+    """
+
+    def __init__(self, one=None, cpu=None, gpu=1, ram=None, io_charge=100, max_workers=None,
+                 poll=0.5):
+        """
+        :param one: ONE instance, inherited by the worker processes
+        :param cpu: number of cores available (default: all)
+        :param gpu: number of GPUs available
+        :param ram: memory available in Go (default: physical memory)
+        :param io_charge: io capacity, in the same percentage units as tasks io_charge
+        :param max_workers: maximum number of tasks running concurrently (default: cpu)
+        :param poll: seconds between checks of the running tasks
+        """
+        self.one = one
+        self.budget = Bunch({'cpu': cpu or os.cpu_count(), 'gpu': gpu,
+                             'ram': ram or _total_ram(), 'io_charge': io_charge})
+        self.max_workers = max_workers or self.budget.cpu
+        self.poll = poll
+        self.running = {}  # task id: Bunch(process, conn, tdict, start_time, requirements)
+        self.stats = []
+        # forked workers inherit the one instance, spawned workers would need to pickle it
+        methods = multiprocessing.get_all_start_methods()
+        self._mp_context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+    def requirements(self, tdict):
+        """
+        Resources declared by a task, clipped to the budget
+        :param tdict: Alyx task dictionary
+        :return: dictionary of resource: amount
+        """
+        return {k: min(tdict.get(k) or 0, self.budget[k]) for k in RESOURCES}
+
+    @property
+    def used(self):
+        return {k: sum(r.requirements[k] for r in self.running.values()) for k in RESOURCES}
+
+    def fits(self, tdict):
+        """
+        :return: True if the task can start now within the budget
+        """
+        if len(self.running) >= self.max_workers:
+            return False
+        used, req = self.used, self.requirements(tdict)
+        return all(used[k] + req[k] <= self.budget[k] for k in RESOURCES)
+
+    def start(self, tdict, session_path, job_deck=None, **kwargs):
+        """
+        Starts a task in a worker process
+        :param tdict: Alyx task dictionary
+        :param session_path: local session path
+        :param job_deck: list of the session tasks dictionaries, to check parents statuses
+        :param kwargs: run_alyx_task arguments
+        """
+        conn_parent, conn_child = self._mp_context.Pipe(duplex=False)
+        process = self._mp_context.Process(
+            target=_task_process, name=tdict['name'], daemon=False,
+            args=(conn_child, tdict, session_path, self.one, job_deck, kwargs))
+        process.start()
+        conn_child.close()
+        _logger.info(f"Started {tdict['name']} on {session_path}, pid {process.pid}")
+        self.running[tdict['id']] = Bunch({
+            'process': process, 'conn': conn_parent, 'tdict': tdict,
+            'session_path': session_path, 'start_time': time.time(),
+            'requirements': self.requirements(tdict), 'peak_memory': None})
+
+    def collect(self, timeout=None):
+        """
+        Waits for running tasks to finish and collects their results. Tasks running longer than
+        their Alyx time_out_sec are terminated.
+        :param timeout: maximum waiting time in seconds (default: poll interval)
+        :return: list of (task dictionary, registered datasets) of the finished tasks
+        """
+        timeout = self.poll if timeout is None else timeout
+        # the memory of the subprocesses of the tasks is sampled from the worker process groups
+        for run in self.running.values():
+            memory = _process_group_memory_mb(run.process.pid)
+            if memory is not None:
+                run.peak_memory = max(run.peak_memory or 0, memory)
+        conns = {r.conn: tid for tid, r in self.running.items()}
+        ready = multiprocessing.connection.wait(list(conns), timeout=timeout)
+        finished = []
+        for conn in ready:
+            run = self.running.pop(conns[conn])
+            try:
+                result = conn.recv()
+            except EOFError:  # the process died without sending results
+                run.process.join()
+                result = {'error': f'worker process died with exit code {run.process.exitcode}'}
+            conn.close()
+            run.process.join()
+            finished.append(self._finish(run, result))
+        for tid, run in list(self.running.items()):
+            time_out = run.tdict.get('time_out_sec')
+            if time_out and time.time() - run.start_time > time_out:
+                _kill_process_group(run.process)
+                run.conn.close()
+                self.running.pop(tid)
+                finished.append(self._finish(run, {'error': f'time out after {time_out} secs'}))
+        return finished
+
+    def _finish(self, run, result):
+        wall_time = time.time() - run.start_time
+        tdict, dsets = result.get('task'), result.get('datasets') or []
+        if tdict is None:
+            # the task could not report its status, flag it as errored
+            _logger.error(f"{run.tdict['name']} on {run.session_path}: {result['error']}")
+            tdict = dict(run.tdict, status='Errored')
+            if self.one is not None:
+                tdict = self.one.alyx.rest('tasks', 'partial_update', id=run.tdict['id'],
+                                           data={'status': 'Errored', 'log': result['error']})
+        # the memory of the worker process is exact, the memory of the whole process group is
+        # sampled, without it the largest subprocess is added to the worker process
+        peak_rss_mb = result.get('peak_rss_mb')
+        if peak_rss_mb is not None and run.peak_memory is not None:
+            peak_rss_mb = max(peak_rss_mb, run.peak_memory)
+        elif peak_rss_mb is not None:
+            peak_rss_mb += result.get('children_peak_rss_mb') or 0
+        stat = Bunch({'id': run.tdict['id'], 'name': run.tdict['name'],
+                      'session_path': run.session_path, 'status': tdict['status'],
+                      'wall_time': wall_time, 'peak_rss_mb': peak_rss_mb})
+        self.stats.append(stat)
+        _logger.info(f"{stat.name} {stat.status} in {wall_time:.1f} secs, peak memory "
+                     f"{stat.peak_rss_mb or float('nan'):.0f} Mb")
+        return tdict, dsets
+
+    def terminate(self):
+        """
+        Terminates the running tasks and sets them back to Waiting on Alyx
+        """
+        for tid, run in list(self.running.items()):
+            _kill_process_group(run.process)
+            run.conn.close()
+            self.running.pop(tid)
+            if self.one is not None:
+                self.one.alyx.rest('tasks', 'partial_update', id=tid, data={'status': 'Waiting'})
+
+    def run(self, task_deck, session_path, status__in=['Waiting'], **kwargs):
+        """
+        Runs the tasks of a deck concurrently, respecting the dependencies between tasks
+        :param task_deck: list of Alyx tasks dictionaries
+        :param session_path: local session path, or function returning the session path of
+         a task dictionary
+        :param status__in: lists of status strings to run
+        :param kwargs: arguments passed downstream to run_alyx_task
+        :return: task_deck: list of updated tasks dictionaries
+        :return: all_datasets: list of REST dictionaries of the dataset endpoints
+        """
+        get_session_path = session_path if callable(session_path) else lambda t: session_path
+        task_deck = list(task_deck)
+        index = {t['id']: i for i, t in enumerate(task_deck)}
+        statuses = {t['id']: t['status'] for t in task_deck}
+        todo = [t for t in task_deck if t['status'] in status__in]
+        todo.sort(key=lambda t: (-(t.get('priority') or 0), t.get('level') or 0))
+        all_datasets = []
+
+        def parent_status(pid):
+            # parents outside of the deck are read from Alyx once
+            if pid not in statuses:
+                statuses[pid] = self.one.alyx.rest('tasks', 'read', id=pid)['status']
+            return statuses[pid]
+
+        def update(tdict, dsets):
+            statuses[tdict['id']] = tdict['status']
+            if tdict['id'] in index:
+                task_deck[index[tdict['id']]] = tdict
+            all_datasets.extend(dsets or [])
+
+        skipped = []
+        while todo or self.running:
+            pending = {t['id'] for t in todo} | set(self.running)
+            progress = False
+            for tdict in list(todo):
+                parents = [parent_status(p) for p in tdict['parents']]
+                if any(s in FAILED_STATUSES for s in parents):
+                    # run_alyx_task labels the task as Held without running it
+                    todo.remove(tdict)
+                    deck = [dict(t, status=statuses[t['id']]) for t in task_deck]
+                    update(*tasks.run_alyx_task(tdict=tdict, session_path=get_session_path(tdict),
+                                                one=self.one, job_deck=deck, **kwargs))
+                    progress = True
+                elif any(s != 'Complete' for s in parents):
+                    # a parent that is neither scheduled nor running will not complete
+                    if not {p for p, s in zip(tdict['parents'], parents) if s != 'Complete'} \
+                            <= pending:
+                        todo.remove(tdict)
+                        skipped.append(tdict)
+                elif self.fits(tdict):
+                    todo.remove(tdict)
+                    deck = [dict(t, status=statuses[t['id']]) for t in task_deck]
+                    self.start(tdict, get_session_path(tdict), job_deck=deck, **kwargs)
+                    progress = True
+            if not self.running:
+                if progress:
+                    continue
+                break
+            for tdict, dsets in self.collect():
+                update(tdict, dsets)
+        for tdict in skipped + todo:
+            _logger.warning(f"{tdict['name']} has unmet dependencies and was not run")
+        return task_deck, all_datasets
+
+
+def session_path_from_alyx(one, subjects_path):
+    """
+    :return: function returning the local session path of an Alyx task dictionary, caching the
+     sessions queries
+    """
+    cache = {}
+
+    def session_path(tdict):
+        if tdict['session'] not in cache:
+            ses = one.alyx.rest('sessions', 'list', django=f"pk,{tdict['session']}")[0]
+            cache[tdict['session']] = Path(subjects_path).joinpath(
+                Path(ses['subject'], ses['start_time'][:10], str(ses['number']).zfill(3)))
+        return cache[tdict['session']]
+    return session_path
@@ -96,7 +96,9 @@ class Task(abc.ABC):
 
     def register_datasets(self, one=None, **kwargs):
         """
-        Register output datasets form the task to Alyx
+        Register output datasets form the task to Alyx. The outputs are hashed in parallel and
+        the hashes of unchanged or already hashed files (ie. compressed ephys) are read from the
+        hash cache, see ibllib.io.hashfile.hash_files
         :param one:
         :param jobid:
         :param kwargs: directly passed to the register_dataset function
@@ -224,11 +226,13 @@ class Pipeline(abc.ABC):
             tasks_alyx.append(talyx)
         return tasks_alyx
 
-    def run(self, status__in=['Waiting'], **kwargs):
+    def run(self, status__in=['Waiting'], scheduler=None, **kwargs):
         """
         Get all the session related jobs from alyx and run them
         :param status__in: lists of status strings to run in
         ['Waiting', 'Started', 'Errored', 'Empty', 'Complete']
+        :param scheduler: optional ibllib.pipes.scheduler.TaskScheduler to run the tasks
+         concurrently, by default the tasks are run one after the other
         :param kwargs: arguments passed downstream to run_alyx_task
         :return: jalyx: list of REST dictionaries of the job endpoints
         :return: job_deck: list of REST dictionaries of the jobs endpoints
@@ -239,6 +243,8 @@ class Pipeline(abc.ABC):
             _logger.warning("No ONE instance found for Alyx connection, set the one property")
             return
         task_deck = self.one.alyx.rest('tasks', 'list', session=self.eid)
+        if scheduler is not None:
+            return scheduler.run(task_deck, self.session_path, status__in=status__in, **kwargs)
         # [(t['name'], t['level']) for t in task_deck]
         all_datasets = []
         for i, j in enumerate(task_deck):
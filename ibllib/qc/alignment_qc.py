@@ -1,5 +1,5 @@
 import logging
-from ibllib.atlas import AllenAtlas
+from ibllib.atlas import get_allen_atlas
 from ibllib.atlas.regions import BrainRegions
 from ibllib.pipes import histology
 from ibllib.ephys.neuropixel import SITES_COORDINATES
@@ -33,7 +33,7 @@ class AlignmentQC(base.QC):
         self.criteria = CRITERIA
 
         # Get the brain atlas
-        self.brain_atlas = brain_atlas or AllenAtlas(25)
+        self.brain_atlas = brain_atlas or get_allen_atlas(25)
         # Flag for uploading channels to alyx. For testing purposes
         self.channels = channels
 
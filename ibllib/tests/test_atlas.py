@@ -1,9 +1,14 @@
+import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
 
 import numpy as np
 
+from brainbox.core import Bunch
 from ibllib.atlas import (BrainCoordinates, cart2sph, sph2cart, Trajectory,
-                          Insertion, ALLEN_CCF_LANDMARKS_MLAPDV_UM, AllenAtlas)
+                          Insertion, ALLEN_CCF_LANDMARKS_MLAPDV_UM, AllenAtlas, get_allen_atlas)
+import ibllib.atlas.atlas
 from ibllib.atlas.regions import BrainRegions
 
 
@@ -37,6 +42,27 @@ class TestBrainRegions(unittest.TestCase):
         self.assertTrue(self.brs.descendants(ids=688).id.size == 567)
         self.assertTrue(self.brs.ancestors(ids=688).id.size == 4)
 
+    def test_hierarchy_index(self):
+        # id to row lookup, unknown ids are -1
+        rows = self.brs.id2index(np.array([688, 997, 10 ** 9]))
+        self.assertTrue(np.all(self.brs.id[rows[:2]] == [688, 997]))
+        self.assertEqual(rows[2], -1)
+        # the descendants of a set of regions are the union of their descendants
+        desc = self.brs.descendants(ids=np.array([688, 315])).id
+        self.assertTrue(np.all(np.isin(self.brs.descendants(ids=315).id, desc)))
+        self.assertEqual(desc.size, 567)
+        self.assertTrue(np.all(self.brs.is_descendant(desc, 688)))
+        self.assertFalse(np.any(self.brs.is_descendant(self.brs.ancestors(688).id[:-1], 688)))
+        self.assertTrue(np.all(self.brs.is_descendant(688, self.brs.ancestors(688).id)))
+        # remapping to the level of the isocortex (315, level 5) and above
+        remap = self.brs.remap_level(desc, 5)
+        self.assertTrue(np.all(np.isin(remap, desc)))
+        self.assertTrue(np.all(self.brs.get(remap).level <= 5))
+        self.assertTrue(np.all(remap[self.brs.is_descendant(desc, 315)] == 315))
+        self.assertTrue(np.all(self.brs.remap_level(np.array([997, 8]), 5) == [997, 8]))
+        self.assertTrue(np.all(self.brs.leaves().id == np.sort(self.brs.id[
+            ~np.isin(self.brs.id, self.brs.parent)])))
+
     def test_mappings(self):
         # the mapping assigns all non found regions to root (1:997), except for the void (0:0)
         # here we're looking at the retina (1327:304325711)
@@ -47,6 +73,61 @@ class TestBrainRegions(unittest.TestCase):
         assert np.all(inds == inds_)
 
 
+class TestAllenAtlasCache(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        path_atlas = Path(self.td.name).joinpath('histology', 'ATLAS', 'Needles', 'Allen')
+        path_atlas.mkdir(parents=True)
+        for f in ['average_template_50.nrrd', 'annotation_50.nrrd']:
+            path_atlas.joinpath(f).touch()
+        # volumes in [ap, ml, dv] order with a block of isocortex (id 315) as the brain
+        self.label = np.zeros((264, 228, 160), dtype=np.int64)
+        self.label[50:200, 40:180, 20:100] = 315
+        self.image = np.random.randint(0, 500, self.label.shape).astype(np.int16)
+        par = Bunch({'CACHE_DIR': self.td.name})
+        self.patches = [mock.patch.object(ibllib.atlas.atlas.params, 'read', return_value=par),
+                        mock.patch.object(AllenAtlas, '_read_volume', wraps=self._read_volume)]
+        self.read_volume = [p.start() for p in self.patches][1]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        ibllib.atlas.atlas._SHARED_ATLASES.clear()
+        self.td.cleanup()
+
+    def _read_volume(self, file_volume):
+        if file_volume.name == 'annotation_50.nrrd':
+            return self.label
+        elif file_volume.name == 'average_template_50.nrrd':
+            return self.image
+        return np.load(file_volume)['arr_0']
+
+    def test_cache(self):
+        ba = AllenAtlas(50)
+        self.assertEqual(self.read_volume.call_count, 3)
+        # the second instance memory-maps the cache and doesn't read the volumes
+        ba_ = AllenAtlas(50, scaling=np.array([1, 1.1, 0.95]))
+        self.assertEqual(self.read_volume.call_count, 3)
+        self.assertIsInstance(ba_.label, np.memmap)
+        self.assertTrue(np.all(ba_.image == self.image))
+        self.assertTrue(np.all(ba_.regions.id[ba_.label] == self.label))
+        ba_nocache = AllenAtlas(50, scaling=np.array([1, 1.1, 0.95]), cache=False)
+        for k in ['top', 'bottom', 'surface', 'srf_xyz']:
+            self.assertTrue(np.allclose(getattr(ba_, k), getattr(ba_nocache, k), equal_nan=True))
+        self.assertEqual(np.nanmin(ba.top), ba.bc.i2z(20))
+        # the volumes are copy-on-write
+        ba_.image[0, 0, 0] = -1
+        self.assertEqual(AllenAtlas(50).image[0, 0, 0], self.image[0, 0, 0])
+
+    def test_shared_instance(self):
+        ba = get_allen_atlas(50)
+        self.assertIs(get_allen_atlas(50), ba)
+        self.assertIsNot(get_allen_atlas(50, scaling=np.array([1, 1.1, 0.95])), ba)
+        self.assertIs(get_allen_atlas(50, scaling=np.array([1, 1.1, 0.95])),
+                      get_allen_atlas(50, scaling=np.array([1, 1.1, 0.95])))
+
+
 class TestAtlasSlicesConversion(unittest.TestCase):
 
     @classmethod
@@ -92,6 +173,42 @@ class TestAtlasSlicesConversion(unittest.TestCase):
         assert np.all(np.unique(rgb_slice) == np.array([0, 255]))
         assert ba.slice(axis=0, coordinate=0, volume='surface').shape == (ny, nz)
 
+    def test_batched_slices(self):
+        ba = self.ba
+        nx, ny, nz = ba.bc.nxyz
+        # stacked slices are the same as the individual slices
+        coords = np.array([-0.002, 0, 0.001])
+        for axis in range(3):
+            for volume in ['image', 'annotation', ba.label]:
+                slices = ba.slices(coords, axis=axis, volume=volume, mode='clip')
+                self.assertTrue(np.all(slices == np.stack(
+                    [ba.slice(c, axis=axis, volume=volume, mode='clip') for c in coords])))
+        with self.assertRaises(IndexError):
+            ba.slices(np.array([0, 123]), axis=1)
+        # lower resolution previews
+        self.assertEqual(ba.slices(coords, axis=1, step=4).shape, (3, nx // 4, nz // 4))
+        # the interpolation is exact on the voxels and linear in between
+        volume = np.tile(np.arange(ny, dtype=float)[:, np.newaxis, np.newaxis], (1, nx, nz))
+        iy = np.array([100, 100.25, 100.5])
+        islices = ba.slices(ba.bc.i2y(iy), axis=1, volume=volume, interpolate=True)
+        self.assertTrue(np.allclose(islices[:, 0, 0], iy))
+        # tilted slices
+        xyzs = [np.array([[-0.001, -0.002, 0], [0.001, -0.0025, -0.004]]),
+                np.array([[0.001, 0, 0], [0, 0, -0.004]])]
+        for axis in range(2):
+            tslices, width, height, depth = ba.tilted_slices(xyzs, axis=axis, mode='clip')
+            self.assertEqual(tslices.shape, (2, nz, [ny, nx][axis]))
+            for i, xyz in enumerate(xyzs):
+                tslice, w, h, d = ba.tilted_slice(xyz, axis=axis)
+                self.assertTrue(np.all(tslices[i] == tslice))
+                self.assertTrue(np.all(width[i] == w) and np.all(depth[i] == d))
+        tslices = ba.tilted_slices(xyzs, axis=1, step=2, volume='annotation')[0]
+        self.assertEqual(tslices.shape, (2, nz // 2, nx // 2, 3))
+        tslices = ba.tilted_slices(xyzs, axis=1, volume=volume, interpolate=True)[0]
+        # the ap index of the trajectory increases linearly with depth
+        self.assertTrue(np.allclose(np.diff(tslices[0][:, 0], n=2), 0))
+        self.assertTrue(np.all(np.diff(tslices[0][:, 0]) > 0))
+
     def test_ccf_xyz(self):
         # test with bregma first
         assert np.all(np.abs(ALLEN_CCF_LANDMARKS_MLAPDV_UM['bregma'] -
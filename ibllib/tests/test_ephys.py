@@ -1,9 +1,14 @@
 # Mock dataset
 import unittest
+from pathlib import Path
+import tempfile
 
 import numpy as np
 
-from ibllib.ephys import ephysqc, neuropixel
+import alf.io
+from ibllib.ephys import ephysqc, neuropixel, scan
+from ibllib.io import spikeglx
+from ibllib.io.extractors import ephys_fpga
 
 
 class TestNeuropixel(unittest.TestCase):
@@ -52,5 +57,89 @@ class TestFpgaTask(unittest.TestCase):
         self.assertTrue(np.all([np.all(qct[k]) for k in qct]))
 
 
+class TestRmsMap(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        file_meta = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx',
+                                                   'sample3A_g0_t0.imec.lf.meta')
+        self.file_bin = spikeglx._mock_spikeglx_file(
+            Path(self._tempdir.name).joinpath('sample3A_g0_t0.imec.lf.bin'), file_meta,
+            ns=8192 * 4 + 2000, nc=385, sync_depth=16, random=True)['bin_file']
+
+    def test_rmsmap_parallel(self):
+        ref = ephysqc.rmsmap(self.file_bin, nprocesses=1)
+        self.assertEqual(ref['TRMS'].shape, (5, 385))
+        self.assertTrue(np.all(ref['nsamples'] == np.r_[np.ones(4) * 8192, 2000]))
+        # the multi-process output should be bit-identical to the single process one
+        rms = ephysqc.rmsmap(spikeglx.Reader(self.file_bin), nprocesses=2)
+        for k in ref:
+            self.assertTrue(np.array_equal(ref[k], rms[k]))
+        # compressed files are read by the workers directly
+        file_cbin = spikeglx.Reader(self.file_bin).compress_file()
+        rms = ephysqc.rmsmap(file_cbin, nprocesses=2)
+        for k in ref:
+            self.assertTrue(np.array_equal(ref[k], rms[k]))
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+
+class TestRawScan(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.probe_path = Path(self._tempdir.name).joinpath('raw_ephys_data', 'probe00')
+        self.probe_path.mkdir(parents=True)
+        fixtures = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx')
+        self.files = {}
+        for typ, ns in zip(['ap', 'lf'], [3000, 8192 * 4 + 2000]):
+            self.files[typ] = spikeglx._mock_spikeglx_file(
+                self.probe_path.joinpath(f'sample3A_g0_t0.imec.{typ}.bin'),
+                fixtures.joinpath(f'sample3A_g0_t0.imec.{typ}.meta'),
+                ns=ns, nc=385, sync_depth=16, random=True)['bin_file']
+
+    def test_windowed_consumers(self):
+        # the consumers windows do not depend on the scan chunks size
+        ref = ephysqc.rmsmap(self.files['lf'])
+        maxs = []
+        rms, chunks = scan.scan(self.files['lf'], [
+            ephysqc.RmsMapConsumer(),
+            scan.CallbackConsumer(lambda raw, first, last: maxs.append(raw.max(axis=0)))],
+            nswin=1000)
+        self.assertEqual(len(chunks), 35)
+        self.assertTrue(np.all(np.max(np.array(maxs), axis=0) == spikeglx.Reader(
+            self.files['lf'])._raw[:].max(axis=0)))
+        for k in ref:
+            self.assertTrue(np.array_equal(ref[k], rms[k]))
+        sync = ephys_fpga._sync_to_alf(self.files['ap'])
+        sync_ = scan.scan(self.files['ap'], [ephys_fpga.SyncFrontsConsumer(self.probe_path)],
+                          nswin=7)[0]
+        for k in sync:
+            self.assertTrue(np.array_equal(sync[k], sync_[k]))
+
+    def test_raw_scan_session(self):
+        sync_files, qc_files = ephysqc.raw_scan_session(self._tempdir.name)
+        self.assertEqual(len(sync_files), 3)
+        self.assertEqual(len(qc_files), 8)
+        # the outputs are the same as the single purpose functions
+        sync = alf.io.load_object(self.probe_path, 'sync', namespace='spikeglx', short_keys=True)
+        sync_ = ephys_fpga._sync_to_alf(self.files['ap'])
+        for k in sync_:
+            self.assertTrue(np.array_equal(sync[k], sync_[k]))
+        rms = alf.io.load_object(self.probe_path, 'ephysTimeRmsLF', namespace='iblqc')
+        rms_ = ephysqc.rmsmap(self.files['lf'])
+        self.assertTrue(np.array_equal(rms['rms'], rms_['TRMS'].astype(np.single)))
+        # second run does not read the raw data
+        with self.assertLogs('ibllib', level='INFO') as log:
+            files = ephysqc.raw_scan_session(self._tempdir.name)
+            self.assertFalse(any(['Scanning' in line for line in log.output]))
+        self.assertEqual(set(files[0]), set(sync_files))
+        self.assertEqual(set(files[1]), set(qc_files))
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+
 if __name__ == "__main__":
     unittest.main(exit=False)
@@ -2,10 +2,12 @@ from pathlib import Path
 import unittest
 
 import numpy as np
+import pandas as pd
 
 from ibllib.pipes import histology
 from ibllib.pipes.ephys_alignment import (EphysAlignment, TIP_SIZE_UM, _cumulative_distance)
 import ibllib.atlas as atlas
+from ibllib.atlas.regions import FILE_REGIONS
 
 
 brain_atlas = atlas.AllenAtlas(res_um=25)
@@ -45,6 +47,30 @@ class TestHistology(unittest.TestCase):
         self.assertTrue(np.isclose(brain_atlas.top[iy, ix], top[2]))
         self.assertTrue(np.isclose(brain_atlas.bottom[iy, ix], bottom[2]))
 
+    def test_coverage(self):
+        trajs = [{'x': -1000, 'y': -2000, 'z': -500, 'phi': 30, 'theta': theta, 'depth': 3000}
+                 for theta in [0, 15, 60]]
+        # the sparse contribution of a tilted track is the taper of the distance to the sites
+        inds, values = histology.insertion_coverage(trajs[2], brain_atlas)
+        self.assertEqual(np.unique(inds).size, inds.size)
+        self.assertTrue(np.all((values > 0) & (values <= 1)))
+        ins = atlas.Insertion.from_dict(trajs[2])
+        uvec = (ins.entry - ins.tip) / np.linalg.norm(ins.entry - ins.tip)
+        sites_bounds = ins.tip + uvec * (np.array([[histology.ACTIVE_LENGTH_UM], [0]]) +
+                                         TIP_SIZE_UM) / 1e6
+        ixyz = np.array(np.unravel_index(inds, brain_atlas.image.shape)).T[:, [1, 0, 2]]
+        xyz = brain_atlas.bc.i2xyz(ixyz.astype(float))
+        mdist = ins.trajectory.mindist(xyz, bounds=sites_bounds)
+        self.assertTrue(np.all(mdist < 150 / 1e6))
+        self.assertTrue(np.allclose(values[mdist < 100 / 1e6], 1))
+        # the coverage volume can be updated in place with new insertions
+        full_coverage = histology.coverage(trajs, ba=brain_atlas, nthreads=2, batch_size=1)
+        partial = histology.coverage(trajs[:1], ba=brain_atlas)
+        updated = histology.coverage(trajs[1:], ba=brain_atlas, full_coverage=partial)
+        self.assertIs(updated, partial)
+        self.assertTrue(np.allclose(updated, full_coverage, equal_nan=True))
+        self.assertTrue(np.all(np.isnan(full_coverage[brain_atlas.label == 0])))
+
     def test_filename_parser(self):
         tdata = [
             {'input': Path("/gna/electrode_tracks_SWC_014/2019-12-12_SWC_014_001_probe01_fit.csv"),
@@ -143,6 +169,23 @@ class TestsEphysAlignment(unittest.TestCase):
         self.assertTrue(np.isclose(np.around(scale_factor[0], 3), linear_fit))
         self.assertTrue(np.isclose(np.around(scale_factor[-1], 3), linear_fit))
 
+    def test_nearest_boundary(self):
+        allen = pd.read_csv(FILE_REGIONS)
+        xyz = self.ephysalign.xyz_samples[::20]
+        nb = self.ephysalign.get_nearest_boundary(xyz, allen, extent=100, steps=8,
+                                                  brain_atlas=brain_atlas)
+        # the region of each point is the region at the point itself, and its parent region
+        ids = brain_atlas.get_labels(xyz)
+        self.assertTrue(np.all(nb['id'] == ids))
+        iallen = [np.where(allen['id'] == i)[0][0] for i in ids]
+        parents = np.nan_to_num(allen['parent_structure_id'].values[iallen])
+        self.assertTrue(np.all(nb['parent_id'] == parents))
+        self.assertEqual(nb['col'], list(allen['color_hex_triplet'].values[iallen]))
+        # the distances are within the sampled planes
+        for k in ['dist', 'parent_dist']:
+            self.assertTrue(np.all((nb[k] > 0) & (nb[k] <= 100 * np.sqrt(2) + 1e-6)))
+        self.assertTrue(np.all(nb['parent_dist'] >= nb['dist']))
+
 
 class TestsEphysReconstruction(unittest.TestCase):
 
@@ -6,11 +6,13 @@ import tempfile
 from pathlib import Path
 import shutil
 import sys
+import time
 
 import numpy as np
 
 from oneibl.one import ONE
-from ibllib.io import params, flags, jsonable, spikeglx, hashfile, misc, globus, video
+from ibllib.io import (params, flags, jsonable, spikeglx, hashfile, misc, globus, video,
+                       npy_header)
 import ibllib.io.raw_data_loaders as raw
 
 
@@ -183,6 +185,103 @@ class TestsJsonable(unittest.TestCase):
         os.unlink(tfile.name)
 
 
+class TestsHashFile(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.workdir = Path(self._tempdir.name)
+        patcher = patch.object(hashfile, 'CACHE_FILE', self.workdir.joinpath('hash_cache.sqlite'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.files = [self.workdir.joinpath(f'file{i}.bin') for i in range(5)]
+        for i, f in enumerate(self.files):
+            f.write_bytes(np.random.bytes(1000 * (i + 1)))
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_hash_files(self):
+        expected = [hashfile.md5(f) for f in self.files]
+        with patch.object(hashfile, '_hash_file', wraps=hashfile._hash_file) as hf:
+            self.assertEqual(hashfile.hash_files(self.files, nthreads=3), expected)
+            self.assertEqual(hf.call_count, 5)
+            # the threads use a small buffer and no progress bar
+            self.assertEqual(hf.call_args[1], dict(buf_size=hashfile.THREAD_BUF_SIZE,
+                                                   progress_bar=False))
+            # unchanged files are read from the cache
+            self.assertEqual(hashfile.hash_files(self.files), expected)
+            self.assertEqual(hashfile.md5(self.files[0], cache=True), expected[0])
+            self.assertEqual(hf.call_count, 5)
+            # a modified file is hashed again
+            self.files[0].write_bytes(b'toto')
+            hashes = hashfile.hash_files(self.files)
+            self.assertEqual(hf.call_count, 6)
+        # the cache is looked up once per file
+        with patch.object(hashfile.HashCache, 'get', return_value=None) as get:
+            hashfile.hash_files(self.files)
+            self.assertEqual(get.call_count, len(self.files))
+        self.assertEqual(hashes[0], hashfile.md5(self.files[0]))
+        self.assertEqual(hashes[1:], expected[1:])
+        # large files are not hashed unless cached
+        self.files[1].write_bytes(np.random.bytes(3000))
+        self.assertEqual(hashfile.hash_files(self.files[:3], max_size=2500),
+                         [hashes[0], None, expected[2]])
+        self.assertEqual(hashfile.hash_files(self.files, 'sha1'),
+                         [hashfile.sha1(f) for f in self.files])
+
+    def test_hash_while_writing(self):
+        file_tmp = self.workdir.joinpath('toto.bin_tmp')
+        file_out = self.workdir.joinpath('toto.bin')
+        data = np.random.bytes(50000)
+        with patch.object(hashfile, 'FOLLOW_POLL', 0.01):
+            with hashfile.hash_while_writing(file_tmp, register_as=file_out) as hasher:
+                with open(file_tmp, 'wb') as fid:
+                    for i in range(0, len(data), 10000):
+                        fid.write(data[i:i + 10000])
+                        fid.flush()
+                        time.sleep(0.02)
+        file_tmp.rename(file_out)
+        self.assertEqual(hasher.hexdigest(), hashfile.md5(file_out))
+        with patch.object(hashfile, '_hash_file') as hf:
+            self.assertEqual(hashfile.hash_files([file_out]), [hasher.hexdigest()])
+            hf.assert_not_called()
+        # if the writer rewinds, the hash is not cached
+        with patch.object(hashfile, 'FOLLOW_POLL', 0.01), \
+                patch.object(hashfile.HashCache, 'set') as hs:
+            with hashfile.hash_while_writing(file_tmp):
+                with open(file_tmp, 'wb') as fid:
+                    fid.write(data)
+                    fid.flush()
+                    time.sleep(0.1)
+                    fid.seek(0)
+                    fid.truncate()
+                    fid.write(data[:100])
+            hs.assert_not_called()
+
+
+class TestsNpyHeader(unittest.TestCase):
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as td:
+            file_npy = Path(td).joinpath('toto.npy')
+            for arr in [np.zeros((4, 3), dtype=np.float32), np.asfortranarray(np.ones((2, 5))),
+                        np.arange(7, dtype='>i2')]:
+                np.save(file_npy, arr)
+                hdr = npy_header.read(file_npy)
+                self.assertEqual(hdr.shape, arr.shape)
+                self.assertEqual(npy_header.dtype(hdr), arr.dtype)
+                self.assertEqual(hdr.fortran_order, np.isfortran(arr))
+                self.assertEqual(npy_header.nbytes(hdr), arr.nbytes)
+                self.assertEqual(npy_header.offset(hdr) + arr.nbytes, file_npy.stat().st_size)
+            # version 2 headers
+            with open(file_npy, 'wb') as fid:
+                np.lib.format.write_array(fid, arr, version=(2, 0))
+            self.assertEqual(npy_header.read(file_npy).shape, (7,))
+            file_npy.write_bytes(b'toto')
+            with self.assertRaises(ValueError):
+                npy_header.read(file_npy)
+
+
 class TestSpikeGLX_glob_ephys(unittest.TestCase):
     """
     Creates mock acquisition folders architecture (omitting metadata files):
@@ -345,6 +444,55 @@ class TestsSpikeGLX_compress(unittest.TestCase):
         self.assertFalse(self.file_bin.exists())
         compare_data(sr_ref, self.sc)
 
+    def test_read_waveforms(self):
+        sr = self.sr
+        # spikes are unsorted and some waveforms overlap the file edges
+        samples = np.array([40000, 5, 1000, 1010, 76100, 20000, 1000])
+        ch = np.array([10, 3, 200])
+        wfs = sr.read_waveforms(samples, ch, window=(-30, 52))
+        self.assertEqual(wfs.shape, (7, 82, 3))
+        self.assertEqual(wfs.dtype, np.float32)
+        for i, s in enumerate(samples):
+            i0, i1 = (max(s - 30, 0), min(s + 52, sr.ns))
+            expected = np.zeros((82, 3), dtype=np.float32)
+            expected[i0 - s + 30:i1 - s + 30] = sr.read(slice(i0, i1), ch, sync=False)
+            self.assertTrue(np.all(wfs[i] == expected))
+        # channels can be specified for each spike, and output written to disk
+        chs = np.tile(ch, (7, 1))
+        chs[3] = [50, 51, 52]
+        wfs_ = sr.read_waveforms(samples, chs, window=(-30, 52),
+                                 out=self.workdir.joinpath('wfs.npy'))
+        self.assertTrue(isinstance(wfs_, np.memmap))
+        self.assertTrue(np.all(np.delete(wfs_, 3, axis=0) == np.delete(wfs, 3, axis=0)))
+        self.assertTrue(np.all(wfs_[3] == sr.read(slice(980, 1062), chs[3], sync=False)))
+        del wfs_
+
+    def test_mtscomp_parallel_cache(self):
+        file_cbin = self.sr.compress_file()
+        sc = spikeglx.Reader(file_cbin, nthreads=3, cache_size=4)
+        nchunks = sc._raw.n_chunks
+        self.assertEqual(nchunks, 3)
+        # a slice over all chunks decompresses them in parallel and returns the same data
+        self.assertTrue(np.all(sc[100:76000, :] == self.sr[100:76000, :]))
+        self.assertEqual(sc._raw.n_decompressed, nchunks)
+        # snippets in cached chunks do not cost any decompression
+        for i0 in np.arange(0, 76000, 5000):
+            self.assertTrue(np.all(sc[i0:i0 + 82, 5:10] == self.sr[i0:i0 + 82, 5:10]))
+            self.assertTrue(np.all(sc._raw[int(i0)] == self.sr._raw[int(i0)]))
+        self.assertEqual(sc._raw.n_decompressed, nchunks)
+        # sequential reads decompress the next chunks in advance
+        sc = spikeglx.Reader(file_cbin, nthreads=2, cache_size=4)
+        sc.read_samples(0, 100)
+        sc.read_samples(100, 200)
+        [f.result() for f in list(sc._raw._futures.values())]
+        self.assertEqual(sc._raw.n_decompressed, nchunks)
+        # the cache is bounded
+        sc = spikeglx.Reader(file_cbin, nthreads=2, cache_size=1)
+        sc.read_samples(0, 40000)
+        self.assertEqual(len(sc._raw._cache), 1)
+        self.assertTrue(np.all(sc._raw[-5:] == self.sr._raw[-5:]))
+        sc._raw.close()
+
 
 class TestsSpikeGLX_Meta(unittest.TestCase):
 
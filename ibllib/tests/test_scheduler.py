@@ -0,0 +1,339 @@
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+import ibllib.pipes.tasks
+from ibllib.pipes import scheduler, local_server
+
+
+class _SleepTask(ibllib.pipes.tasks.Task):
+    """Writes its start and end times in the session folder"""
+    sleep = 0.4
+
+    def _run(self):
+        t0 = time.time()
+        time.sleep(self.sleep)
+        out_file = Path(self.session_path).joinpath(f'{self.name}.json')
+        out_file.write_text(json.dumps({'start': t0, 'end': time.time()}))
+        return [out_file]
+
+
+class TaskA(_SleepTask):
+    pass
+
+
+class TaskB(_SleepTask):
+    pass
+
+
+class TaskC(_SleepTask):
+    pass
+
+
+class TaskSlow(_SleepTask):
+    sleep = 30
+
+
+class TaskScanRaw(_SleepTask):
+    """Lists the raw files, then reads each of them, as ephysqc.raw_scan_session"""
+
+    def _run(self):
+        raw_files = sorted(Path(self.session_path).glob('*.bin'))
+        time.sleep(self.sleep)
+        nbytes = sum(len(f.read_bytes()) for f in raw_files)
+        out_file = Path(self.session_path).joinpath(f'{self.name}.json')
+        out_file.write_text(json.dumps({'start': 0, 'end': time.time(), 'nbytes': nbytes}))
+        return [out_file]
+
+
+class TaskScanRawQC(TaskScanRaw):
+    pass
+
+
+class TaskCompressRaw(_SleepTask):
+    """Compresses the raw files and deletes them, as EphysMtscomp"""
+
+    def _run(self):
+        t0 = time.time()
+        out_files = []
+        for raw_file in sorted(Path(self.session_path).glob('*.bin')):
+            out_files.append(raw_file.with_suffix('.cbin'))
+            out_files[-1].write_bytes(raw_file.read_bytes())
+            raw_file.unlink()
+        out_file = Path(self.session_path).joinpath(f'{self.name}.json')
+        out_file.write_text(json.dumps({'start': t0, 'end': time.time()}))
+        return out_files
+
+
+class TaskMemory(_SleepTask):
+    """Allocates 100 Mb and starts a subprocess allocating 100 Mb for a second"""
+
+    def _run(self):
+        a = np.ones(100 * 2 ** 17)
+        subprocess.run([sys.executable, '-c', 'import time; import numpy as np; '
+                        'a = np.ones(100 * 2 ** 17); time.sleep(1)'], check=True)
+        return super(TaskMemory, self)._run() if a.size else None
+
+
+class TaskSubprocess(_SleepTask):
+    """Starts a long subprocess, writes its pid in the session folder and waits for it"""
+
+    def _run(self):
+        proc = subprocess.Popen(['sleep', '60'])
+        Path(self.session_path).joinpath('subprocess.pid').write_text(str(proc.pid))
+        proc.wait()
+
+
+class TaskError(_SleepTask):
+
+    def _run(self):
+        raise Exception('Something dumb happened')
+
+
+class TaskCrash(_SleepTask):
+
+    def _run(self):
+        import os
+        os._exit(1)
+
+
+def _tdict(name, parents=None, **kwargs):
+    tdict = {'id': str(uuid.uuid4()), 'name': name, 'status': 'Waiting', 'session': 'eid',
+             'executable': f'ibllib.tests.test_scheduler.{name}', 'parents': parents or [],
+             'priority': 30, 'level': 0, 'cpu': 1, 'gpu': 0, 'ram': 1, 'io_charge': 10,
+             'time_out_sec': None}
+    tdict.update(kwargs)
+    return tdict
+
+
+def _mock_one(task_deck):
+    """ONE instance whose Alyx client updates tasks from a deck and accepts any registration"""
+    tasks = {t['id']: t for t in task_deck}
+
+    def rest(url, action, id=None, data=None, **kwargs):
+        if url == 'tasks' and action == 'partial_update':
+            tasks[id] = dict(tasks[id], **data)
+            return tasks[id]
+        if url == 'tasks' and action == 'read':
+            return tasks[id]
+        if url == 'register-file':
+            return [{'name': Path(f).name} for f in data['filenames']]
+
+    one = mock.MagicMock()
+    one.alyx.rest.side_effect = rest
+    one._par.ALYX_LOGIN = 'test_user'
+    return one
+
+
+class TestTaskScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.session_path = Path(self.td.name).joinpath('subject', '2020-01-01', '001')
+        self.session_path.mkdir(parents=True)
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def _times(self, name):
+        return json.loads(self.session_path.joinpath(f'{name}.json').read_text())
+
+    def test_run_dependencies(self):
+        a, b, err = _tdict('TaskA', priority=90), _tdict('TaskB'), _tdict('TaskError')
+        c = _tdict('TaskC', parents=[a['id']], level=1)
+        held = _tdict('TaskB', parents=[err['id']], level=1)
+        done = _tdict('TaskA', status='Complete')
+        deck = [held, c, b, a, err, done]
+        sched = scheduler.TaskScheduler(one=_mock_one(deck), cpu=4, poll=0.05)
+        deck, dsets = sched.run(deck, self.session_path)
+        statuses = {t['id']: t['status'] for t in deck}
+        self.assertEqual(statuses, {a['id']: 'Complete', b['id']: 'Complete',
+                                    c['id']: 'Complete', err['id']: 'Errored',
+                                    held['id']: 'Held', done['id']: 'Complete'})
+        self.assertEqual(sorted(d['name'] for d in dsets),
+                         ['TaskA.json', 'TaskB.json', 'TaskC.json'])
+        # level 0 tasks ran concurrently and the child task started after its parent ended
+        ta, tb, tc = (self._times(n) for n in ['TaskA', 'TaskB', 'TaskC'])
+        self.assertTrue(tb['start'] < ta['end'] and ta['start'] < tb['end'])
+        self.assertTrue(tc['start'] >= ta['end'])
+        self.assertEqual(len(sched.stats), 4)
+        self.assertTrue(all(s.wall_time > 0 for s in sched.stats))
+        self.assertTrue(all(s.peak_rss_mb > 0 for s in sched.stats))
+
+    def test_resources_packing(self):
+        # both tasks fit the cpu budget but not the ram budget together
+        a, b = _tdict('TaskA', ram=3, priority=50), _tdict('TaskB', ram=3)
+        deck = [a, b]
+        sched = scheduler.TaskScheduler(one=_mock_one(deck), cpu=4, ram=4, poll=0.05)
+        deck, _ = sched.run(deck, self.session_path)
+        self.assertTrue(all(t['status'] == 'Complete' for t in deck))
+        ta, tb = self._times('TaskA'), self._times('TaskB')
+        self.assertTrue(tb['start'] >= ta['end'])
+        # tasks requiring more than the budget are clipped and run alone
+        self.assertEqual(sched.requirements(_tdict('TaskA', cpu=64))['cpu'], 4)
+
+    def test_raw_files_deletion(self):
+        # the compression deletes the raw files and runs after all the tasks reading them
+        raw_files = [self.session_path.joinpath(f'raw{i}.bin') for i in range(2)]
+        for raw_file in raw_files:
+            raw_file.write_bytes(b'0' * 1000)
+        scan = _tdict('TaskScanRaw', priority=90)
+        qc = _tdict('TaskScanRawQC', parents=[scan['id']], level=1)
+        compress = _tdict('TaskCompressRaw', parents=[scan['id'], qc['id']], level=2,
+                          priority=50)
+        deck = [compress, qc, scan, _tdict('TaskA')]
+        sched = scheduler.TaskScheduler(one=_mock_one(deck), cpu=4, poll=0.05)
+        deck, dsets = sched.run(deck, self.session_path)
+        self.assertTrue(all(t['status'] == 'Complete' for t in deck))
+        self.assertEqual(self._times('TaskScanRaw')['nbytes'], 2000)
+        self.assertEqual(self._times('TaskScanRawQC')['nbytes'], 2000)
+        self.assertTrue(self._times('TaskCompressRaw')['start'] >=
+                        self._times('TaskScanRawQC')['end'])
+        self.assertFalse(any(f.exists() for f in raw_files))
+        self.assertTrue(all(f.with_suffix('.cbin').exists() for f in raw_files))
+
+    def test_ephys_pipeline_raw_files(self):
+        from ibllib.pipes.ephys_preprocessing import EphysExtractionPipeline
+        pipe = EphysExtractionPipeline(self.session_path)
+        # the raw files compression runs after the tasks reading the raw files
+        parents = [t.name for t in pipe.tasks['EphysMtscomp'].parents]
+        self.assertTrue({'EphysPulses', 'RawEphysQC'} <= set(parents))
+        # the tasks levels are consistent with their dependencies
+        for name in ['EphysRawQC', 'EphysMtscomp', 'SpikeSorting', 'EphysCellsQc']:
+            task = pipe.tasks[name]
+            self.assertTrue(all(p.level < task.level for p in task.parents), name)
+
+    def test_peak_memory(self):
+        # the memory of the parent shared with the forked workers is not attributed to the tasks
+        parent_memory = np.ones(400 * 2 ** 17)
+        deck = [_tdict('TaskMemory')]
+        sched = scheduler.TaskScheduler(one=_mock_one(deck), cpu=1, poll=0.05)
+        deck, _ = sched.run(deck, self.session_path)
+        self.assertEqual(deck[0]['status'], 'Complete')
+        # 100 Mb in the worker plus the largest subprocess, numpy and 100 Mb
+        self.assertTrue(200 < sched.stats[0].peak_rss_mb < 400, sched.stats[0].peak_rss_mb)
+        self.assertTrue(parent_memory.size)
+
+    @unittest.skipIf(sys.platform == 'win32', 'process groups are posix only')
+    def test_timeout_subprocesses(self):
+        # the subprocesses of a task that times out are terminated with its worker process
+        deck = [_tdict('TaskSubprocess', time_out_sec=1)]
+        sched = scheduler.TaskScheduler(one=_mock_one(deck), cpu=1, poll=0.05)
+        deck, _ = sched.run(deck, self.session_path)
+        self.assertEqual(deck[0]['status'], 'Errored')
+        pid = int(self.session_path.joinpath('subprocess.pid').read_text())
+        time.sleep(0.2)  # the orphaned subprocess is reaped by init
+        stat_file = Path(f'/proc/{pid}/stat')
+        self.assertTrue(not stat_file.exists() or stat_file.read_text().split()[2] == 'Z')
+
+    def test_worker_failure(self):
+        crash = _tdict('TaskCrash')
+        child = _tdict('TaskA', parents=[crash['id']], level=1)
+        deck = [crash, child]
+        one = _mock_one(deck)
+        sched = scheduler.TaskScheduler(one=one, cpu=2, poll=0.05)
+        deck, _ = sched.run(deck, self.session_path)
+        self.assertEqual([t['status'] for t in deck], ['Errored', 'Held'])
+        # the task died without reporting its status, the scheduler flags it as errored
+        self.assertIn('exit code 1', one.alyx.rest('tasks', 'read', id=crash['id'])['log'])
+
+
+def _shared_one(task_deck, manager):
+    """ONE instance whose Alyx tasks are shared with the worker processes, sessions by lab"""
+    tasks = manager.dict({t['id']: t for t in task_deck})
+
+    def rest(url, action, id=None, data=None, **kwargs):
+        if url == 'tasks' and action == 'list':
+            return [t for t in tasks.values() if t['status'] == kwargs['status']]
+        if url == 'tasks' and action == 'partial_update':
+            tasks[id] = dict(tasks[id], **data)
+            return tasks[id]
+        if url == 'tasks' and action == 'read':
+            return tasks[id]
+        if url == 'sessions':
+            eid = kwargs['django'].split(',')[1]
+            return [{'subject': eid, 'start_time': '2020-01-01T12:00:00', 'number': 1}]
+        if url == 'register-file':
+            return [{'name': Path(f).name} for f in data['filenames']]
+
+    one = mock.MagicMock()
+    one.alyx.rest.side_effect = rest
+    one._par.ALYX_LOGIN = 'test_user'
+    return one, tasks
+
+
+class TestJobRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.manager = multiprocessing.Manager()
+        for eid in ['eid0', 'eid1']:
+            Path(self.td.name).joinpath(eid, '2020-01-01', '001').mkdir(parents=True)
+
+    def tearDown(self):
+        self.manager.shutdown()
+        self.td.cleanup()
+
+    def _runner(self, deck, **kwargs):
+        one, tasks = _shared_one(deck, self.manager)
+        sched = scheduler.TaskScheduler(one=one, cpu=2, poll=0.05)
+        runner = local_server.JobRunner(self.td.name, one=one, lab='lab', task_scheduler=sched,
+                                        refill_interval=0.2, **kwargs)
+        return runner, tasks
+
+    def test_run_until_empty(self):
+        a, b = _tdict('TaskA', session='eid0'), _tdict('TaskB', session='eid1', priority=90)
+        c = _tdict('TaskC', session='eid0', parents=[a['id']], level=1)
+        metrics_file = Path(self.td.name).joinpath('metrics.json')
+        runner, tasks = self._runner([c, a, b], metrics_file=metrics_file)
+        self.assertEqual(runner.refill(), 3)
+        # the queue is prioritized across sessions and refilled incrementally
+        self.assertEqual(sorted(runner.queue.values())[0][1]['id'], b['id'])
+        d = _tdict('TaskA', session='eid1')
+        tasks[d['id']] = d
+        self.assertEqual(runner.refill(), 1)
+        self.assertEqual(len(runner.queue), 4)
+        runner.run(until_empty=True)
+        self.assertTrue(all(t['status'] == 'Complete' for t in tasks.values()))
+        # the child task started after its parent ended
+        times = [json.loads(Path(self.td.name).joinpath(
+            'eid0', '2020-01-01', '001', f'{n}.json').read_text()) for n in ['TaskA', 'TaskC']]
+        self.assertTrue(times[1]['start'] >= times[0]['end'])
+        metrics = json.loads(metrics_file.read_text())
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['running'], 0)
+        self.assertTrue(metrics['tasks_per_hour'] > 0)
+        self.assertEqual({k: v['count'] for k, v in metrics['tasks'].items()},
+                         {'TaskA': 2, 'TaskB': 1, 'TaskC': 1})
+
+    def test_graceful_shutdown(self):
+        slow = _tdict('TaskSlow', session='eid0')
+        child = _tdict('TaskA', session='eid0', parents=[slow['id']], level=1)
+        runner, tasks = self._runner([slow, child], shutdown_timeout=0.2)
+        timer = threading.Timer(1, os.kill, args=(os.getpid(), signal.SIGTERM))
+        timer.start()
+        t0 = time.time()
+        runner.run()
+        timer.join()
+        self.assertTrue(time.time() - t0 < 10)
+        # the running task is requeued on Alyx and the signal handler is restored
+        self.assertEqual(tasks[slow['id']]['status'], 'Waiting')
+        self.assertEqual(tasks[child['id']]['status'], 'Waiting')
+        self.assertFalse(runner.scheduler.running)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+
+if __name__ == "__main__":
+    unittest.main(exit=False)
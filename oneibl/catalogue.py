@@ -0,0 +1,317 @@
+"""
+Local catalogue of the sessions and datasets known to ONE, persisted in a sqlite database in the
+cache directory. Records are indexed by session, dataset type and dataset id so that lookups and
+incremental upserts do not depend on the size of the catalogue. The database runs in WAL mode
+with a busy timeout so that several processes on the same machine can read and write it
+concurrently. The database file is only created on the first write.
+
+UUIDs are stored as pairs of int64 as in the parquet tables (see brainbox.io.parquet).
+"""
+from contextlib import contextmanager
+import logging
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from brainbox.io import parquet
+
+_logger = logging.getLogger('ibllib')
+
+CATALOGUE_FILE = '.one_cache.sqlite'
+LEGACY_CACHE_FILE = '.one_cache.parquet'
+
+SESSION_COLUMNS = ['eid_0', 'eid_1', 'lab', 'subject', 'start_time', 'date', 'number',
+                   'task_protocol', 'project', 'users', 'location', 'n_trials',
+                   'n_correct_trials', 'complete']
+DATASET_COLUMNS = ['id_0', 'id_1', 'eid_0', 'eid_1', 'name', 'dataset_type', 'collection',
+                   'file_size', 'hash']
+# columns of the legacy parquet cache, returned by Catalogue.datasets
+CACHE_COLUMNS = ['id_0', 'id_1', 'name', 'dataset_type', 'file_size', 'hash', 'collection',
+                 'subject', 'lab', 'eid_0', 'eid_1', 'start_time', 'number', 'task_protocol']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    eid_0 INTEGER NOT NULL, eid_1 INTEGER NOT NULL,
+    lab TEXT, subject TEXT, start_time TEXT, date TEXT, number INTEGER,
+    task_protocol TEXT, project TEXT, users TEXT, location TEXT,
+    n_trials INTEGER, n_correct_trials INTEGER,
+    complete INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (eid_0, eid_1));
+CREATE INDEX IF NOT EXISTS ix_sessions_path ON sessions (subject, date, number);
+CREATE TABLE IF NOT EXISTS datasets (
+    id_0 INTEGER NOT NULL, id_1 INTEGER NOT NULL,
+    eid_0 INTEGER NOT NULL, eid_1 INTEGER NOT NULL,
+    name TEXT, dataset_type TEXT, collection TEXT, file_size REAL, hash TEXT,
+    PRIMARY KEY (id_0, id_1));
+CREATE INDEX IF NOT EXISTS ix_datasets_session ON datasets (eid_0, eid_1, dataset_type);
+"""
+# columns added to the sessions table after its creation: name, sql type
+_SESSION_MIGRATIONS = [('n_trials', 'INTEGER'), ('n_correct_trials', 'INTEGER')]
+
+
+def _to_int(x):
+    return None if x is None or pd.isna(x) else int(x)
+
+
+class Catalogue:
+    """
+    Sessions and datasets catalogue stored in `cache_dir/.one_cache.sqlite`.
+    The database is created on the first write, or on first access if a legacy
+    `.one_cache.parquet` cache found in the same folder has to be imported.
+
+    cat = Catalogue(cache_dir)
+    cat.upsert(df)  # dataframe of datasets joined with their sessions fields
+    df = cat.datasets(eid, dataset_types=['spikes.times'])
+    """
+
+    def __init__(self, cache_dir, timeout=60):
+        self.db_file = Path(cache_dir).joinpath(CATALOGUE_FILE)
+        self.timeout = timeout
+        self._initialized = False  # the schema of the database file is up to date
+
+    def _init_db(self):
+        """
+        Creates the database file and its schema if needed, migrates the schema of an existing
+        database and imports the legacy parquet cache in a new database.
+        """
+        new = not self.db_file.exists()
+        if new:
+            self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(str(self.db_file), timeout=self.timeout)
+        try:
+            with con:
+                con.executescript(_SCHEMA)
+                existing = {r[1] for r in con.execute('PRAGMA table_info(sessions)')}
+                for col, typ in _SESSION_MIGRATIONS:
+                    if col not in existing:
+                        con.execute(f'ALTER TABLE sessions ADD COLUMN {col} {typ}')
+        finally:
+            con.close()
+        self._initialized = True
+        legacy_file = self.db_file.parent.joinpath(LEGACY_CACHE_FILE)
+        if new and legacy_file.exists():
+            _logger.info(f"importing {legacy_file} in {self.db_file}")
+            self.upsert(parquet.load(legacy_file), complete=False)
+
+    @contextmanager
+    def _connect(self, write=False):
+        """
+        Opens a connection for a single transaction, committed on exit. Connections are not
+        shared so that the catalogue can be used from several threads and processes.
+        Reading a catalogue that doesn't exist yet uses an empty in-memory database.
+
+        :param write: if True, creates the database file if it doesn't exist
+        """
+        if self._initialized or self.db_file.exists() or write or \
+                self.db_file.parent.joinpath(LEGACY_CACHE_FILE).exists():
+            if not self._initialized:
+                self._init_db()
+            con = sqlite3.connect(str(self.db_file), timeout=self.timeout)
+        else:
+            con = sqlite3.connect(':memory:')
+            con.executescript(_SCHEMA)
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def __len__(self):
+        with self._connect() as con:
+            return con.execute('SELECT COUNT(*) FROM datasets').fetchone()[0]
+
+    @property
+    def size(self):
+        return len(self)
+
+    def upsert(self, df, complete=False):
+        """
+        Inserts or updates datasets records and their sessions
+
+        :param df: pandas dataframe of datasets with the columns of the legacy parquet cache
+         (see CACHE_COLUMNS and _ses2pandas) and optionally the session fields in SESSION_COLUMNS
+        :param complete: if True, flags the sessions as having all of their datasets in the
+         catalogue: the datasets of these sessions missing from the dataframe are removed
+        :return: number of records inserted, changed or removed
+        """
+        if df is None or df.size == 0:
+            return 0
+        ses = df.drop_duplicates(subset=['eid_0', 'eid_1'])
+        ses_recs = []
+        for _, s in ses.iterrows():
+            start_time = pd.Timestamp(s['start_time']).isoformat()
+            ses_recs.append(dict(zip(SESSION_COLUMNS, (
+                int(s['eid_0']), int(s['eid_1']), s.get('lab'), s.get('subject'), start_time,
+                start_time[:10], int(s['number']), s.get('task_protocol'), s.get('project'),
+                s.get('users'), s.get('location'), _to_int(s.get('n_trials')),
+                _to_int(s.get('n_correct_trials')), int(complete)))))
+        dset_recs = [dict(zip(DATASET_COLUMNS, rec)) for rec in zip(
+            df['id_0'].astype(np.int64).tolist(), df['id_1'].astype(np.int64).tolist(),
+            df['eid_0'].astype(np.int64).tolist(), df['eid_1'].astype(np.int64).tolist(),
+            df['name'].tolist(), df['dataset_type'].tolist(), df['collection'].tolist(),
+            df['file_size'].astype(np.double).tolist(), df['hash'].tolist())]
+        with self._connect(write=True) as con:
+            n0 = con.total_changes
+            # INSERT OR IGNORE followed by UPDATE rather than an upsert clause that requires
+            # sqlite >= 3.24. Only the fields that changed are written: unchanged records are
+            # left untouched
+            con.executemany(
+                f"INSERT OR IGNORE INTO sessions ({', '.join(SESSION_COLUMNS)}) VALUES "
+                f"({', '.join(':' + c for c in SESSION_COLUMNS)})", ses_recs)
+            con.executemany(
+                "UPDATE sessions SET "
+                + ', '.join(f'{c} = COALESCE(:{c}, {c})' for c in SESSION_COLUMNS[2:-1])
+                + ', complete = MAX(complete, :complete) '
+                "WHERE eid_0 = :eid_0 AND eid_1 = :eid_1 AND ("
+                + ' OR '.join(f'(:{c} IS NOT NULL AND :{c} IS NOT {c})'
+                              for c in SESSION_COLUMNS[2:-1])
+                + ' OR :complete > complete)', ses_recs)
+            con.executemany(
+                f"INSERT OR IGNORE INTO datasets ({', '.join(DATASET_COLUMNS)}) VALUES "
+                f"({', '.join(':' + c for c in DATASET_COLUMNS)})", dset_recs)
+            con.executemany(
+                "UPDATE datasets SET "
+                + ', '.join(f'{c} = :{c}' for c in DATASET_COLUMNS[2:])
+                + ' WHERE id_0 = :id_0 AND id_1 = :id_1 AND ('
+                + ' OR '.join(f':{c} IS NOT {c}' for c in DATASET_COLUMNS[2:]) + ')',
+                dset_recs)
+            nchanges = con.total_changes - n0
+            if complete:
+                # the datasets that don't exist anymore are removed from complete sessions
+                con.execute('CREATE TEMP TABLE upserted (id_0 INTEGER, id_1 INTEGER)')
+                con.executemany('INSERT INTO upserted VALUES (:id_0, :id_1)', dset_recs)
+                nchanges += con.executemany(
+                    'DELETE FROM datasets WHERE eid_0 = :eid_0 AND eid_1 = :eid_1 AND NOT EXISTS '
+                    '(SELECT 1 FROM upserted u WHERE u.id_0 = datasets.id_0 AND '
+                    'u.id_1 = datasets.id_1)', ses_recs).rowcount
+                con.execute('DROP TABLE upserted')
+            return nchanges
+
+    def datasets(self, eid=None, dataset_types=None):
+        """
+        Returns the datasets records joined with their sessions fields
+
+        :param eid: session UUID string or list of UUID strings (default all sessions)
+        :param dataset_types: list of dataset types (default all dataset types)
+        :return: pandas dataframe with the columns of the legacy parquet cache
+        """
+        where, params = [], []
+        if eid is not None:
+            # the sessions are joined from a temporary table, as the number of query parameters
+            # is limited to 999 for sqlite < 3.32
+            eids = parquet.str2np(eid).tolist()
+        if dataset_types and dataset_types != ['__all__'] and dataset_types != '__all__':
+            dataset_types = [dataset_types] if isinstance(dataset_types, str) else dataset_types
+            where.append(f"d.dataset_type IN ({', '.join('?' * len(dataset_types))})")
+            params.extend(dataset_types)
+        sql = ("SELECT d.id_0, d.id_1, d.name, d.dataset_type, d.file_size, d.hash, "
+               "d.collection, s.subject, s.lab, d.eid_0, d.eid_1, s.start_time, s.number, "
+               "s.task_protocol FROM datasets d JOIN sessions s "
+               "ON d.eid_0 = s.eid_0 AND d.eid_1 = s.eid_1")
+        if eid is not None:
+            sql += " JOIN temp.eids e ON d.eid_0 = e.eid_0 AND d.eid_1 = e.eid_1"
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self._connect() as con:
+            if eid is not None:
+                con.execute('CREATE TEMP TABLE eids (eid_0 INTEGER, eid_1 INTEGER, '
+                            'PRIMARY KEY (eid_0, eid_1))')
+                con.executemany('INSERT OR IGNORE INTO eids VALUES (?, ?)', eids)
+            df = pd.read_sql_query(sql, con, params=params)
+            if eid is not None:
+                con.execute('DROP TABLE temp.eids')
+        df['start_time'] = pd.to_datetime(df['start_time'])
+        return df[CACHE_COLUMNS]
+
+    def session(self, eid):
+        """
+        :param eid: session UUID string
+        :return: dictionary of the session fields, None if the session is not in the catalogue
+        """
+        npeid = parquet.str2np(eid)[0]
+        with self._connect() as con:
+            con.row_factory = sqlite3.Row
+            rec = con.execute('SELECT * FROM sessions WHERE eid_0 = ? AND eid_1 = ?',
+                              (int(npeid[0]), int(npeid[1]))).fetchone()
+        return None if rec is None else dict(rec)
+
+    def eid_from_path(self, subject, date, number):
+        """
+        :param subject: subject nickname
+        :param date: session date as an ISO string 'yyyy-mm-dd'
+        :param number: session number
+        :return: eid UUID string, None if the session is not in the catalogue
+        """
+        with self._connect() as con:
+            rec = con.execute('SELECT eid_0, eid_1 FROM sessions WHERE subject = ? AND '
+                              'date = ? AND number = ?', (subject, date, int(number))).fetchone()
+        return None if rec is None else parquet.np2str(np.array(rec, dtype=np.int64))
+
+    def search(self, dataset_types=None, users=None, subject=None, date_range=None, lab=None,
+               task_protocol=None, number=None, location=None, project=None,
+               performance_lte=None, performance_gte=None):
+        """
+        Searches sessions with the same semantics as the Alyx sessions endpoint filters.
+        All filters are lists, except date_range (2 ISO dates, inclusive) and performances.
+
+        :param dataset_types: sessions having all of the dataset types
+        :param users: sessions having all of the users
+        :param subject, lab, location, project, number: sessions matching any of the values
+        :param task_protocol: sessions whose task protocol contains any of the strings
+        :param performance_lte / performance_gte: percentage of correct trials bounds
+        :return: list of sessions dictionaries, most recent first
+        """
+        where, params = [], []
+
+        def isin(field, values):
+            where.append(f"s.{field} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+        for field, values in zip(['subject', 'lab', 'location', 'project'],
+                                 [subject, lab, location, project]):
+            if values:
+                isin(field, list(values))
+        if number:
+            isin('number', [int(n) for n in number])
+        if task_protocol:
+            where.append('(' + ' OR '.join(['s.task_protocol LIKE ?'] * len(task_protocol)) + ')')
+            params.extend([f'%{t}%' for t in task_protocol])
+        for user in users or []:
+            where.append("(',' || s.users || ',') LIKE ?")
+            params.append(f'%,{user},%')
+        if date_range:
+            where.append('s.date BETWEEN ? AND ?')
+            params.extend([str(d)[:10] for d in date_range])
+        for bound, op in zip([performance_lte, performance_gte], ['<=', '>=']):
+            if bound is not None:
+                where.append(f's.n_trials > 0 AND 100.0 * s.n_correct_trials / s.n_trials {op} ?')
+                params.append(float(bound))
+        if dataset_types:
+            dataset_types = sorted(set(dataset_types))
+            where.append(
+                '(SELECT COUNT(DISTINCT d.dataset_type) FROM datasets d WHERE '
+                'd.eid_0 = s.eid_0 AND d.eid_1 = s.eid_1 AND d.dataset_type IN '
+                f"({', '.join('?' * len(dataset_types))})) = ?")
+            params.extend(dataset_types + [len(dataset_types)])
+        sql = 'SELECT * FROM sessions s'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY s.start_time DESC'
+        with self._connect() as con:
+            con.row_factory = sqlite3.Row
+            recs = [dict(r) for r in con.execute(sql, params)]
+        for rec in recs:
+            rec['eid'] = parquet.np2str(np.array([rec.pop('eid_0'), rec.pop('eid_1')]))
+            rec['users'] = rec['users'].split(',') if rec['users'] else []
+        return recs
+
+    def dataset_types(self):
+        """
+        :return: sorted list of the dataset types present in the catalogue
+        """
+        with self._connect() as con:
+            return [r[0] for r in con.execute(
+                'SELECT DISTINCT dataset_type FROM datasets ORDER BY dataset_type')]
@@ -12,7 +12,6 @@ from uuid import UUID
 
 import requests
 import tqdm
-import pandas as pd
 import numpy as np
 
 import oneibl.params
@@ -25,8 +24,8 @@ from ibllib.exceptions import \
 from ibllib.io import hashfile
 from ibllib.misc import pprint
 from oneibl.dataclass import SessionDataInfo
+from oneibl.catalogue import Catalogue
 from brainbox.io import parquet
-from brainbox.numerical import ismember, ismember2d, find_first_2d
 
 _logger = logging.getLogger('ibllib')
 
@@ -34,7 +33,7 @@ _logger = logging.getLogger('ibllib')
 def Listable(t): return Union[t, Sequence[t]]  # noqa
 
 
-NTHREADS = 4  # number of download threads
+NTHREADS = wc.DOWNLOAD_THREADS  # number of download threads
 
 _ENDPOINTS = {  # keynames are possible input arguments and values are actual endpoints
     'data': 'dataset-types',
@@ -98,8 +97,10 @@ def _ses2pandas(ses, dtypes=None):
     :param dtypes: list of dataset types
     :return:
     """
-    # selection: get relevant dtypes only if there is an url associated
-    rec = list(filter(lambda x: x['url'], ses['data_dataset_session_related']))
+    # selection: get relevant dtypes only if there is a data url associated, that is only the
+    # datasets with an existing file record as per the Alyx `exists=True` datasets filter
+    rec = list(filter(lambda x: x['url'] and x.get('data_url'),
+                      ses['data_dataset_session_related']))
     if dtypes == ['__all__'] or dtypes == '__all__':
         dtypes = None
     if dtypes is not None:
@@ -108,12 +109,79 @@ def _ses2pandas(ses, dtypes=None):
     uuid_fields = ['id', 'eid']
     join = {'subject': ses['subject'], 'lab': ses['lab'], 'eid': ses['url'][-36:],
             'start_time': np.datetime64(ses['start_time']), 'number': ses['number'],
-            'task_protocol': ses['task_protocol']}
+            'task_protocol': ses['task_protocol'], 'project': ses.get('project'),
+            'users': ','.join(ses.get('users') or []), 'location': ses.get('location'),
+            'n_trials': ses.get('n_trials'), 'n_correct_trials': ses.get('n_correct_trials')}
     col = parquet.rec2col(rec, include=include, uuid_fields=uuid_fields, join=join,
                           types={'file_size': np.double}).to_df()
     return col
 
 
+def _parse_search_terms(kwargs):
+    """
+    Validates the search keywords against SEARCH_TERMS and formats the queries
+    :param kwargs: dictionary of search keywords and values
+    :return: dictionary of search fields and queries, None if a keyword is not valid
+    """
+    # small function to make sure string inputs are interpreted as lists
+    def validate_input(inarg):
+        if isinstance(inarg, str):
+            return [inarg]
+        elif isinstance(inarg, int):
+            return [str(inarg)]
+        else:
+            return inarg
+
+    queries = {}
+    for k in kwargs.keys():
+        # check that the input matches one of the defined filters
+        if k not in SEARCH_TERMS:
+            _logger.error(f'"{k}" is not a valid search keyword' + '\n' +
+                          "Valid keywords are: " + str(set(SEARCH_TERMS.values())))
+            return
+        # then make sure the field is formatted properly
+        field = SEARCH_TERMS[k]
+        if field == 'date_range':
+            queries[field] = _validate_date_range(kwargs[k])
+        elif field.startswith('performance'):
+            queries[field] = kwargs[k]
+        else:
+            queries[field] = validate_input(kwargs[k])
+    return queries
+
+
+def _object_datasets(names, collections, obj, source='Alyx'):
+    """
+    Selects the datasets of a single ALF object
+    :param names: list of datasets file names
+    :param collections: list of datasets collections
+    :param obj: ALF object name, supports asterisks as wildcards
+    :param source: where the datasets come from, for error messages
+    :return: indices of the object datasets
+    """
+    pattern = re.compile(fnmatch.translate(obj))
+
+    # Further refine by matching object part of ALF datasets
+    def match(name):
+        return is_valid(name) and pattern.match(alf_parts(name)[1])
+
+    imatch = [i for i, name in enumerate(names) if match(name)]
+    # Get filenames of returned ALF files
+    returned_obj = {alf_parts(names[i])[1] for i in imatch}
+
+    # Validate result before loading
+    if len(returned_obj) > 1:
+        raise ALFMultipleObjectsFound('The following matching objects were found: ' +
+                                      ', '.join(returned_obj))
+    elif len(returned_obj) == 0:
+        raise ALFObjectNotFound(f'ALF object "{obj}" not found on {source}')
+    collection_set = {collections[i] for i in imatch}
+    if len(collection_set) > 1:
+        raise ALFMultipleCollectionsFound('Matching object belongs to multiple collections:' +
+                                          ', '.join(collection_set))
+    return imatch
+
+
 def parse_id(method):
     """
     Ensures the input experiment identifier is an experiment UUID string
@@ -139,13 +207,8 @@ class OneAbstract(abc.ABC):
         self._par = self._par.set('ALYX_URL', base_url or self._par.ALYX_URL)
         self._par = self._par.set('ALYX_PWD', password or self._par.ALYX_PWD)
         self._par = self._par.set('CACHE_DIR', cache_dir or self._par.CACHE_DIR)
-        # init the cache file
-        self._cache_file = Path(self._par.CACHE_DIR).joinpath('.one_cache.parquet')
-        if self._cache_file.exists():
-            # we need to keep this part fast enough for transient objects
-            self._cache = parquet.load(self._cache_file)
-        else:
-            self._cache = pd.DataFrame()
+        # init the local sessions and datasets catalogue, the database is created on first write
+        self._catalogue = Catalogue(self._get_cache_dir(None))
 
     def _load(self, eid, dataset_types=None, dclass_output=False, download_only=False,
               offline=False, **kwargs):
@@ -198,14 +261,7 @@ class OneAbstract(abc.ABC):
         return cache_dir
 
     def _make_dataclass_offline(self, eid, dataset_types=None, cache_dir=None, **kwargs):
-        if self._cache.size == 0:
-            return SessionDataInfo()
-        # select the session
-        npeid = parquet.str2np(eid)[0]
-        df = self._cache[self._cache['eid_0'] == npeid[0]]
-        df = df[df['eid_1'] == npeid[1]]
-        # select datasets
-        df = df[ismember(df['dataset_type'], dataset_types)[0]]
+        df = self._catalogue.datasets(eid, dataset_types=dataset_types)
         return SessionDataInfo.from_pandas(df, self._get_cache_dir(cache_dir))
 
     def path_from_eid(self, eid: str) -> Optional[Listable(Path)]:
@@ -224,17 +280,11 @@ class OneAbstract(abc.ABC):
         if not alfio.is_uuid_string(eid):
             print(eid, " is not a valid eID/UUID string")
             return
-        if self._cache.size == 0:
-            return
-
         # load path from cache
-        ic = find_first_2d(
-            self._cache[['eid_0', 'eid_1']].to_numpy(), parquet.str2np(eid))
-        if ic is not None:
-            ses = self._cache.iloc[ic]
+        ses = self._catalogue.session(eid)
+        if ses is not None:
             return Path(self._par.CACHE_DIR).joinpath(
-                ses['lab'], 'Subjects', ses['subject'], ses['start_time'].isoformat()[:10],
-                str(ses['number']).zfill(3))
+                ses['lab'], 'Subjects', ses['subject'], ses['date'], str(ses['number']).zfill(3))
 
     def eid_from_path(self, path_obj):
         """
@@ -252,18 +302,90 @@ class OneAbstract(abc.ABC):
         # else ensure the path ends with mouse,date, number
         path_obj = Path(path_obj)
         session_path = alfio.get_session_path(path_obj)
-        # if path does not have a date and a number, or cache is empty return None
-        if session_path is None or self._cache.size == 0:
+        # if path does not have a date and a number return None
+        if session_path is None:
             return None
 
         # fetch eid from cache
-        ind = ((self._cache['subject'] == session_path.parts[-3]) &
-               (self._cache['start_time'].apply(
-                   lambda x: x.isoformat()[:10] == session_path.parts[-2])) &
-               (self._cache['number']) == int(session_path.parts[-1]))
-        ind = np.where(ind.to_numpy())[0]
-        if ind.size > 0:
-            return parquet.np2str(self._cache[['eid_0', 'eid_1']].iloc[ind[0]])
+        return self._catalogue.eid_from_path(*session_path.parts[-3:])
+
+    def to_eid(self,
+               id: Listable(Union[str, Path, UUID, dict]) = None,
+               cache_dir: Optional[Union[str, Path]] = None) -> Listable(str):
+        if isinstance(id, (list, tuple)):  # Recurse
+            return [self.to_eid(i, cache_dir) for i in id]
+        if isinstance(id, UUID):
+            return str(id)
+        # elif is_exp_ref(id):
+        #     return ref2eid(id, one=self)
+        elif isinstance(id, dict):
+            assert {'subject', 'number', 'start_time', 'lab'}.issubset(id)
+            root = Path(self._get_cache_dir(cache_dir))
+            id = root.joinpath(
+                id['lab'],
+                'Subjects', id['subject'],
+                id['start_time'][:10],
+                ('%03d' % id['number']))
+
+        if alfio.is_session_path(id):
+            return self.eid_from_path(id)
+        elif isinstance(id, str):
+            if len(id) > 36:
+                id = id[-36:]
+            if not alfio.is_uuid_string(id):
+                raise ValueError('Invalid experiment ID')
+            else:
+                return id
+        else:
+            raise ValueError('Unrecognized experiment ID')
+
+    def _search_cache(self, details=False, limit=None, **queries):
+        """
+        Searches sessions in the local catalogue, see OneAlyx.search
+        :param queries: search fields and queries as returned by _parse_search_terms
+        """
+        sessions = self._catalogue.search(**queries)[:limit]
+        eids = [s['eid'] for s in sessions]
+        if not details:
+            return eids
+        for s in sessions:
+            s['url'] = f"{self._par.ALYX_URL}/sessions/{s['eid']}"
+            s['local_path'] = str(Path(self._par.CACHE_DIR, s['lab'], 'Subjects', s['subject'],
+                                       s['date'], str(s['number']).zfill(3)))
+        return eids, sessions
+
+    def _list_cache(self, eid=None, details=False):
+        """
+        Lists the dataset types in the local catalogue, or the datasets of a session
+        :param eid: Experiment session uuid str
+        :param details: If false returns a list of path, otherwise returns the records dictionaries
+        """
+        if not eid:
+            return self._catalogue.dataset_types()
+        df = self._catalogue.datasets(eid)
+        if details:
+            return df.to_dict('records')
+        return sorted([Path(c).joinpath(n) for c, n in zip(df['collection'], df['name'])])
+
+    def _load_object_cache(self, eid, obj, collection='alf', download_only=False, **kwargs):
+        """
+        Loads an ALF object from the local files of datasets recorded in the catalogue, raises
+        ALFObjectNotFound if the object or any of its files is missing. See OneAlyx.load_object
+        """
+        df = self._catalogue.datasets(eid)
+        if collection and collection != 'all':
+            pattern = re.compile(collection.replace('*', '.*'))
+            df = df[[pattern.search(c) is not None for c in df['collection']]]
+        imatch = _object_datasets(df['name'].tolist(), df['collection'].tolist(), obj,
+                                  source='local cache')
+        dc = SessionDataInfo.from_pandas(df.iloc[imatch], self._get_cache_dir(None))
+        out_files = dc.local_path
+        if not all(f.exists() for f in out_files):
+            raise ALFObjectNotFound(f'ALF object "{obj}" files not found in local cache')
+        if download_only:
+            return out_files
+        else:
+            return alfio.load_object(out_files[0].parent, obj, **kwargs)
 
     @abc.abstractmethod
     def _make_dataclass(self, eid, dataset_types=None, cache_dir=None, **kwargs):
@@ -281,6 +403,10 @@ class OneAbstract(abc.ABC):
     def search(self, **kwargs):
         pass
 
+    @abc.abstractmethod
+    def load_object(self, eid, obj, **kwargs):
+        pass
+
 
 def ONE(offline=False, **kwargs):
     if offline:
@@ -295,13 +421,37 @@ class OneOffline(OneAbstract):
         return self._make_dataclass_offline(*args, **kwargs)
 
     def load(self, eid, **kwargs):
+        kwargs.setdefault('offline', True)
         return self._load(eid, **kwargs)
 
-    def list(self, **kwargs):
-        pass
+    def list(self, eid=None, details=False):
+        """
+        From a Session ID, lists the datasets related to a session in the local catalogue.
+        Without Session ID, lists the dataset types in the local catalogue.
+        See OneAlyx.list
+        """
+        return self._list_cache(self.to_eid(eid) if eid else None, details=details)
 
-    def search(self, **kwargs):
-        pass
+    def search(self, details=False, limit=None, **kwargs):
+        """
+        Applies a filter to the sessions of the local catalogue and returns a list of eids.
+        Accepts the same search terms as OneAlyx.search
+
+        >>> one.search(subject='KS005', date_range=['2019-04-01', '2019-04-30'])
+        """
+        queries = _parse_search_terms(kwargs)
+        if queries is None:
+            return
+        return self._search_cache(details=details, limit=limit, **queries)
+
+    @parse_id
+    def load_object(self, eid, obj, collection='alf', download_only=False, **kwargs):
+        """
+        Load all attributes of an ALF object from a Session ID and an object name, from the
+        local catalogue and files. See OneAlyx.load_object
+        """
+        return self._load_object_cache(eid, obj, collection=collection,
+                                       download_only=download_only, **kwargs)
 
 
 class OneAlyx(OneAbstract):
@@ -338,8 +488,8 @@ class OneAlyx(OneAbstract):
         out = self.alyx.rest('dataset-types', 'read', dataset_type)
         print(out['description'])
 
-    def list(self, eid: Optional[Union[str, Path, UUID]] = None, details=False
-             ) -> Union[List, Dict[str, str]]:
+    def list(self, eid: Optional[Union[str, Path, UUID]] = None, details=False,
+             use_cache: bool = True) -> Union[List, Dict[str, str]]:
         """
         From a Session ID, queries Alyx database for datasets related to a session.
 
@@ -349,12 +499,22 @@ class OneAlyx(OneAbstract):
         :param details: If false returns a list of path, otherwise returns the REST dictionary
         :type eid: bool
 
+        :param use_cache: if set to False, will force database connection. Otherwise the
+         datasets are listed from the local catalogue for sessions fully recorded in it
+        :type use_cache: bool
+
         :return: list of strings or dict of lists if details is True
         :rtype:  list, dict
         """
         if not eid:
             return [x['name'] for x in self.alyx.rest('dataset-types', 'list')]
 
+        # first try avoid hitting the database
+        if use_cache and not details:
+            ses = self._catalogue.session(eid)
+            if ses is not None and ses['complete']:
+                return self._list_cache(eid)
+
         # Session specific list
         dsets = self.alyx.rest('datasets', 'list', session=eid, exists=True)
         if not details:
@@ -447,6 +607,7 @@ class OneAlyx(OneAbstract):
                     obj: str,
                     collection: Optional[str] = 'alf',
                     download_only: bool = False,
+                    use_cache: bool = False,
                     **kwargs) -> Union[alfio.AlfBunch, List[Path]]:
         """
         Load all attributes of an ALF object from a Session ID and an object name.
@@ -457,6 +618,8 @@ class OneAlyx(OneAbstract):
         :param collection:  The collection to which the object belongs, e.g. 'alf/probe01'.
         Supports asterisks as wildcards.
         :param download_only: When true the data are downloaded and the file paths are returned
+        :param use_cache: When true, loads the object from the local catalogue and files if they
+        are all present, without connecting to the database
         :param kwargs: Optional filters for the ALF objects, including namespace and timescale
         :return: An ALF bunch or if download_only is True, a list of Paths objects
 
@@ -465,33 +628,22 @@ class OneAlyx(OneAbstract):
         load_object(eid, 'trials')
         load_object(eid, 'spikes', collection='*probe01')
         """
+        if use_cache:
+            try:
+                return self._load_object_cache(eid, obj, collection=collection,
+                                               download_only=download_only, **kwargs)
+            except ALFObjectNotFound:
+                _logger.info(f'ALF object "{obj}" not in local cache, querying Alyx')
         # Filter server-side by collection and dataset name
         search_str = 'name__regex,' + obj.replace('*', '.*')
         if collection and collection != 'all':
             search_str += ',collection__regex,' + collection.replace('*', '.*')
         results = self.alyx.rest('datasets', 'list', session=eid, django=search_str)
-        pattern = re.compile(fnmatch.translate(obj))
-
-        # Further refine by matching object part of ALF datasets
-        def match(r):
-            return is_valid(r['name']) and pattern.match(alf_parts(r['name'])[1])
-
-        # Get filenames of returned ALF files
-        returned_obj = {alf_parts(x['name'])[1] for x in results if match(x)}
-
-        # Validate result before loading
-        if len(returned_obj) > 1:
-            raise ALFMultipleObjectsFound('The following matching objects were found: ' +
-                                          ', '.join(returned_obj))
-        elif len(returned_obj) == 0:
-            raise ALFObjectNotFound(f'ALF object "{obj}" not found on Alyx')
-        collection_set = {x['collection'] for x in results if match(x)}
-        if len(collection_set) > 1:
-            raise ALFMultipleCollectionsFound('Matching object belongs to multiple collections:' +
-                                              ', '.join(collection_set))
+        imatch = _object_datasets([x['name'] for x in results],
+                                  [x['collection'] for x in results], obj)
 
         # Download and optionally load the datasets
-        out_files = self.download_datasets(x for x in results if match(x))
+        out_files = self.download_datasets(results[i] for i in imatch)
         assert not any(x is None for x in out_files), 'failed to download object'
         if download_only:
             return out_files
@@ -519,36 +671,6 @@ class OneAlyx(OneAbstract):
                     out.append(self._load(e, **kwargs)[0])
             return out
 
-    def to_eid(self,
-               id: Listable(Union[str, Path, UUID, dict]) = None,
-               cache_dir: Optional[Union[str, Path]] = None) -> Listable(str):
-        if isinstance(id, (list, tuple)):  # Recurse
-            return [self.to_eid(i, cache_dir) for i in id]
-        if isinstance(id, UUID):
-            return str(id)
-        # elif is_exp_ref(id):
-        #     return ref2eid(id, one=self)
-        elif isinstance(id, dict):
-            assert {'subject', 'number', 'start_time', 'lab'}.issubset(id)
-            root = Path(self._get_cache_dir(cache_dir))
-            id = root.joinpath(
-                id['lab'],
-                'Subjects', id['subject'],
-                id['start_time'][:10],
-                ('%03d' % id['number']))
-
-        if alfio.is_session_path(id):
-            return self.eid_from_path(id)
-        elif isinstance(id, str):
-            if len(id) > 36:
-                id = id[-36:]
-            if not alfio.is_uuid_string(id):
-                raise ValueError('Invalid experiment ID')
-            else:
-                return id
-        else:
-            raise ValueError('Unrecognized experiment ID')
-
     def _make_dataclass(self, eid, dataset_types=None, cache_dir=None, dry_run=False,
                         clobber=False, offline=False, keep_uuid=False):
         # if the input as an UUID, add the beginning of URL to it
@@ -613,7 +735,7 @@ class OneAlyx(OneAbstract):
 
     # def search(self, dataset_types=None, users=None, subjects=None, date_range=None,
     #            lab=None, number=None, task_protocol=None, details=False):
-    def search(self, details=False, limit=None, **kwargs):
+    def search(self, details=False, limit=None, use_cache=False, **kwargs):
         """
         Applies a filter to the sessions (eid) table and returns a list of json dictionaries
          corresponding to sessions.
@@ -659,6 +781,10 @@ class OneAlyx(OneAbstract):
         :param users: a list of users
         :type users: list or str
 
+        :param use_cache: default False, if True searches the sessions of the local catalogue
+         without connecting to the database
+        :type use_cache: bool
+
         :return: list of eids, if details is True, also returns a list of json dictionaries,
          each entry corresponding to a matching session
         :rtype: list, list
@@ -666,31 +792,17 @@ class OneAlyx(OneAbstract):
 
         """
 
-        # small function to make sure string inputs are interpreted as lists
-        def validate_input(inarg):
-            if isinstance(inarg, str):
-                return [inarg]
-            elif isinstance(inarg, int):
-                return [str(inarg)]
-            else:
-                return inarg
+        queries = _parse_search_terms(kwargs)
+        if queries is None:
+            return
+        if use_cache:
+            return self._search_cache(details=details, limit=limit, **queries)
 
         # loop over input arguments and build the url
         url = '/sessions?'
-        for k in kwargs.keys():
-            # check that the input matches one of the defined filters
-            if k not in SEARCH_TERMS:
-                _logger.error(f'"{k}" is not a valid search keyword' + '\n' +
-                              "Valid keywords are: " + str(set(SEARCH_TERMS.values())))
-                return
-            # then make sure the field is formatted properly
-            field = SEARCH_TERMS[k]
-            if field == 'date_range':
-                query = _validate_date_range(kwargs[k])
-            else:
-                query = validate_input(kwargs[k])
-            # at last append to the URL
-            url = url + f"&{field}=" + ','.join(query)
+        for field, query in queries.items():
+            query = query if isinstance(query, list) else [query]
+            url = url + f"&{field}=" + ','.join(map(str, query))
         # the REST pagination argument has to be the last one
         if limit:
             url += f'&limit={limit}'
@@ -793,7 +905,7 @@ class OneAlyx(OneAbstract):
             local_path, md5 = wc.http_download_file(
                 url, username=self._par.HTTP_DATA_SERVER_LOGIN,
                 password=self._par.HTTP_DATA_SERVER_PWD, cache_dir=str(target_dir),
-                clobber=clobber, return_md5=True)
+                clobber=clobber, return_md5=True, nthreads=NTHREADS)
             # post download, if there is a mismatch between Alyx and the newly downloaded file size
             # or hash flag the offending file record in Alyx for database maintenance
             hash_mismatch = hash and md5 != hash
@@ -851,7 +963,7 @@ class OneAlyx(OneAbstract):
             return
 
         # first try avoid hitting the database
-        if self._cache.size > 0 and use_cache:
+        if use_cache:
             cache_path = super().path_from_eid(eid)
             if cache_path:
                 return cache_path
@@ -887,7 +999,7 @@ class OneAlyx(OneAbstract):
             return None
 
         # try the cached info to possibly avoid hitting database
-        cache_eid = super().eid_from_path(path_obj)
+        cache_eid = super().eid_from_path(path_obj) if use_cache else None
         if cache_eid:
             return cache_eid
 
@@ -951,48 +1063,16 @@ class OneAlyx(OneAbstract):
         out.update({'local_path': self.path_from_eid(eid)})
         return out
 
-    def _update_cache(self, ses, dataset_types):
+    def _update_cache(self, ses, dataset_types=None):
         """
+        Upserts the session and all of its datasets in the local catalogue. As the session
+        details contain all datasets, the session is flagged as complete in the catalogue.
         :param ses: session details dictionary as per Alyx response
-        :param dataset_types:
+        :param dataset_types: unused, all the datasets of the session are recorded
         :return: is_updated (bool): if the cache was updated or not
         """
-        save = False
-        pqt_dsets = _ses2pandas(ses, dtypes=dataset_types)
-        # if the dataframe is empty, return
-        if pqt_dsets.size == 0:
-            return
-        # if the cache is empty create the cache variable
-        elif self._cache.size == 0:
-            self._cache = pqt_dsets
-            save = True
-        # the cache is not empty and there are datasets in the query
-        else:
-            isin, icache = ismember2d(pqt_dsets[['id_0', 'id_1']].to_numpy(),
-                                      self._cache[['id_0', 'id_1']].to_numpy())
-            # check if the hash / filesize fields have changed on patching
-            heq = (self._cache['hash'].iloc[icache].to_numpy() ==
-                   pqt_dsets['hash'].iloc[isin].to_numpy())
-            feq = np.isclose(self._cache['file_size'].iloc[icache].to_numpy(),
-                             pqt_dsets['file_size'].iloc[isin].to_numpy(),
-                             rtol=0, atol=0, equal_nan=True)
-            eq = np.logical_and(heq, feq)
-            # update new hash / filesizes
-            if not np.all(eq):
-                self._cache.iloc[icache].loc[:, ['file_size', 'hash']] = \
-                    pqt_dsets.iloc[np.where(isin)[0]].loc[:, ['file_size', 'hash']]
-                save = True
-            # append datasets that haven't been found
-            if not np.all(isin):
-                self._cache = self._cache.append(pqt_dsets.iloc[np.where(~isin)[0]])
-                self._cache = self._cache.reindex()
-                save = True
-        if save:
-            # before saving makes sure pandas did not cast uuids in float
-            typs = [t for t, k in zip(self._cache.dtypes, self._cache.keys()) if 'id_' in k]
-            assert (all(map(lambda t: t == np.int64, typs)))
-            # if this gets too big, look into saving only when destroying the ONE object
-            parquet.save(self._cache_file, self._cache)
+        pqt_dsets = _ses2pandas(ses)
+        return self._catalogue.upsert(pqt_dsets, complete=True) > 0
 
     def download_raw_partial(self, url_cbin, url_ch, first_chunk=0, last_chunk=0):
         assert url_cbin.endswith('.cbin')
@@ -1007,7 +1087,7 @@ class OneAlyx(OneAbstract):
             url_ch,
             username=self._par.HTTP_DATA_SERVER_LOGIN,
             password=self._par.HTTP_DATA_SERVER_PWD,
-            cache_dir=target_dir, clobber=True, offline=False, return_md5=False))
+            cache_dir=target_dir, clobber=True, return_md5=False))
         ch_local_path = alfio.remove_uuid_file(ch_local_path)
         ch_local_path_renamed = ch_local_path.with_suffix('.chopped.ch')
         ch_local_path.rename(ch_local_path_renamed)
@@ -1048,7 +1128,7 @@ class OneAlyx(OneAbstract):
             url_cbin,
             username=self._par.HTTP_DATA_SERVER_LOGIN,
             password=self._par.HTTP_DATA_SERVER_PWD,
-            cache_dir=target_dir, clobber=True, offline=False, return_md5=False,
+            cache_dir=target_dir, clobber=True, return_md5=False,
             chunks=(first_byte, n_bytes))
         cbin_local_path = alfio.remove_uuid_file(cbin_local_path)
         cbin_local_path_renamed = cbin_local_path.with_suffix(
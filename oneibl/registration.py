@@ -53,7 +53,7 @@ def register_dataset(file_list, one=None, created_by=None, repository=None, serv
     :param dry: (bool) False by default
     :param verbose: (bool) logs
     :param max_md5_size: (int) maximum file in bytes to compute md5 sum (always compute if Npne)
-    defaults to None
+    defaults to None. Hashes found in the hash cache are used regardless of the file size
     :return:
     """
     if created_by is None:
@@ -70,13 +70,10 @@ def register_dataset(file_list, one=None, created_by=None, repository=None, serv
         versions = [versions for _ in file_list]
     assert isinstance(versions, list) and len(versions) == len(file_list)
 
-    # computing the md5 can be very long, so this is an option to skip if the file is bigger
-    # than a certain threshold
-    if max_md5_size:
-        hashes = [hashfile.md5(p) if
-                  p.stat().st_size < max_md5_size else None for p in file_list]
-    else:
-        hashes = [hashfile.md5(p) for p in file_list]
+    # files are hashed in parallel and unchanged files are not hashed again. Computing the md5
+    # can be very long, so this is an option to skip if the file is bigger than a certain
+    # threshold and its hash is not cached
+    hashes = hashfile.hash_files(file_list, max_size=max_md5_size)
 
     session_path = alf.io.get_session_path(file_list[0])
     # first register the file
@@ -295,7 +292,7 @@ class RegistrationClient:
         # register all files that match the Alyx patterns, warn user when files are encountered
         rename_files_compatibility(ses_path, md['IBLRIG_VERSION_TAG'])
         F = []  # empty list whose keys will be relative paths and content filenames
-        md5s = []
+        files_hash = []
         file_sizes = []
         for fn in _glob_session(ses_path):
             if fn.suffix in EXCLUDED_EXTENSIONS:
@@ -321,8 +318,9 @@ class RegistrationClient:
             rel_path = Path(str(fn)[str(fn).find(str(gen_rel_path)):])
             F.append(str(rel_path.relative_to(gen_rel_path)))
             file_sizes.append(fn.stat().st_size)
-            md5s.append(hashfile.md5(fn) if fn.stat().st_size < 1024 ** 3 else None)
+            files_hash.append(fn)
             _logger.info('Registering ' + str(fn))
+        md5s = hashfile.hash_files(files_hash, max_size=1024 ** 3)
 
         r_ = {'created_by': username,
               'path': str(gen_rel_path),
@@ -0,0 +1,186 @@
+import multiprocessing
+import shutil
+import tempfile
+import unittest
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+import alf.io
+from brainbox.io import parquet
+from ibllib.exceptions import ALFObjectNotFound
+from oneibl.catalogue import Catalogue, CATALOGUE_FILE, LEGACY_CACHE_FILE
+from oneibl.one import ONE, _ses2pandas
+
+
+def _session_details(eid=None, ndsets=3, subject='KS005', number=1, **kwargs):
+    eid = eid or str(uuid.uuid4())
+    dsets = [{'url': f'https://alyx/datasets/{uuid.uuid4()}', 'id': str(uuid.uuid4()),
+              'hash': f'{i:032x}', 'dataset_type': f'object{i}.times',
+              'name': f'object{i}.times.npy', 'file_size': 1000 + i, 'collection': 'alf',
+              'data_url': f'https://data/{subject}/alf/object{i}.times.npy'}
+             for i in range(ndsets)]
+    ses = {'url': f'https://alyx/sessions/{eid}', 'subject': subject, 'lab': 'cortexlab',
+           'start_time': '2019-04-04T12:00:00', 'number': number, 'task_protocol': 'training',
+           'project': 'ibl_neuropixel_brainwide_01', 'users': ['olivier', 'nbonacchi'],
+           'location': 'rig1', 'n_trials': 100, 'n_correct_trials': 80,
+           'data_dataset_session_related': dsets}
+    ses.update(kwargs)
+    return ses
+
+
+def _upsert_sessions(cache_dir, nses):
+    cat = Catalogue(cache_dir)
+    for i in range(nses):
+        cat.upsert(_ses2pandas(_session_details(number=i)), complete=True)
+
+
+class TestCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.cat = Catalogue(self.td.name)
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def test_upsert_lookups(self):
+        ses = _session_details()
+        eid = ses['url'][-36:]
+        self.assertEqual(self.cat.upsert(_ses2pandas(ses), complete=True), 4)
+        self.assertEqual(len(self.cat), 3)
+        # upserting the same records again does not change anything
+        self.assertEqual(self.cat.upsert(_ses2pandas(ses), complete=True), 0)
+        # a changed hash updates the record in place
+        ses['data_dataset_session_related'][0]['hash'] = 'f' * 32
+        self.assertEqual(self.cat.upsert(_ses2pandas(ses)), 1)
+        df = self.cat.datasets(eid)
+        self.assertEqual(df.shape, (3, 14))
+        self.assertEqual(set(df['hash']), {'f' * 32, f'{1:032x}', f'{2:032x}'})
+        self.assertEqual(parquet.np2str(df[['eid_0', 'eid_1']])[0], eid)
+        # filter by dataset types
+        df = self.cat.datasets(eid, dataset_types=['object1.times', 'titi.tata'])
+        self.assertEqual(df['name'].tolist(), ['object1.times.npy'])
+        self.assertEqual(self.cat.datasets(str(uuid.uuid4())).shape[0], 0)
+        # a long list of sessions doesn't go over the sqlite limit of query parameters
+        eids = [str(uuid.uuid4()) for _ in range(17000)] + [eid, eid]
+        self.assertEqual(self.cat.datasets(eids, dataset_types=['object1.times']).shape[0], 1)
+        # sessions lookups
+        rec = self.cat.session(eid)
+        self.assertEqual(rec['users'], 'olivier,nbonacchi')
+        self.assertEqual(rec['date'], '2019-04-04')
+        self.assertTrue(rec['complete'])
+        self.assertIsNone(self.cat.session(str(uuid.uuid4())))
+        self.assertEqual(self.cat.eid_from_path('KS005', '2019-04-04', '001'), eid)
+        self.assertIsNone(self.cat.eid_from_path('KS005', '2019-04-04', '002'))
+        # datasets without file record are not recorded and removed from complete sessions
+        ses['data_dataset_session_related'][1]['data_url'] = None
+        self.assertEqual(self.cat.upsert(_ses2pandas(ses), complete=True), 1)
+        self.assertEqual(set(self.cat.datasets(eid)['name']),
+                         {'object0.times.npy', 'object2.times.npy'})
+
+    def test_lazy_creation(self):
+        db_file = Path(self.td.name).joinpath(CATALOGUE_FILE)
+        self.assertEqual(len(self.cat), 0)
+        self.assertEqual(self.cat.search(), [])
+        self.assertFalse(db_file.exists())
+        self.cat.upsert(_ses2pandas(_session_details()), complete=True)
+        self.assertTrue(db_file.exists())
+        self.assertEqual(len(Catalogue(self.td.name)), 3)
+
+    def test_legacy_import(self):
+        fixture = Path(__file__).parent.joinpath('fixtures', LEGACY_CACHE_FILE)
+        cache_dir = Path(self.td.name).joinpath('legacy')
+        cache_dir.mkdir()
+        shutil.copy(fixture, cache_dir.joinpath(LEGACY_CACHE_FILE))
+        cat = Catalogue(cache_dir)
+        legacy = parquet.load(fixture)
+        self.assertEqual(len(cat), legacy.shape[0])
+        self.assertTrue(cache_dir.joinpath(CATALOGUE_FILE).exists())
+        eid = parquet.np2str(legacy[['eid_0', 'eid_1']].iloc[0])
+        self.assertFalse(cat.session(eid)['complete'])
+        self.assertEqual(set(cat.datasets(eid)['hash']), set(legacy['hash']))
+
+    def test_concurrent_processes(self):
+        ctx = multiprocessing.get_context('spawn')
+        procs = [ctx.Process(target=_upsert_sessions, args=(self.td.name, 5)) for _ in range(3)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+        self.assertEqual(len(self.cat), 3 * 5 * 3)
+
+
+class TestOneOffline(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.one = ONE(offline=True, silent=True, cache_dir=self.td.name)
+        sessions = [
+            _session_details(subject='KS005', number=1),
+            _session_details(subject='KS005', number=2, start_time='2019-04-05T12:00:00',
+                             users=['olivier'], n_correct_trials=50),
+            _session_details(subject='CSHL052', lab='churchlandlab', ndsets=1,
+                             start_time='2020-02-21T13:24:45', task_protocol='ephysChoiceWorld')]
+        for ses in sessions:
+            self.one._catalogue.upsert(_ses2pandas(ses), complete=True)
+        self.eids = [ses['url'][-36:] for ses in sessions]
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def test_search(self):
+        one = self.one
+        # most recent sessions first
+        self.assertEqual(one.search(), self.eids[::-1])
+        self.assertEqual(one.search(subject='KS005'), self.eids[1::-1])
+        self.assertEqual(one.search(subjects=['CSHL052', 'KS005'], lab='cortexlab'),
+                         self.eids[1::-1])
+        self.assertEqual(one.search(date_range=['2019-04-05', '2020-01-01']), [self.eids[1]])
+        self.assertEqual(one.search(date_range='2019-04-04'), [self.eids[0]])
+        self.assertEqual(one.search(number=2), [self.eids[1]])
+        self.assertEqual(one.search(task='ephys'), [self.eids[2]])
+        self.assertEqual(one.search(users=['olivier', 'nbonacchi']), [self.eids[2], self.eids[0]])
+        self.assertEqual(one.search(performance_gte=60), [self.eids[2], self.eids[0]])
+        self.assertEqual(one.search(performance_lte=60), [self.eids[1]])
+        # sessions have to contain all dataset types
+        self.assertEqual(one.search(dataset_types=['object1.times', 'object2.times']),
+                         self.eids[1::-1])
+        self.assertEqual(one.search(dataset_types=['object1.times', 'titi.tata']), [])
+        self.assertEqual(one.search(limit=1), [self.eids[2]])
+        self.assertIsNone(one.search(toto='titi'))
+        eids, details = one.search(subject='CSHL052', details=True)
+        self.assertEqual(details[0]['users'], ['olivier', 'nbonacchi'])
+        self.assertEqual(Path(details[0]['local_path']).parts[-3:],
+                         ('CSHL052', '2020-02-21', '001'))
+
+    def test_list_paths(self):
+        one = self.one
+        self.assertEqual(one.list(), ['object0.times', 'object1.times', 'object2.times'])
+        self.assertEqual(one.list(self.eids[2]), [Path('alf', 'object0.times.npy')])
+        self.assertEqual(len(one.list(self.eids[0], details=True)), 3)
+        session_path = one.path_from_eid(self.eids[1])
+        self.assertEqual(session_path.parts[-3:], ('KS005', '2019-04-05', '002'))
+        self.assertEqual(one.eid_from_path(session_path.joinpath('alf')), self.eids[1])
+
+    def test_load_object(self):
+        one = self.one
+        with self.assertRaises(ALFObjectNotFound):
+            one.load_object(self.eids[2], 'object0')
+        file = one.path_from_eid(self.eids[2]).joinpath('alf', 'object0.times.npy')
+        file.parent.mkdir(parents=True)
+        np.save(file, np.arange(5))
+        obj = one.load_object(self.eids[2], 'object0')
+        self.assertIsInstance(obj, alf.io.AlfBunch)
+        self.assertTrue(np.all(obj.times == np.arange(5)))
+        self.assertEqual(one.load_object(self.eids[2], 'obj*', download_only=True), [file])
+        self.assertEqual(one.load(self.eids[2], dataset_types=['object0.times'])[0].size, 5)
+        # the offline flag may also be passed explicitly
+        self.assertEqual(one.load(self.eids[2], dataset_types=['object0.times'],
+                                  offline=True)[0].size, 5)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -30,8 +30,8 @@ class TestOneOffline(unittest.TestCase):
         shutil.copyfile(init_cache_file, cache_dir.joinpath(init_cache_file.name))
 
         # test the constructor
-        self.one = ONE(offline=True)
-        self.assertTrue(self.one._cache.shape[1] == 14)
+        self.one = ONE(offline=True, cache_dir=cache_dir)
+        self.assertTrue(len(self.one._catalogue) == 18)
 
         self.eid = 'cf264653-2deb-44cb-aa84-89b82507028a'
 
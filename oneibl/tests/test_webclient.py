@@ -0,0 +1,303 @@
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import re
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+import oneibl.webclient as wc
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves in-memory files with byte range support, can drop connections mid-transfer"""
+    files = {}
+    requests = []
+    interrupt_after = None
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self):
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return None, None
+        first, last = 0, len(data) - 1
+        rg = self.headers.get('Range')
+        if rg:
+            first, last = map(int, re.match(r'bytes=(\d+)-(\d+)', rg).groups())
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(last - first + 1))
+        self.end_headers()
+        return data, (first, last)
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        data, rg = self._headers()
+        if data is None:
+            return
+        _RangeHandler.requests.append((self.path, rg))
+        chunk = data[rg[0]:rg[1] + 1]
+        if _RangeHandler.interrupt_after is not None:
+            chunk = chunk[:_RangeHandler.interrupt_after]
+            _RangeHandler.interrupt_after = None
+            self.close_connection = True
+        self.wfile.write(chunk)
+
+
+class TestHttpDownload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(42)
+        _RangeHandler.files = {f'/file_{i}.bin': np.random.bytes(n)
+                               for i, n in enumerate([100000, 20000, 0])}
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        _RangeHandler.requests = []
+        _RangeHandler.interrupt_after = None
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def _check(self, file_name, md5, path):
+        data = _RangeHandler.files[path]
+        self.assertEqual(Path(file_name).read_bytes(), data)
+        self.assertEqual(md5, hashlib.md5(data).hexdigest())
+        self.assertFalse(Path(file_name + '.part').exists())
+        self.assertFalse(Path(file_name + '.part.json').exists())
+
+    def test_download_file(self):
+        for path in _RangeHandler.files:
+            file_name, md5 = wc.http_download_file(self.url + path, cache_dir=self.td.name,
+                                                   return_md5=True)
+            self._check(file_name, md5, path)
+        # existing files are not downloaded again unless clobber is set
+        wc.http_download_file(self.url + '/file_1.bin', cache_dir=self.td.name)
+        self.assertEqual(len(_RangeHandler.requests), 2)
+        wc.http_download_file(self.url + '/file_1.bin', cache_dir=self.td.name, clobber=True)
+        self.assertEqual(len(_RangeHandler.requests), 3)
+        # partial download of a byte range
+        file_name = wc.http_download_file(self.url + '/file_0.bin', cache_dir=self.td.name,
+                                          chunks=(1000, 500), clobber=True)
+        data = _RangeHandler.files['/file_0.bin']
+        self.assertEqual(Path(file_name).read_bytes(), data[1000:1500])
+
+    def test_segmented_download(self):
+        hash_part_file = wc._SegmentedDownload._hash_part_file
+        with mock.patch.object(wc, 'SEGMENT_SIZE', 16384), \
+                mock.patch.object(wc, 'BLOCK_SIZE', 4096), \
+                mock.patch.object(wc._SegmentedDownload, '_hash_part_file', autospec=True,
+                                  side_effect=hash_part_file) as hpf:
+            file_name, md5 = wc.http_download_file(self.url + '/file_0.bin', nthreads=4,
+                                                   cache_dir=self.td.name, return_md5=True)
+            self._check(file_name, md5, '/file_0.bin')
+            # the part file is only read before and after the download, not for each block
+            self.assertEqual(hpf.call_count, 2)
+            file_name, md5 = wc.http_download_file(self.url + '/file_0.bin', nthreads=1,
+                                                   cache_dir=self.td.name, return_md5=True,
+                                                   clobber=True)
+            self._check(file_name, md5, '/file_0.bin')
+        ranges = sorted(rg for _, rg in _RangeHandler.requests[:4])
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 100000 - 1)
+
+    def test_resume_download(self):
+        _RangeHandler.interrupt_after = 30000
+        with mock.patch.object(wc, 'BLOCK_SIZE', 4096):
+            with self.assertRaises(Exception):
+                wc.http_download_file(self.url + '/file_0.bin', cache_dir=self.td.name)
+            self.assertTrue(Path(self.td.name).joinpath('file_0.bin.part').exists())
+            file_name, md5 = wc.http_download_file(self.url + '/file_0.bin',
+                                                   cache_dir=self.td.name, return_md5=True)
+        self._check(file_name, md5, '/file_0.bin')
+        # the second request only asks for the missing bytes
+        (_, first), (_, second) = _RangeHandler.requests
+        self.assertEqual(first[0], 0)
+        self.assertTrue(0 < second[0] <= 30000)
+
+    def test_download_file_list(self):
+        links = [self.url + path for path in _RangeHandler.files]
+        file_names = wc.http_download_file_list(links, cache_dir=self.td.name, nthreads=3)
+        for file_name, path in zip(file_names, _RangeHandler.files):
+            self.assertEqual(Path(file_name).name, path[1:])
+            self.assertEqual(Path(file_name).read_bytes(), _RangeHandler.files[path])
+        with self.assertRaises(Exception):
+            wc.http_download_file_list([self.url + '/missing.bin'], cache_dir=self.td.name)
+
+
+class _MockAlyxHandler(http.server.BaseHTTPRequestHandler):
+    """Minimal Alyx REST API with a paginated sessions list endpoint"""
+    sessions = {}
+    requests = []
+    page_size = 10
+    delay = 0
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send_json({'token': 'ab1234'})
+
+    def do_GET(self):
+        _MockAlyxHandler.requests.append(('GET', self.path))
+        time.sleep(self.delay)
+        if self.path == '/docs':
+            actions = {'list': {'action': 'get', 'url': '/sessions'},
+                       'read': {'action': 'get', 'url': '/sessions/{id}'},
+                       'partial_update': {'action': 'patch', 'url': '/sessions/{id}'}}
+            return self._send_json({'sessions': actions})
+        path, _, query = self.path.partition('?')
+        if path == '/sessions':
+            query = dict(q.split('=') for q in query.split('&') if q)
+            offset, limit = int(query.get('offset', 0)), int(query.get('limit', self.page_size))
+            ses = [s for s in self.sessions.values()
+                   if query.get('subject', s['subject']) == s['subject']]
+            query.update(limit=limit, offset=offset + limit)
+            url_next = path + '?' + '&'.join(f'{k}={v}' for k, v in query.items())
+            return self._send_json({'count': len(ses), 'next': url_next, 'previous': None,
+                                    'results': ses[offset:offset + limit]})
+        return self._send_json(self.sessions[path.split('/')[-1]])
+
+    def do_PATCH(self):
+        _MockAlyxHandler.requests.append(('PATCH', self.path))
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        ses = self.sessions[self.path.split('/')[-1]]
+        ses.update(data)
+        self._send_json(ses)
+
+
+class TestAlyxClient(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _MockAlyxHandler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        _MockAlyxHandler.sessions = {f'{i:04d}': {'id': f'{i:04d}', 'subject': f'sub{i % 2}',
+                                                  'number': i} for i in range(25)}
+        _MockAlyxHandler.delay = 0
+        self.ac = wc.AlyxClient(username='test_user', password='pwd', base_url=self.url,
+                                cache_endpoints=wc.ALYX_CACHED_ENDPOINTS + ['sessions'])
+        self.ac.clear_cache()
+        self.ac._stats.clear()
+        _MockAlyxHandler.requests = []
+
+    def _ngets(self):
+        return len([r for r in _MockAlyxHandler.requests if r[0] == 'GET'])
+
+    def test_pagination(self):
+        ses = self.ac.rest('sessions', 'list')
+        self.assertEqual(len(ses), 25)
+        self.assertEqual(self._ngets(), 1)
+        # the missing page and the next ones are fetched at once on first access
+        self.assertEqual(ses[10]['number'], 10)
+        self.assertEqual(self._ngets(), 3)
+        self.assertEqual([s['number'] for s in ses], list(range(25)))
+        self.assertEqual(self._ngets(), 3)
+
+    def test_cache_invalidation(self):
+        ses = self.ac.rest('sessions', 'read', id='0003')
+        # the response is cached and the client gets its own copy each time
+        ses['number'] = -1
+        self.assertEqual(self.ac.rest('sessions', 'read', id='0003')['number'], 3)
+        self.assertEqual(len(self.ac.rest('sessions', 'list', subject='sub1')), 12)
+        self.assertEqual(self.ac.rest('sessions', 'read', id='0003')['number'], 3)
+        self.assertEqual(self._ngets(), 2)
+        self.assertEqual(self.ac.stats['sessions']['hits'], 2)
+        # a write invalidates the cache of the endpoint
+        self.ac.rest('sessions', 'partial_update', id='0003', data={'number': 300})
+        self.assertEqual(self.ac.rest('sessions', 'read', id='0003')['number'], 300)
+        self.assertEqual(self._ngets(), 3)
+        # responses expire after the time to live
+        self.ac._cache.ttl = 0.05
+        self.ac.clear_cache()
+        self.ac.rest('sessions', 'read', id='0003')
+        self.ac.rest('sessions', 'read', id='0003')
+        time.sleep(0.1)
+        self.ac.rest('sessions', 'read', id='0003')
+        self.assertEqual(self._ngets(), 5)
+        # the least recently used responses are evicted above the maximum size
+        self.ac._cache.ttl = 60
+        self.ac._cache.max_size = 100
+        for i in range(5):
+            self.ac.rest('sessions', 'read', id=f'{i:04d}')
+        self.assertTrue(0 < len(self.ac._cache) < 5)
+        self.assertTrue(self.ac._cache._size <= 100)
+        # registering files invalidates the sessions and datasets responses
+        self.ac._cache.max_size = wc.ALYX_CACHE_SIZE
+        self.ac.clear_cache()
+        _MockAlyxHandler.requests = []
+        self.ac.rest('sessions', 'read', id='0003')
+        self.ac.rest('sessions', 'read', id='0003')
+        self.ac.post('/register-file', data={'filenames': ['alf/spikes.times.npy']})
+        self.ac.rest('sessions', 'read', id='0003')
+        self.assertEqual(self._ngets(), 2)
+
+    def test_cached_endpoints(self):
+        # by default only the responses of the read-only endpoints are cached
+        ac = wc.AlyxClient(username='test_user', password='pwd', base_url=self.url)
+        ac.clear_cache()
+        _MockAlyxHandler.requests = []
+        ac.rest('sessions', 'read', id='0003')
+        ac.rest('sessions', 'read', id='0003')
+        self.assertEqual(self._ngets(), 2)
+        self.assertEqual(len(ac._cache), 0)
+        self.assertEqual(ac.get('/docs'), self.ac._rest_schemes)
+        ac.get('/docs')
+        self.assertEqual(self._ngets(), 3)
+
+    def test_coalescing(self):
+        _MockAlyxHandler.delay = 0.2
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(self.ac.rest, 'sessions', 'read', id='0005')
+                       for _ in range(4)]
+            res = [f.result() for f in futures]
+        self.assertTrue(all(r == res[0] for r in res))
+        self.assertEqual(self._ngets(), 1)
+        stats = self.ac.stats['sessions']
+        self.assertEqual(stats['misses'] + stats['coalesced'] + stats['hits'], 4)
+        self.assertTrue(stats['latency'] >= 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -1,24 +1,108 @@
+import concurrent.futures
 import json
 import logging
 import math
 import os
 import re
-import urllib.request
+import threading
+import time
+from collections import OrderedDict
 from collections.abc import Mapping
 from pathlib import Path
 import hashlib
 
+import numpy as np
 import requests
 
 from ibllib.misc import pprint, print_progress
 
 _logger = logging.getLogger('ibllib')
 
+ALYX_THREADS = 4  # number of concurrent requests to fetch pages of a paginated response
+ALYX_CACHE_TTL = 60  # seconds during which a GET response is served from the cache
+ALYX_CACHE_SIZE = 2 ** 27  # 128 Mb, maximum total size of the cached responses
+# endpoints whose GET responses are cached: reference tables that clients don't write to
+ALYX_CACHED_ENDPOINTS = ['docs', 'dataset-types', 'data-formats', 'data-repository', 'labs',
+                         'users', 'projects', 'locations']
+# endpoints whose cached responses are invalidated by a write to another endpoint
+ALYX_WRITE_INVALIDATES = {'register-file': ['datasets', 'files', 'sessions']}
+
+
+def _endpoint(rest_query):
+    """
+    '/sessions/f8d5c8b0-...' -> 'sessions', '/datasets?session=f8d5...' -> 'datasets'
+    """
+    return re.findall("^/*[^?/]*", rest_query)[0].replace('/', '')
+
+
+class _ResponseCache:
+    """
+    Thread-safe cache of GET responses text, keyed by query. Only the responses of `endpoints`
+    are cached. Entries expire after `ttl` seconds and the least recently used entries are
+    evicted above a total size of `max_size` characters.
+    Each endpoint has a generation counter incremented on invalidation, so that a response
+    requested before a write to the endpoint is not cached after it.
+    """
+
+    def __init__(self, ttl=ALYX_CACHE_TTL, max_size=ALYX_CACHE_SIZE, endpoints=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.endpoints = set(ALYX_CACHED_ENDPOINTS if endpoints is None else endpoints)
+        self._entries = OrderedDict()  # rest_query: (expiry time, text)
+        self._generations = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if entry[0] < time.time():
+                self._pop(key)
+                return
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def generation(self, key):
+        return self._generations.get(_endpoint(key), 0)
+
+    def set(self, key, text, generation=None):
+        if self.ttl <= 0 or len(text) > self.max_size or _endpoint(key) not in self.endpoints:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation(key):
+                return
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time.time() + self.ttl, text)
+            self._size += len(text)
+            while self._size > self.max_size:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        self._size -= len(self._entries.pop(key)[1])
+
+    def invalidate(self, endpoint=None):
+        """
+        :param endpoint: removes the responses of this endpoint only (default: all)
+        """
+        with self._lock:
+            keys = [k for k in self._entries if endpoint is None or _endpoint(k) == endpoint]
+            for k in keys:
+                self._pop(k)
+            for e in ([endpoint] if endpoint else list(self._generations.keys())):
+                self._generations[e] = self._generations.get(e, 0) + 1
+
 
 class _PaginatedResponse(Mapping):
     """
     This class allows to emulate a list from a paginated response.
-    Provides cache functionality
+    Provides cache functionality: on access to a missing page, the next pages are prefetched
+    concurrently
     PaginatedResponse(alyx, response)
     """
 
@@ -39,13 +123,21 @@ class _PaginatedResponse(Mapping):
     def __len__(self):
         return self.count
 
+    def _fetch_page(self, offset):
+        query = f'{self.query}&limit={self.limit}&offset={offset}'
+        res = self.alyx._generic_request('GET', query)
+        for i, r in enumerate(res['results']):
+            self._cache[i + offset] = res['results'][i]
+
     def __getitem__(self, item):
         if self._cache[item] is None:
             offset = self.limit * math.floor(item / self.limit)
-            query = f'{self.query}&limit={self.limit}&offset={offset}'
-            res = self.alyx._generic_request(requests.get, query)
-            for i, r in enumerate(res['results']):
-                self._cache[i + offset] = res['results'][i]
+            # fetch the page and the next missing ones concurrently
+            offsets = [o for o in range(offset, self.count, self.limit)[:ALYX_THREADS]
+                       if self._cache[o] is None]
+            futures = [self.alyx._executor.submit(self._fetch_page, o) for o in offsets]
+            for future in futures:
+                future.result()
         return self._cache[item]
 
     def __iter__(self):
@@ -53,27 +145,76 @@ class _PaginatedResponse(Mapping):
             yield self.__getitem__(i)
 
 
-def http_download_file_list(links_to_file_list, **kwargs):
+DOWNLOAD_THREADS = 4  # number of files downloaded concurrently
+SEGMENT_SIZE = 2 ** 28  # 256 Mb, files above this size are split in parallel byte ranges
+BLOCK_SIZE = 8192 * 64 * 8  # 4 Mb streaming block size
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def http_session():
+    """
+    Returns the module level HTTP session. Connections are kept alive and pooled so that
+    concurrent and successive downloads from the same server re-use them.
+
+    :return: requests.Session
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=DOWNLOAD_THREADS,
+                                                    pool_maxsize=DOWNLOAD_THREADS ** 2)
+            _SESSION.mount('http://', adapter)
+            _SESSION.mount('https://', adapter)
+    return _SESSION
+
+
+def _reset_http_session():
+    # connections and locks can't be shared with a forked child process
+    global _SESSION, _SESSION_LOCK
+    _SESSION, _SESSION_LOCK = None, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_http_session)
+
+
+def http_download_file_list(links_to_file_list, nthreads=DOWNLOAD_THREADS, **kwargs):
     """
     Downloads a list of files from the flat Iron from a list of links.
     Same options behaviour as http_download_file
 
     :param links_to_file_list: list of http links to files.
     :type links_to_file_list: list
+    :param nthreads: [4] number of files downloaded concurrently
+    :type nthreads: int
 
     :return: (list) a list of the local full path of the downloaded files.
     """
-    file_names_list = []
-    for link_str in links_to_file_list:
-        file_names_list.append(http_download_file(link_str, **kwargs))
-    return file_names_list
+    if nthreads == 1:
+        return [http_download_file(link_str, **kwargs) for link_str in links_to_file_list]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+        futures = [executor.submit(http_download_file, link_str, **kwargs)
+                   for link_str in links_to_file_list]
+        return [future.result() for future in futures]
 
 
-def http_download_file(full_link_to_file, chunks=None, *, clobber=False,
-                       username='', password='', cache_dir='', return_md5=False, headers=None):
+def http_download_file(full_link_to_file, chunks=None, *, clobber=False, username='',
+                       password='', cache_dir='', return_md5=False, headers=None, nthreads=1,
+                       resume=True):
     """
+    Downloads a file through a pooled HTTP session.
+    If the server supports byte ranges, the file is first written to a `.part` file whose
+    progress is recorded in a `.part.json` file: an interrupted download resumes where it
+    stopped on the next call. Files above SEGMENT_SIZE are split in `nthreads` byte ranges
+    downloaded in parallel.
+
     :param full_link_to_file: http link to the file.
     :type full_link_to_file: str
+    :param chunks: (first_byte, n_bytes) to download only part of the file
+    :type chunks: tuple
     :param clobber: [False] If True, force overwrite the existing file.
     :type clobber: bool
     :param username: [''] authentication for password protected file server.
@@ -82,10 +223,17 @@ def http_download_file(full_link_to_file, chunks=None, *, clobber=False,
     :type password: str
     :param cache_dir: [''] directory in which files are cached; defaults to user's
      Download directory.
-    :param: headers: [{}] additional headers to add to the request (auth tokens etc..)
     :type cache_dir: str
+    :param return_md5: [False] if True, also returns the md5 computed while downloading
+    :type return_md5: bool
+    :param: headers: [{}] additional headers to add to the request (auth tokens etc..)
+    :type headers: dict
+    :param nthreads: [1] maximum number of parallel connections for a single large file
+    :type nthreads: int
+    :param resume: [True] resumes a previously interrupted download if any
+    :type resume: bool
 
-    :return: (str) a list of the local full path of the downloaded files.
+    :return: (str) the local full path of the downloaded file, (str, str) with the md5
     """
     from ibllib.io import hashfile
     if not full_link_to_file:
@@ -102,59 +250,206 @@ def http_download_file(full_link_to_file, chunks=None, *, clobber=False,
     if not clobber and os.path.exists(file_name):
         return (file_name, hashfile.md5(file_name)) if return_md5 else file_name
 
-    # This should be the base url you wanted to access.
-    baseurl = os.path.split(str(full_link_to_file))[0]
-
-    # Create a password manager
-    manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-    if (len(password) != 0) & (len(username) != 0):
-        manager.add_password(None, baseurl, username, password)
-
-    # Create an authentication handler using the password manager
-    auth = urllib.request.HTTPBasicAuthHandler(manager)
-
-    # Create an opener that will replace the default urlopen method on further calls
-    opener = urllib.request.build_opener(auth)
-    urllib.request.install_opener(opener)
-
-    # Support for partial download.
-    req = urllib.request.Request(full_link_to_file)
-    if chunks is not None:
-        first_byte, n_bytes = chunks
-        req.add_header("Range", "bytes=%d-%d" % (first_byte, first_byte + n_bytes - 1))
-
-    # add additional headers
-    if headers is not None:
-        for k in headers:
-            req.add_header(k, headers[k])
-
-    # Open the url and get the length
+    session = http_session()
+    auth = (username, password) if (len(password) != 0) & (len(username) != 0) else None
+    headers = dict(headers or {})
+
+    # probe the file size and the byte range support
+    rep = session.head(full_link_to_file, auth=auth, headers=headers, allow_redirects=True)
+    if rep.status_code in (405, 501):  # HEAD not implemented by the server
+        file_size, etag, ranges = None, None, False
+    else:
+        _raise_for_status(rep, full_link_to_file)
+        file_size = rep.headers.get('Content-Length')
+        file_size = None if file_size is None else int(file_size)
+        etag = rep.headers.get('ETag') or rep.headers.get('Last-Modified')
+        ranges = rep.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+    first_byte, n_bytes = (0, file_size) if chunks is None else chunks
+    if n_bytes is None or not ranges:
+        if chunks is not None:
+            headers['Range'] = "bytes=%d-%d" % (first_byte, first_byte + n_bytes - 1)
+        md5 = _http_stream_file(session, full_link_to_file, file_name, auth, headers, n_bytes)
+    else:
+        download = _SegmentedDownload(session, full_link_to_file, file_name, auth, headers,
+                                      first_byte, n_bytes, etag=etag, return_md5=return_md5)
+        download.run(nthreads=nthreads, resume=resume)
+        md5 = download.md5
+    return (file_name, md5) if return_md5 else file_name
+
+
+def _raise_for_status(rep, url):
     try:
-        u = urllib.request.urlopen(req)
-    except urllib.error.HTTPError as e:
-        _logger.error(f"{str(e)} {full_link_to_file}")
+        rep.raise_for_status()
+    except requests.HTTPError as e:
+        _logger.error(f"{str(e)} {url}")
         raise e
 
-    file_size = int(u.getheader('Content-length'))
-
-    print(f"Downloading: {file_name} Bytes: {file_size}")
-    file_size_dl = 0
-    block_sz = 8192 * 64 * 8
 
+def _http_stream_file(session, url, file_name, auth, headers, file_size):
+    """
+    Downloads a file in a single request, for servers not supporting byte ranges
+    """
     md5 = hashlib.md5()
-    f = open(file_name, 'wb')
-    while True:
-        buffer = u.read(block_sz)
-        if not buffer:
-            break
-        file_size_dl += len(buffer)
-        f.write(buffer)
-        if return_md5:
-            md5.update(buffer)
-        print_progress(file_size_dl, file_size, prefix='', suffix='')
-    f.close()
+    with session.get(url, auth=auth, headers=headers, stream=True) as rep:
+        _raise_for_status(rep, url)
+        if file_size is None and rep.headers.get('Content-Length'):
+            file_size = int(rep.headers.get('Content-Length'))
+        print(f"Downloading: {file_name} Bytes: {file_size}")
+        file_size_dl = 0
+        with open(file_name, 'wb') as f:
+            for buffer in rep.iter_content(chunk_size=BLOCK_SIZE):
+                file_size_dl += len(buffer)
+                f.write(buffer)
+                md5.update(buffer)
+                if file_size:
+                    print_progress(file_size_dl, file_size, prefix='', suffix='')
+    return md5.hexdigest()
+
+
+class _SegmentedDownload:
+    """
+    Downloads a file in one or several byte ranges written in place in a `.part` file.
+    The progress of each range is saved in a `.part.json` file to resume interrupted downloads.
+    The md5 is computed on the fly from the downloaded buffers contiguous to the hashed part of
+    the file, ie. all of them for a single range. The bytes of the other ranges are hashed from
+    the `.part` file once the download is complete.
+    """
 
-    return (file_name, md5.hexdigest()) if return_md5 else file_name
+    def __init__(self, session, url, file_name, auth, headers, first_byte, n_bytes,
+                 etag=None, return_md5=False):
+        self.session = session
+        self.url = url
+        self.file_name = file_name
+        self.part_file = Path(file_name + '.part')
+        self.state_file = Path(file_name + '.part.json')
+        self.auth = auth
+        self.headers = headers
+        self.first_byte = first_byte
+        self.n_bytes = n_bytes
+        self.etag = etag
+        self.segments = None
+        self._md5 = hashlib.md5() if return_md5 else None
+        self._hashed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest() if self._md5 is not None else None
+
+    def _state(self):
+        return {'url': self.url, 'first_byte': self.first_byte, 'n_bytes': self.n_bytes,
+                'etag': self.etag, 'segments': self.segments}
+
+    def _load_state(self, nthreads, resume):
+        """
+        Reads the progress of a previous download of the same remote bytes, or starts anew
+        """
+        if resume and self.part_file.exists() and self.state_file.exists():
+            try:
+                with open(self.state_file) as fid:
+                    state = json.load(fid)
+            except ValueError:
+                state = None
+            if state is not None and all(state.get(k) == v for k, v in self._state().items()
+                                         if k != 'segments'):
+                _logger.info(f"resuming download of {self.file_name}")
+                self.segments = state['segments']
+                return
+        nseg = int(min(max(nthreads, 1), max(np.ceil(self.n_bytes / SEGMENT_SIZE), 1)))
+        bounds = np.linspace(0, self.n_bytes, nseg + 1).astype(np.int64) + self.first_byte
+        # each segment is a list [first byte, last byte + 1, number of bytes downloaded]
+        self.segments = [[int(b0), int(b1), 0] for b0, b1 in zip(bounds[:-1], bounds[1:])]
+        with open(self.part_file, 'wb') as f:
+            f.truncate(self.n_bytes)
+        self._save_state()
+
+    def _save_state(self, state=None):
+        """
+        Writes the progress state atomically, so that the segments threads can save it
+        concurrently. A state saved late only records less progress than on disk.
+        """
+        state_tmp = self.state_file.with_suffix(f'.{threading.get_ident()}.tmp')
+        with open(state_tmp, 'w') as fid:
+            json.dump(state or self._state(), fid)
+        os.replace(state_tmp, self.state_file)
+
+    def _advance(self, iseg, offset, buffer):
+        """
+        Records the bytes written by a segment thread and hashes them if they are contiguous to
+        the hashed part of the file
+        :param offset: position of the buffer relative to the first byte
+        """
+        # buffers of different segments can't start at the same offset: only the thread writing
+        # at the end of the hashed part hashes its buffers, in order
+        if self._md5 is not None and offset == self._hashed:
+            self._md5.update(buffer)
+            self._hashed += len(buffer)
+        with self._lock:
+            self.segments[iseg][2] += len(buffer)
+            state = self._state()
+            state['segments'] = [list(seg) for seg in self.segments]
+            done = sum(seg[2] for seg in self.segments)
+        self._save_state(state)
+        print_progress(done - 1, self.n_bytes, prefix='', suffix='')
+
+    def _hash_part_file(self):
+        """
+        Hashes the downloaded bytes contiguous to the hashed part of the file from the `.part`
+        file, when no segment is being downloaded
+        """
+        if self._md5 is None:
+            return
+        contiguous = 0
+        for b0, b1, done in self.segments:
+            contiguous = b0 + done - self.first_byte
+            if b0 + done < b1:
+                break
+        if contiguous <= self._hashed:
+            return
+        with open(self.part_file, 'rb') as f:
+            f.seek(self._hashed)
+            while self._hashed < contiguous:
+                buffer = f.read(min(BLOCK_SIZE, contiguous - self._hashed))
+                self._md5.update(buffer)
+                self._hashed += len(buffer)
+
+    def _fetch(self, iseg):
+        b0, b1, done = self.segments[iseg]
+        if b0 + done >= b1:
+            return
+        headers = {**self.headers, 'Range': f"bytes={b0 + done}-{b1 - 1}"}
+        with self.session.get(self.url, auth=self.auth, headers=headers, stream=True) as rep:
+            _raise_for_status(rep, self.url)
+            if rep.status_code != 206:
+                raise IOError(f"{self.url} server ignored the byte range request")
+            offset = b0 + done - self.first_byte
+            with open(self.part_file, 'r+b') as f:
+                f.seek(offset)
+                for buffer in rep.iter_content(chunk_size=BLOCK_SIZE):
+                    f.write(buffer)
+                    f.flush()
+                    self._advance(iseg, offset, buffer)
+                    offset += len(buffer)
+
+    def run(self, nthreads=1, resume=True):
+        self._load_state(nthreads, resume)
+        print(f"Downloading: {self.file_name} Bytes: {self.n_bytes}")
+        # bytes downloaded by a previous run
+        self._hash_part_file()
+        if len(self.segments) == 1:
+            self._fetch(0)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.segments)) as ex:
+                futures = [ex.submit(self._fetch, i) for i in range(len(self.segments))]
+                for future in futures:
+                    future.result()
+        if any(b0 + done != b1 for b0, b1, done in self.segments):
+            raise IOError(f"{self.url} download incomplete, re-run to resume")
+        # bytes of the segments downloaded ahead of the hashed part
+        self._hash_part_file()
+        os.replace(self.part_file, self.file_name)
+        self.state_file.unlink()
 
 
 def file_record_to_url(file_records, urls=[]):
@@ -216,9 +511,15 @@ class AlyxClient(metaclass=UniqueSingletons):
     """
     Class that implements simple GET/POST wrappers for the Alyx REST API
     http://alyx.readthedocs.io/en/latest/api.html
+
+    Requests go through a pooled keep-alive session. GET responses of the `cache_endpoints`
+    are cached for `cache_ttl` seconds and identical GET requests in flight from several threads
+    are sent only once. The cached responses of an endpoint are invalidated by any write to this
+    endpoint, or to an endpoint that changes its records (see ALYX_WRITE_INVALIDATES).
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, cache_ttl=ALYX_CACHE_TTL, cache_size=ALYX_CACHE_SIZE, cache_endpoints=None,
+                 **kwargs):
         """
         Create a client instance that allows to GET and POST to the Alyx server
         For oneibl, constructor attempts to authenticate with credentials in params.py
@@ -230,7 +531,20 @@ class AlyxClient(metaclass=UniqueSingletons):
         :type password: str
         :param base_url: Alyx server address, including port and protocol
         :type base_url: str
+        :param cache_ttl: [60] time in seconds a GET response is cached, 0 disables the cache
+        :type cache_ttl: float
+        :param cache_size: [2 ** 27] maximum total size of the cached responses in characters
+        :type cache_size: int
+        :param cache_endpoints: endpoints whose GET responses are cached, defaults to the
+         read-only reference tables in ALYX_CACHED_ENDPOINTS
+        :type cache_endpoints: list
         """
+        self._cache = _ResponseCache(ttl=cache_ttl, max_size=cache_size,
+                                     endpoints=cache_endpoints)
+        self._stats = {}
+        self._init_connections()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._init_connections)
         self.authenticate(**kwargs)
         self._headers['Accept'] = 'application/coreapi+json'
         self._rest_schemes = self.get('/docs')
@@ -238,20 +552,83 @@ class AlyxClient(metaclass=UniqueSingletons):
         self._headers['Accept'] = 'application/json'
         self._obj_id = id(self)
 
-    def _generic_request(self, reqfunction, rest_query, data=None, files=None):
+    def _init_connections(self):
+        """
+        Creates the HTTP session, the thread pool and the locks. Called again in forked child
+        processes (ie. pipeline workers) as those can't be shared across processes
+        """
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=ALYX_THREADS * 2)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=ALYX_THREADS)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._cache._lock = threading.Lock()
+
+    def _generic_request(self, method, rest_query, data=None, files=None):
+        """
+        :param method: HTTP method: 'GET', 'POST', 'PUT', 'PATCH' or 'DELETE'
+        """
         # makes sure the base url is the one from the instance
         rest_query = rest_query.replace(self._base_url, '')
         if not rest_query.startswith('/'):
             rest_query = '/' + rest_query
+        if method == 'GET':
+            text = self._cached_get(rest_query)
+        else:
+            try:
+                text = self._send(method, rest_query, data=data, files=files)
+            finally:
+                # a write may change the responses of any query to the endpoint
+                endpoint = _endpoint(rest_query)
+                for e in [endpoint] + ALYX_WRITE_INVALIDATES.get(endpoint, []):
+                    self._cache.invalidate(e)
+        return None if text is None else json.loads(text)
+
+    def _cached_get(self, rest_query):
+        """
+        Returns the GET response text from the cache, from an identical request in flight, or
+        sends the request
+        """
+        text = self._cache.get(rest_query)
+        if text is not None:
+            self._log_request('GET', rest_query, 'hits')
+            return text
+        with self._lock:
+            future = self._inflight.get(rest_query)
+            owner = future is None
+            if owner:
+                future = self._inflight[rest_query] = concurrent.futures.Future()
+        if not owner:
+            self._log_request('GET', rest_query, 'coalesced')
+            return future.result()
+        try:
+            generation = self._cache.generation(rest_query)
+            text = self._send('GET', rest_query)
+            if text is not None:
+                self._cache.set(rest_query, text, generation=generation)
+            future.set_result(text)
+        except Exception as e:
+            future.set_exception(e)
+            raise e
+        finally:
+            with self._lock:
+                self._inflight.pop(rest_query, None)
+        return text
+
+    def _send(self, method, rest_query, data=None, files=None):
         _logger.debug(f"{self._base_url + rest_query}, headers: {self._headers}")
         headers = self._headers.copy()
         if files is None:
             data = json.dumps(data) if isinstance(data, dict) or isinstance(data, list) else data
             headers['Content-Type'] = 'application/json'
-        r = reqfunction(self._base_url + rest_query, stream=True, headers=headers,
-                        data=data, files=files)
+        t0 = time.time()
+        r = self._session.request(method, self._base_url + rest_query, headers=headers,
+                                  data=data, files=files)
+        self._log_request(method, rest_query, 'misses', latency=time.time() - t0)
         if r and r.status_code in (200, 201):
-            return json.loads(r.text)
+            return r.text
         elif r and r.status_code == 204:
             return
         else:
@@ -259,6 +636,33 @@ class AlyxClient(metaclass=UniqueSingletons):
             _logger.error(r.text)
             raise(requests.HTTPError(r))
 
+    def _log_request(self, method, rest_query, outcome, latency=0.):
+        endpoint = _endpoint(rest_query)
+        with self._lock:
+            stats = self._stats.setdefault(
+                endpoint, {'hits': 0, 'coalesced': 0, 'misses': 0, 'latency': 0.})
+            stats[outcome] += 1
+            stats['latency'] += latency
+        _logger.debug(f"alyx {method} {endpoint} {outcome} {latency * 1000:.0f} ms: "
+                      f"{stats['hits']} hits, {stats['coalesced']} coalesced, "
+                      f"{stats['misses']} requests, {stats['latency']:.2f} s total")
+
+    @property
+    def stats(self):
+        """
+        Per endpoint count of cache hits, coalesced requests, requests sent to the server
+        and total latency of the requests sent in seconds
+        """
+        with self._lock:
+            return {k: dict(v) for k, v in self._stats.items()}
+
+    def clear_cache(self, endpoint=None):
+        """
+        Removes the cached GET responses
+        :param endpoint: only removes the responses of this endpoint (default: all)
+        """
+        self._cache.invalidate(endpoint)
+
     def authenticate(self, username='', password='', base_url=''):
         """
         Gets a security token from the Alyx REST API to create requests headers.
@@ -272,8 +676,8 @@ class AlyxClient(metaclass=UniqueSingletons):
         :type base_url: str
         """
         self._base_url = base_url
-        rep = requests.post(base_url + '/auth-token',
-                            data=dict(username=username, password=password))
+        rep = self._session.post(base_url + '/auth-token',
+                                 data=dict(username=username, password=password))
         # Assign token or raise exception on internal server error
         self._token = rep.json() if rep.ok else rep.raise_for_status()
         if not (list(self._token.keys()) == ['token']):
@@ -295,7 +699,7 @@ class AlyxClient(metaclass=UniqueSingletons):
 
         :return: (dict/list) json interpreted dictionary from response
         """
-        return self._generic_request(requests.delete, rest_query)
+        return self._generic_request('DELETE', rest_query)
 
     def download_file(self, url, **kwargs):
         """
@@ -318,7 +722,7 @@ class AlyxClient(metaclass=UniqueSingletons):
 
         :return: (dict/list) json interpreted dictionary from response
         """
-        rep = self._generic_request(requests.get, rest_query)
+        rep = self._generic_request('GET', rest_query)
         _logger.debug(rest_query)
         if isinstance(rep, dict) and list(rep.keys()) == ['count', 'next', 'previous', 'results']:
             if len(rep['results']) < rep['count']:
@@ -341,7 +745,7 @@ class AlyxClient(metaclass=UniqueSingletons):
 
         :return: response object
         """
-        return self._generic_request(requests.patch, rest_query, data=data, files=files)
+        return self._generic_request('PATCH', rest_query, data=data, files=files)
 
     def post(self, rest_query, data=None, files=None):
         """
@@ -357,7 +761,7 @@ class AlyxClient(metaclass=UniqueSingletons):
 
         :return: response object
         """
-        return self._generic_request(requests.post, rest_query, data=data, files=files)
+        return self._generic_request('POST', rest_query, data=data, files=files)
 
     def put(self, rest_query, data=None, files=None):
         """
@@ -373,7 +777,7 @@ class AlyxClient(metaclass=UniqueSingletons):
 
         :return: response object
         """
-        return self._generic_request(requests.put, rest_query, data=data, files=files)
+        return self._generic_request('PUT', rest_query, data=data, files=files)
 
     def rest(self, url=None, action=None, id=None, data=None, files=None, **kwargs):
         """